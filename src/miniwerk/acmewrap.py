@@ -0,0 +1,203 @@
+"""In-process ACME client, alternative to calling certbot (le_engine=acme)
+
+The account key and registration are kept in acme_path and reused, one HTTP-01 responder serves the
+challenges of all the orders so the lineages are ordered concurrently. Results are written as plain files
+to acme_path/live/<lineage> (see MWConfig.le_lineage_dir), same file names as certbot uses so copying and
+renewal checks work the same for both. Certbot's own live dir holds symlinks into its archive and is
+left alone so switching back to le_engine=certbot keeps working"""
+
+from typing import List, Optional, Set, Tuple, cast
+from dataclasses import dataclass, field
+import asyncio
+import datetime
+import hashlib
+import logging
+
+from josepy.jwk import JWKRSA
+from acme import challenges, client, crypto_util, errors, messages, standalone
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+from miniwerk import __version__
+from .config import MWConfig, KeyType
+from .helpers import cert_needs_renewal, certbot_lock, file_lock, write_if_changed
+from .jwt import PRIVDIR_MODE
+from .report import in_context, measure
+
+LOGGER = logging.getLogger(__name__)
+LE_DIRECTORY = "https://acme-v02.api.letsencrypt.org/directory"
+LE_STAGING_DIRECTORY = "https://acme-staging-v02.api.letsencrypt.org/directory"
+USER_AGENT = f"miniwerk/{__version__}"
+
+
+@dataclass
+class PendingOrder:
+    """Order whose challenges are being served"""
+
+    lineage: str
+    keypem: bytes
+    acme: client.ClientV2
+    orderr: messages.OrderResource
+    answers: List[Tuple[messages.ChallengeBody, challenges.ChallengeResponse]] = field(default_factory=list)
+
+
+def acme_directory(config: MWConfig) -> str:
+    """Directory URL to use"""
+    if config.acme_directory:
+        return config.acme_directory
+    return LE_STAGING_DIRECTORY if config.le_test else LE_DIRECTORY
+
+
+def private_key_pem(keytype: KeyType) -> bytes:
+    """New cert private key in PKCS8 PEM"""
+    key: rsa.RSAPrivateKey | ec.EllipticCurvePrivateKey
+    if keytype == KeyType.ECDSA:
+        key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def load_account_key(config: MWConfig) -> JWKRSA:
+    """Load the account key, create it if needed"""
+    config.acme_path.mkdir(parents=True, exist_ok=True)
+    config.acme_path.chmod(PRIVDIR_MODE)
+    keypath = config.acme_path / "account.key"
+    if not keypath.exists():
+        LOGGER.info("Creating ACME account key {}".format(keypath))
+        write_if_changed(keypath, private_key_pem(KeyType.RSA), mode=0o600)
+    key = serialization.load_pem_private_key(keypath.read_bytes(), password=None)
+    assert isinstance(key, rsa.RSAPrivateKey)  # we wrote it
+    return JWKRSA(key=key)
+
+
+def make_client(
+    config: MWConfig, account_key: JWKRSA, regr: Optional[messages.RegistrationResource] = None
+) -> client.ClientV2:
+    """ACME client, each order gets its own so that they can run in separate threads"""
+    net = client.ClientNetwork(account_key, account=regr, user_agent=USER_AGENT, verify_ssl=config.acme_verify_ssl)
+    return client.ClientV2(client.ClientV2.get_directory(acme_directory(config), net), net=net)
+
+
+def register_account(config: MWConfig, account_key: JWKRSA) -> messages.RegistrationResource:
+    """Get the account registration for the directory, register if needed"""
+    directory = acme_directory(config)
+    regrpath = config.acme_path / f"regr-{hashlib.sha256(directory.encode('utf-8')).hexdigest()[:16]}.json"
+    if regrpath.exists():
+        return cast(messages.RegistrationResource, messages.RegistrationResource.json_loads(regrpath.read_bytes()))
+    acme = make_client(config, account_key)
+    newreg = messages.NewRegistration.from_data(email=config.le_email, terms_of_service_agreed=True)
+    try:
+        regr = acme.new_account(newreg)
+        LOGGER.info("Registered ACME account {}".format(regr.uri))
+    except errors.ConflictError as exc:  # key is registered but we lost the regr file
+        regr = acme.query_registration(messages.RegistrationResource(uri=exc.location, body=messages.Registration()))
+    write_if_changed(regrpath, regr.json_dumps().encode("utf-8"), mode=0o600)
+    return regr
+
+
+def start_order(
+    config: MWConfig,
+    account_key: JWKRSA,
+    regr: messages.RegistrationResource,
+    lineage: str,
+    resources: Set[standalone.HTTP01RequestHandler.HTTP01Resource],
+) -> PendingOrder:
+    """Create the order and add its HTTP-01 challenges to the responder resources"""
+    keypem = private_key_pem(config.keytype)
+    acme = make_client(config, account_key, regr)
+    orderr = acme.new_order(crypto_util.make_csr(keypem, list(config.cert_lineages[lineage])))
+    order = PendingOrder(lineage=lineage, keypem=keypem, acme=acme, orderr=orderr)
+    for authz in orderr.authorizations:
+        if authz.body.status == messages.STATUS_VALID:
+            continue
+        for challb in authz.body.challenges:
+            if isinstance(challb.chall, challenges.HTTP01):
+                break
+        else:
+            raise RuntimeError("No HTTP-01 challenge for {}".format(authz.body.identifier.value))
+        response, validation = challb.response_and_validation(account_key)
+        resources.add(
+            standalone.HTTP01RequestHandler.HTTP01Resource(chall=challb.chall, response=response, validation=validation)
+        )
+        order.answers.append((challb, response))
+    return order
+
+
+def finish_order(config: MWConfig, order: PendingOrder) -> None:
+    """Answer the challenges, wait for the cert and write it to the lineage dir"""
+    for challb, response in order.answers:
+        order.acme.answer_challenge(challb, response)
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=config.certbot_timeout)
+    orderr = order.acme.poll_and_finalize(order.orderr, deadline)
+    fullchain = orderr.fullchain_pem.encode("utf-8")
+    certs = x509.load_pem_x509_certificates(fullchain)
+    pems = [cert.public_bytes(serialization.Encoding.PEM) for cert in certs]
+    livedir = config.le_lineage_dir(order.lineage)
+    livedir.mkdir(parents=True, exist_ok=True)
+    livedir.chmod(PRIVDIR_MODE)
+    # Key first so that the cert never points to a key that is not there
+    write_if_changed(livedir / "privkey.pem", order.keypem, mode=0o600)
+    write_if_changed(livedir / "cert.pem", pems[0])
+    write_if_changed(livedir / "chain.pem", b"".join(pems[1:]))
+    write_if_changed(livedir / "fullchain.pem", fullchain)
+    LOGGER.info("Got cert for {} valid until {}".format(order.lineage, certs[0].not_valid_after_utc))
+
+
+def lineages_to_renew(config: MWConfig) -> List[str]:
+    """Lineages whose cert is missing, has different names or is about to expire"""
+    return [
+        lineage
+        for lineage, fqdns in config.cert_lineages.items()
+        if cert_needs_renewal(config.le_lineage_dir(lineage) / "fullchain.pem", fqdns, config.cert_renew_before)
+    ]
+
+
+async def get_acme_certs(config: MWConfig) -> None:
+    """Order certs for the lineages that need renewal, all orders are served by one HTTP-01 responder.
+
+    Takes the same locks as certbot since both bind the HTTP port"""
+    lineages = lineages_to_renew(config)
+    if not lineages:
+        LOGGER.info("Current certs are fine, not ordering")
+        return
+    if config.ci:
+        LOGGER.info("Running under CI, not actually ordering certs for {}".format(lineages))
+        return
+    async with (
+        certbot_lock(),
+        file_lock(config.locks_path / "certbot.lock", config.lock_timeout + config.certbot_timeout),
+    ):
+        # Someone else may have got the certs while we waited
+        lineages = lineages_to_renew(config)
+        if not lineages:
+            LOGGER.info("Certs were renewed while we waited for the lock")
+            return
+        await order_certs(config, lineages)
+
+
+async def order_certs(config: MWConfig, lineages: List[str]) -> None:
+    """Order and write the certs for the lineages"""
+    loop = asyncio.get_event_loop()
+    with measure("acme"):
+        account_key = await loop.run_in_executor(None, load_account_key, config)
+        regr = await loop.run_in_executor(None, register_account, config, account_key)
+        resources: Set[standalone.HTTP01RequestHandler.HTTP01Resource] = set()
+        servers = standalone.HTTP01DualNetworkedServers(("", config.acme_http_port), resources)
+        servers.serve_forever()
+        try:
+            # The responder iterates the set so it is only modified before the challenges are answered
+            orders = [
+                await loop.run_in_executor(None, start_order, config, account_key, regr, lineage, resources)
+                for lineage in lineages
+            ]
+            await asyncio.gather(
+                *(loop.run_in_executor(None, in_context(finish_order, config, order)) for order in orders)
+            )
+        finally:
+            servers.shutdown_and_server_close()
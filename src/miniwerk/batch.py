@@ -0,0 +1,91 @@
+"""Provision many deployments in one process"""
+
+from typing import Any, Dict, List, Optional, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+import asyncio
+import json
+import logging
+import time
+
+from .config import MWConfig
+from .certs import get_certs
+from .jwt import check_create_keypair
+from .manifests import create_rasenmaeher_manifest, create_all_product_manifests
+from .report import measure
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchResult:
+    """How provisioning one deployment went"""
+
+    domain: str
+    duration: float
+    error: Optional[str] = None
+
+
+def load_deployments(batchfile: Path) -> List[MWConfig]:
+    """Read a JSON list of objects, each is the config of one deployment using the MWConfig field names.
+    Fields not given come from the environment/defaults as usual.
+
+    Deployments must not share domain, data_path, manifests_base or cert copy dirs"""
+    data = json.loads(batchfile.read_text(encoding="utf-8"))
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        raise ValueError("{} must contain a JSON list of objects".format(batchfile))
+    configs = [MWConfig(**item) for item in data]
+    seen: Dict[str, Dict[Any, str]] = {"domain": {}, "data_path": {}, "manifests_base": {}, "copy dir": {}}
+    for config in configs:
+        values: Dict[str, List[Any]] = {
+            "domain": [config.domain],
+            "data_path": [config.data_path],
+            "manifests_base": [config.manifests_base],
+            "copy dir": [target.path for target in config.cert_copy_targets],
+        }
+        for what, items in values.items():
+            for item in items:
+                if item in seen[what]:
+                    raise ValueError(
+                        "{} and {} have the same {} {}".format(seen[what][item], config.domain, what, item)
+                    )
+                seen[what][item] = config.domain
+    return configs
+
+
+async def provision(config: MWConfig) -> None:
+    """Do what init does for one deployment, certs are fetched concurrently with the manifests.
+    If one of them fails the others still run to the end before the first error is raised"""
+    await check_create_keypair(config)
+    results = await asyncio.gather(
+        create_rasenmaeher_manifest(config),
+        create_all_product_manifests(config),
+        get_certs(config),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def run_batch(configs: Sequence[MWConfig], workers: int = 4) -> List[BatchResult]:
+    """Provision the deployments, at most workers at a time. A failing deployment does not stop the others,
+    the results are in the same order as configs. Certbot runs are serialized (see helpers.certbot_lock)"""
+    limiter = asyncio.Semaphore(workers)
+
+    async def limited(config: MWConfig) -> BatchResult:
+        """Provision under the concurrency limit"""
+        async with limiter:
+            LOGGER.info("Provisioning {}".format(config.domain))
+            started = time.monotonic()
+            with measure("deployment:{}".format(config.domain)):
+                try:
+                    await provision(config)
+                except Exception as exc:  # pylint: disable=W0718
+                    LOGGER.exception("Provisioning {} failed".format(config.domain))
+                    return BatchResult(
+                        config.domain, time.monotonic() - started, "{}: {}".format(type(exc).__name__, exc)
+                    )
+            return BatchResult(config.domain, time.monotonic() - started)
+
+    return list(await asyncio.gather(*(limited(config) for config in configs)))
@@ -0,0 +1,22 @@
+"""Dispatch to the configured cert handling"""
+
+from typing import Optional
+import logging
+
+from .config import MWConfig
+from .lewrap import get_le_certs
+from .mkcwrap import get_mk_certs
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def get_certs(config: Optional[MWConfig] = None) -> None:
+    """Get certs with the configured method"""
+    if config is None:
+        config = MWConfig.singleton()
+    if config.extcert:
+        LOGGER.info("EXTernal certificate handling specified")
+    elif config.mkcert:
+        await get_mk_certs(config)
+    else:
+        await get_le_certs(config)
@@ -1,13 +1,49 @@
 """Configuration"""
 
 from __future__ import annotations
-from typing import ClassVar, Optional, List, Dict
+from typing import ClassVar, Optional, List, Dict, Any, Tuple, Mapping, Set, cast
 from pathlib import Path
 from enum import StrEnum
+from types import MappingProxyType
+import re
+import stat
 
-from pydantic import Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator, PrivateAttr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+LE_MAX_SANS = 100  # Let's Encrypt limit for names in one cert
+DNS_LABEL_RE = re.compile(r"^(?!-)[a-z0-9-]{1,63}(?<!-)$", re.IGNORECASE)
+
+
+def split_labels(value: str, what: str) -> Tuple[str, ...]:
+    """Split comma separated list, strip, drop empties and duplicates, check each is a valid DNS label"""
+    ret = tuple(dict.fromkeys(item.strip() for item in value.split(",") if item.strip()))
+    for label in ret:
+        if not DNS_LABEL_RE.match(label):
+            raise ValueError("Invalid {} name {!r}, must be a valid DNS label".format(what, label))
+    return ret
+
+
+class LEEngine(StrEnum):
+    """How to talk to Let's Encrypt"""
+
+    CERTBOT = "certbot"
+    ACME = "acme"
+
+
+class LocalCAEngine(StrEnum):
+    """How to issue certs in mkcert mode"""
+
+    MKCERT = "mkcert"
+    BUILTIN = "builtin"
+
+
+class ManifestFormat(StrEnum):
+    """How to format manifest JSON"""
+
+    COMPACT = "compact"
+    PRETTY = "pretty"
+
 
 class KeyType(StrEnum):
     """Valid key types for certbot/mkcert"""
@@ -16,6 +52,42 @@ class KeyType(StrEnum):
     ECDSA = "ecdsa"
 
 
+class CertSharding(StrEnum):
+    """How to split the names into Let's Encrypt certs (lineages)"""
+
+    AUTO = "auto"  # single cert unless there are too many names, then per product
+    SINGLE = "single"
+    PRODUCT = "product"
+
+
+class CopyMode(StrEnum):
+    """How certs_copy distributes the files"""
+
+    FILES = "files"
+    SYMLINK = "symlink"
+
+
+class CopyTarget(BaseModel):
+    """Directory to copy the certs to and the ownership/permissions to give the copies, plain model so that
+    unset fields do not get picked up from the environment (UID/GID are often exported in containers)"""
+
+    path: Path = Field(description="Directory to copy to")
+    file_mode: int = Field(default=stat.S_IRUSR | stat.S_IWUSR, description="Mode for the files, like 0o640")
+    dir_mode: int = Field(default=stat.S_IRWXU, description="Mode for the directory, like 0o750")
+    uid: Optional[int] = Field(default=None, description="Owner uid for directory and files, None to not change")
+    gid: Optional[int] = Field(default=None, description="Owner gid for directory and files, None to not change")
+
+    model_config = ConfigDict(extra="ignore")
+
+    @field_validator("file_mode", "dir_mode", mode="before")
+    @classmethod
+    def octal_string(cls, value: Any) -> Any:
+        """Allow giving modes as octal strings like "0640" """
+        if isinstance(value, str):
+            return int(value, 8)
+        return value
+
+
 class ProductSettings(BaseSettings):
     """Configs for each product"""
 
@@ -29,7 +101,7 @@ class ProductSettings(BaseSettings):
     model_config = SettingsConfigDict(extra="ignore")
 
 
-class MWConfig(BaseSettings):
+class MWConfig(BaseSettings):  # pylint: disable=R0904
     """Config for MiniWerk"""
 
     # Things you must or should define
@@ -66,8 +138,22 @@ class MWConfig(BaseSettings):
     )
 
     le_cert_name: str = Field(default="rasenmaeher", description="--cert-name for LE, used to determine directory name")
+    cert_sharding: CertSharding = Field(  # type: ignore[assignment]
+        default="auto",
+        description="single: one cert for all names, product: extra cert per product named le_cert_name-product, "
+        + f"auto: single unless there are more than {LE_MAX_SANS} names",
+    )
     # FIXME: how to cast the Fields to correct types
     le_copy_path: Path = Field(default="/le_certs", description="Where to copy letsencrypt certs and keys")  # type: ignore[assignment] # pylint: disable=C0301
+    certs_copy_mode: CopyMode = Field(  # type: ignore[assignment]
+        default="files",
+        description="files: replace changed files one by one atomically, "
+        + "symlink: le_copy_path/le_cert_name is a symlink swapped to a new directory when anything changes",
+    )
+    copy_targets: List[CopyTarget] = Field(
+        default_factory=list,
+        description="Extra places to copy certs to in addition to le_copy_path/le_cert_name (JSON list of objects)",
+    )
     data_path: Path = Field(default="/data/persistent", description="Where do we keep our data")  # type: ignore[assignment] # pylint: disable=C0301
     manifests_base: Path = Field(  # type: ignore[assignment]
         default="/pvarkishares", description="Path for manifests etc, each product gets a subdir"
@@ -75,10 +161,84 @@ class MWConfig(BaseSettings):
 
     extcert: bool = Field(default=False, description="Do not use certbot or mkcert, something else handles certs")
     mkcert: bool = Field(default=False, description="Use mkcert instead of certbot")
+    localca_engine: LocalCAEngine = Field(  # type: ignore[assignment]
+        default="mkcert",
+        description="mkcert: call the mkcert CLI, builtin: issue in-process with the mkcert CA "
+        + "(cert_sharding=product gives a cert per product)",
+    )
+    mkcert_caroot: Optional[Path] = Field(
+        default=None,
+        description="mkcert CA dir, default is CAROOT from env or what mkcert -CAROOT says "
+        + "(builtin engine: $XDG_DATA_HOME/mkcert)",
+    )
+    ca_public_path: Path = Field(default="/ca_public", description="Where to publish the mkcert CA cert")  # type: ignore[assignment] # pylint: disable=C0301
     ci: bool = Field(default=False, alias="CI", description="Are we running in CI")
     keytype: KeyType = Field(default="ecdsa", description="Which key types to use, rsa or ecdsa (default)")  # type: ignore[assignment] # pylint: disable=C0301
+    jwt_keytype: KeyType = Field(  # type: ignore[assignment]
+        default="rsa", description="JWT signing key type, use ecdsa only if all consumers accept ES256 tokens"
+    )
+    le_engine: LEEngine = Field(  # type: ignore[assignment]
+        default="certbot",
+        description="certbot: call the certbot CLI, acme: in-process ACME client (lineages are ordered concurrently)",
+    )
+    acme_directory: Optional[str] = Field(
+        default=None,
+        description="ACME directory URL for the acme engine, default is Let's Encrypt (staging if le_test)",
+    )
+    acme_http_port: int = Field(default=80, description="Port for the HTTP-01 responder of the acme engine")
+    acme_verify_ssl: bool = Field(default=True, description="Verify the TLS cert of the ACME directory")
+    certbot_timeout: float = Field(
+        default=300.0, description="Seconds to wait for certbot (or an acme engine order) before giving up"
+    )
+    mkcert_timeout: float = Field(default=60.0, description="Seconds to wait for mkcert before killing it")
+    lock_timeout: float = Field(
+        default=120.0,
+        description="Seconds to wait for a lock held by another miniwerk on the same data_path, "
+        + "the certbot lock is waited certbot_timeout longer",
+    )
+    cert_renew_before: int = Field(
+        default=3600 * 24 * 30,
+        description="Call certbot/mkcert only if the cert expires in less than this many seconds",
+    )
+    daemon_min_interval: int = Field(default=60, description="Minimum seconds between checks in daemon mode")
+    daemon_max_interval: int = Field(default=3600 * 6, description="Maximum seconds between checks in daemon mode")
+    serve_host: str = Field(
+        default="127.0.0.1",
+        description="Address for 'miniwerk serve' to listen on, anyone who can connect gets enrollment tokens",
+    )
+    serve_port: int = Field(default=8080, description="Port for 'miniwerk serve' to listen on")
+    daemon_jitter: float = Field(
+        default=0.1, ge=0.0, lt=1.0, description="Check up to this fraction earlier than needed in daemon mode"
+    )
+    manifest_concurrency: int = Field(default=4, ge=1, description="How many product manifests to create in parallel")
+    csr_jwt_lifetime: int = Field(default=3600 * 24, description="Lifetime of the csr_jwt enrollment tokens in seconds")
+    csr_jwt_renew_before: int = Field(
+        default=3600 * 4, description="Rewrite product manifests whose csr_jwt expires in less than this many seconds"
+    )
+    manifest_format: ManifestFormat = Field(  # type: ignore[assignment]
+        default="compact", description="compact: no whitespace, pretty: indented for humans"
+    )
+    report_path: Optional[Path] = Field(
+        default=None, description="Write a JSON report of stage timings and bytes written here after each run"
+    )
+    metrics_textfile: Optional[Path] = Field(
+        default=None, description="Write the run report as Prometheus metrics here (node_exporter textfile collector)"
+    )
     model_config = SettingsConfigDict(env_prefix="mw_", env_file=".env", extra="ignore", env_nested_delimiter="__")
     _singleton: ClassVar[Optional[MWConfig]] = None
+    _derived: Dict[str, Any] = PrivateAttr(default_factory=dict)
+
+    @model_validator(mode="after")
+    def precompute(self) -> MWConfig:
+        """Compute (and thus validate) the derived tables when the config is loaded"""
+        _ = self.fqdns, self.product_manifest_paths, self.cert_lineages
+        return self
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        """Forget the derived values when any field changes"""
+        if not name.startswith("_"):
+            self._derived.clear()
+        super().__setattr__(name, value)
 
     @classmethod
     def singleton(cls) -> MWConfig:
@@ -87,11 +247,60 @@ class MWConfig(BaseSettings):
             MWConfig._singleton = MWConfig()  # type: ignore[call-arg]
         return MWConfig._singleton
 
+    @classmethod
+    def reload(cls) -> MWConfig:
+        """Re-read the config (env and .env) and replace the singleton"""
+        MWConfig._singleton = MWConfig()  # type: ignore[call-arg]
+        return MWConfig._singleton
+
+    @property
+    def cert_copy_targets(self) -> List[CopyTarget]:
+        """The default copy target followed by the extra ones"""
+        return [CopyTarget(path=self.le_copy_path / self.le_cert_name)] + list(self.copy_targets)
+
+    def lineage_copy_targets(self, lineage: str) -> List[CopyTarget]:
+        """Copy targets for the lineage, extra lineages go to sibling dirs of the main targets with the
+        lineage suffix appended (le_copy_path/rasenmaeher -> le_copy_path/rasenmaeher-tak)"""
+        if lineage == self.le_cert_name:
+            return self.cert_copy_targets
+        suffix = lineage[len(self.le_cert_name) :]
+        return [
+            target.model_copy(update={"path": target.path.with_name(target.path.name + suffix)})
+            for target in self.cert_copy_targets
+        ]
+
+    def le_lineage_dir(self, lineage: str) -> Path:
+        """The "live" dir for given lineage, the acme engine has its own so that it never touches the
+        symlinks certbot keeps in its live dir"""
+        if self.le_engine == LEEngine.ACME:
+            return self.acme_path / "live" / lineage
+        return self.le_config_path / "live" / lineage
+
     @property
     def le_config_path(self) -> Path:
         """LE configuration dir"""
         return self.data_path / "le" / "conf"
 
+    @property
+    def acme_path(self) -> Path:
+        """Account key and registration of the acme engine"""
+        return self.data_path / "acme"
+
+    @property
+    def locks_path(self) -> Path:
+        """Advisory lock files shared by all miniwerks using this data_path"""
+        return self.data_path / "locks"
+
+    @property
+    def keypool_path(self) -> Path:
+        """Pregenerated JWT keypairs, subdir for each keytype"""
+        return self.data_path / "keypool"
+
+    @property
+    def manifests_state_path(self) -> Path:
+        """Input digests of the manifests we have written"""
+        return self.data_path / "manifests_state.json"
+
     @property
     def mkcert_path(self) -> Path:
         """mkcert certs dir"""
@@ -104,25 +313,68 @@ class MWConfig(BaseSettings):
 
     @property
     def le_cert_dir(self) -> Path:
-        """The "live" dir for the cert we have, remember the "file" here are symlinks"""
-        return self.le_config_path / "live" / self.le_cert_name
+        """The "live" dir for the cert we have, remember with certbot the "files" here are symlinks"""
+        return self.le_lineage_dir(self.le_cert_name)
 
     @property
     def mk_cert_dir(self) -> Path:
         """The "live" dir for the cert we have"""
         return self.mkcert_path / self.le_cert_name
 
+    def mk_lineage_dir(self, lineage: str) -> Path:
+        """The "live" dir for given local CA lineage"""
+        return self.mkcert_path / lineage
+
+    @property
+    def local_cert_lineages(self) -> Mapping[str, Tuple[str, ...]]:
+        """Names for each local CA cert, there is no SAN limit so single cert unless sharding is product"""
+        if self.localca_engine == LocalCAEngine.BUILTIN and self.cert_sharding == CertSharding.PRODUCT:
+            return self.cert_lineages
+        return MappingProxyType({self.le_cert_name: self.fqdns})
+
+    @property
+    def product_names(self) -> Tuple[str, ...]:
+        """Product names in configured order without duplicates"""
+        if "product_names" not in self._derived:
+            self._derived["product_names"] = split_labels(str(self.products), "product")
+        return cast(Tuple[str, ...], self._derived["product_names"])
+
+    @property
+    def fqdns(self) -> Tuple[str, ...]:
+        """Main domain and all subdomains and FQDNs, without duplicates"""
+        if "fqdns" not in self._derived:
+            subdomains = split_labels(str(self.subdomains), "subdomain")
+            ret = [f"{subd}.{self.domain}" for subd in subdomains]
+            for proddomain in [f"{prod}.{self.domain}" for prod in self.product_names + ("kc",)]:
+                ret.append(proddomain)
+                ret += [f"{subd}.{proddomain}" for subd in subdomains]
+            ret.append(self.domain)
+            self._derived["fqdns"] = tuple(dict.fromkeys(ret))
+        return cast(Tuple[str, ...], self._derived["fqdns"])
+
     @property
-    def fqdns(self) -> List[str]:
-        """Main domain and all subdomains and FQDNs"""
-        ret = [f"{subd.strip()}.{self.domain}" for subd in str(self.subdomains).split(",")]
-        for proddomain in [f"{prod.strip()}.{self.domain}" for prod in (str(self.products).split(",") + ["kc"])]:
-            ret.append(proddomain)
-            ret += [f"{subd.strip()}.{proddomain}" for subd in str(self.subdomains).split(",")]
-        ret.append(self.domain)
-        return ret
+    def cert_lineages(self) -> Mapping[str, Tuple[str, ...]]:
+        """Names for each Let's Encrypt cert keyed by cert-name, the main one (le_cert_name) is always first"""
+        if "cert_lineages" not in self._derived:
+            sharding = self.cert_sharding
+            if sharding == CertSharding.AUTO:
+                sharding = CertSharding.SINGLE if len(self.fqdns) <= LE_MAX_SANS else CertSharding.PRODUCT
+            lineages: Dict[str, Tuple[str, ...]] = {self.le_cert_name: self.fqdns}
+            if sharding == CertSharding.PRODUCT:
+                sharded: Set[str] = set()
+                for prod in self.product_names:
+                    names = tuple(fqdn for fqdn in self.fqdns if fqdn.endswith(f".{prod}.{self.domain}"))
+                    lineages[f"{self.le_cert_name}-{prod}"] = (f"{prod}.{self.domain}",) + names
+                    sharded.update(lineages[f"{self.le_cert_name}-{prod}"])
+                lineages[self.le_cert_name] = tuple(fqdn for fqdn in self.fqdns if fqdn not in sharded)
+            self._derived["cert_lineages"] = MappingProxyType(lineages)
+        return cast(Mapping[str, Tuple[str, ...]], self._derived["cert_lineages"])
 
     @property
-    def product_manifest_paths(self) -> Dict[str, Path]:
+    def product_manifest_paths(self) -> Mapping[str, Path]:
         """Paths for product manifests keyed by product"""
-        return {prod.strip(): self.manifests_base / prod.strip() for prod in str(self.products).split(",")}
+        if "product_manifest_paths" not in self._derived:
+            self._derived["product_manifest_paths"] = MappingProxyType(
+                {prod: self.manifests_base / prod for prod in self.product_names}
+            )
+        return cast(Mapping[str, Path], self._derived["product_manifest_paths"])
@@ -1,17 +1,19 @@
-"""CLI entrypoints for miniwerk"""
+"""CLI entrypoints for miniwerk
 
-from typing import Any
+The heavy stuff (pydantic, cryptography, multikeyjwt...) is imported inside the commands so that
+things like --version and health checks start fast, tests/test_console.py keeps an eye on this."""
+
+from typing import Any, IO, Optional, Tuple
 import logging
 import asyncio
+import time
 
 import click
 from libadvian.logging import init_logging
 
 from miniwerk import __version__
-from miniwerk.config import MWConfig
-from miniwerk.lewrap import get_le_certs
-from miniwerk.mkcwrap import get_mk_certs
-from miniwerk.manifests import create_rasenmaeher_manifest, create_all_product_manifests
+
+# pylint: disable=import-outside-toplevel
 
 LOGGER = logging.getLogger(__name__)
 
@@ -30,61 +32,287 @@ def cligrp(loglevel: int, verbose: int) -> None:
     LOGGER.setLevel(loglevel)
 
 
+def set_manifest_format(fmt: Optional[str]) -> None:
+    """Override manifest_format of the config if given on the command line"""
+    if fmt is None:
+        return
+    from miniwerk.config import MWConfig, ManifestFormat
+
+    MWConfig.singleton().manifest_format = ManifestFormat(fmt)
+
+
 @cligrp.command(name="config")
 def dump_config() -> None:
     """Show the resolved config as JSON"""
+    from miniwerk.config import MWConfig
+
     click.echo(MWConfig.singleton().model_dump_json())
 
 
+@cligrp.command(name="fqdns")
+@click.option("-l", "--lineages", is_flag=True, help="Prefix each name with the Let's Encrypt cert-name it goes to")
+@click.pass_context
+def show_fqdns(ctx: Any, lineages: bool) -> None:
+    """Show the names certs will be requested for, fails if there are too many for Let's Encrypt in one cert"""
+    from miniwerk.config import MWConfig, LE_MAX_SANS
+
+    config = MWConfig.singleton()
+    if config.mkcert or config.extcert:
+        for fqdn in config.fqdns:
+            click.echo(fqdn)
+        return
+    for lineage, fqdns in config.cert_lineages.items():
+        for fqdn in fqdns:
+            click.echo("{} {}".format(lineage, fqdn) if lineages else fqdn)
+        if len(fqdns) > LE_MAX_SANS:
+            click.echo(
+                "{}: {} names but Let's Encrypt allows at most {} per cert".format(lineage, len(fqdns), LE_MAX_SANS),
+                err=True,
+            )
+            ctx.exit(1)
+
+
 @cligrp.command(name="certs")
 @click.pass_context
 def do_certs(ctx: Any) -> None:
     """Get and/or renew certs based on configuration"""
+    from miniwerk.certs import get_certs
+    from miniwerk.stages import reported_run
 
     async def call() -> int:
         """Do the call"""
-        config = MWConfig.singleton()
-        if config.extcert:
-            LOGGER.info("EXTernal certificate handling specified")
-        elif config.mkcert:
-            await get_mk_certs()
-        else:
-            await get_le_certs()
+        with reported_run("certs"):
+            await get_certs()
         return 0
 
     ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
 
 
 @cligrp.command(name="manifests")
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["compact", "pretty"]),  # miniwerk.config.ManifestFormat values
+    default=None,
+    help="Manifest JSON format, default is manifest_format from config",
+)
 @click.pass_context
-def create_manifests(ctx: Any) -> None:
+def create_manifests(ctx: Any, fmt: Optional[str]) -> None:
     """Create manifests"""
+    from miniwerk.manifests import create_rasenmaeher_manifest, create_all_product_manifests
+    from miniwerk.stages import reported_run
+
+    set_manifest_format(fmt)
 
     async def call() -> int:
         """Do the call"""
-        await create_rasenmaeher_manifest()
-        await create_all_product_manifests()
+        with reported_run("manifests"):
+            await create_rasenmaeher_manifest()
+            await create_all_product_manifests()
         return 0
 
     ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
 
 
+@cligrp.command(name="verify")
+@click.option("-d", "--manifests-base", type=click.Path(file_okay=False), help="Default is manifests_base from config")
+@click.option(
+    "--renew-before",
+    type=int,
+    default=None,
+    help="Fail if a token expires within this many seconds, default from config",
+)
+@click.pass_context
+def verify_tokens(ctx: Any, manifests_base: Optional[str], renew_before: Optional[int]) -> None:
+    """Verify the csr_jwt of every product manifest, exits 1 if any is invalid or about to expire"""
+    from pathlib import Path
+    from miniwerk.config import MWConfig
+    from miniwerk.manifests import verify_manifests
+
+    async def call() -> int:
+        """Do the call"""
+        nonlocal renew_before
+        if renew_before is None:
+            renew_before = MWConfig.singleton().csr_jwt_renew_before
+        ret = 0
+        for status in await verify_manifests(Path(manifests_base) if manifests_base else None):
+            if not status.valid:
+                click.echo("{} INVALID {}".format(status.manifest_path, status.error))
+            else:
+                assert status.expires_in is not None  # valid tokens always have it, keep mypy happy
+                click.echo(
+                    "{} OK {} expires in {:.0f}s".format(status.manifest_path, status.subject, status.expires_in)
+                )
+            if status.needs_renewal(renew_before):
+                ret = 1
+        return ret
+
+    ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
+
+
 @cligrp.command(name="init")
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["compact", "pretty"]),  # miniwerk.config.ManifestFormat values
+    default=None,
+    help="Manifest JSON format, default is manifest_format from config",
+)
 @click.pass_context
-def do_full_init(ctx: Any) -> None:
+def do_full_init(ctx: Any, fmt: Optional[str]) -> None:
     """Create manifests, get certs, everything that is needed"""
+    from miniwerk.jwt import check_create_keypair
+    from miniwerk.certs import get_certs
+    from miniwerk.manifests import create_rasenmaeher_manifest, create_all_product_manifests
+    from miniwerk.stages import Stage, run_stages, log_stage_summary, reported_run
+
+    set_manifest_format(fmt)
+
+    async def call() -> int:
+        """Do the call, certs do not depend on the manifests so they are fetched concurrently"""
+        started = time.monotonic()
+        with reported_run("init"):
+            timings = await run_stages(
+                [
+                    Stage("keypair", check_create_keypair),
+                    Stage("rasenmaeher_manifest", create_rasenmaeher_manifest, ("keypair",)),
+                    Stage("product_manifests", create_all_product_manifests, ("keypair",)),
+                    Stage("certs", get_certs),
+                ]
+            )
+        log_stage_summary(timings, time.monotonic() - started)
+        return 0
+
+    ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
+
+
+@cligrp.command(name="batch")
+@click.argument("batchfile", type=click.Path(exists=True, dir_okay=False))
+@click.option("-j", "--workers", type=int, default=4, help="How many deployments to provision concurrently")
+@click.option(
+    "--report-path", type=click.Path(dir_okay=False), envvar="MW_REPORT_PATH", help="Write run report JSON here"
+)
+@click.option(
+    "--metrics-textfile",
+    type=click.Path(dir_okay=False),
+    envvar="MW_METRICS_TEXTFILE",
+    help="Write run metrics in Prometheus text format here",
+)
+@click.pass_context
+def do_batch(
+    ctx: Any, batchfile: str, workers: int, report_path: Optional[str], metrics_textfile: Optional[str]
+) -> None:
+    """Provision many deployments (JSON list of config objects) in one go, exits 1 if any failed
+
+    The deployments do not need the environment config so the report paths are options here"""
+    from pathlib import Path
+    from miniwerk.batch import load_deployments, run_batch
+    from miniwerk.stages import reported_to
+
+    async def call() -> int:
+        """Do the call"""
+        configs = load_deployments(Path(batchfile))
+        with reported_to(
+            "batch",
+            Path(report_path) if report_path else None,
+            Path(metrics_textfile) if metrics_textfile else None,
+        ):
+            results = await run_batch(configs, workers)
+        for result in results:
+            if result.error:
+                click.echo("{} FAILED {}".format(result.domain, result.error))
+            else:
+                click.echo("{} OK {:.2f}s".format(result.domain, result.duration))
+        return 1 if any(result.error for result in results) else 0
+
+    ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
+
+
+@cligrp.command(name="daemon")
+@click.pass_context
+def do_daemon(ctx: Any) -> None:
+    """Keep running and renew certs and manifests when they are about to expire, SIGHUP reloads config"""
+    from miniwerk.daemon import run_daemon
+
+    ctx.exit(asyncio.get_event_loop().run_until_complete(run_daemon()))
+
+
+@cligrp.command(name="serve")
+@click.option("--host", default=None, help="Address to listen on, default is serve_host from config")
+@click.option("-p", "--port", type=int, default=None, help="Port to listen on, default is serve_port from config")
+@click.pass_context
+def do_serve(ctx: Any, host: Optional[str], port: Optional[int]) -> None:
+    """Serve the manifests over HTTP with fresh csr_jwt per request, SIGHUP reloads config"""
+    from miniwerk.config import MWConfig
+    from miniwerk.server import run_server
+
+    config = MWConfig.singleton()
+    if host is not None:
+        config.serve_host = host
+    if port is not None:
+        config.serve_port = port
+    ctx.exit(asyncio.get_event_loop().run_until_complete(run_server(config)))
+
+
+@cligrp.command(name="tokens")
+@click.argument("subjects", nargs=-1)
+@click.option("-f", "--from-file", type=click.File("r"), help="Read subjects from file one per line, - for stdin")
+@click.option("-n", "--count", type=int, default=1, help="How many tokens to mint per subject")
+@click.option("--lifetime", type=int, default=None, help="Token lifetime in seconds, default is csr_jwt_lifetime")
+@click.option("--batch-size", type=int, default=100, help="How many tokens to sign per worker call")
+@click.option("-j", "--workers", type=int, default=None, help="Signing processes, default is CPU count")
+@click.pass_context
+def mint_tokens(  # pylint: disable=R0913,R0917
+    ctx: Any,
+    subjects: Tuple[str, ...],
+    from_file: Optional[IO[str]],
+    count: int,
+    lifetime: Optional[int],
+    batch_size: int,
+    workers: Optional[int],
+) -> None:
+    """Mint csr_jwt enrollment tokens for the subjects, output is JSON lines of sub and csr_jwt"""
+    import json
+    import itertools
+    from miniwerk.jwt import mint_csr_tokens
+
+    if not subjects and from_file is None:
+        raise click.UsageError("Give subjects as arguments or with --from-file")
+    lines = (line.strip() for line in from_file) if from_file is not None else iter(())
+    allsubjects = itertools.chain(subjects, (line for line in lines if line))
+
+    async def call() -> int:
+        """Do the call"""
+        async for subject, token in mint_csr_tokens(allsubjects, count, lifetime, batch_size, workers):
+            click.echo(json.dumps({"sub": subject, "csr_jwt": token}))
+        return 0
+
+    ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
+
+
+@cligrp.group(name="keys")
+def keys_grp() -> None:
+    """JWT keypair management"""
+
+
+@keys_grp.command(name="prefill")
+@click.option("-n", "--count", type=int, default=1, help="How many keypairs to pregenerate")
+@click.option(
+    "--keytype",
+    type=click.Choice(["rsa", "ecdsa"]),  # miniwerk.config.KeyType values, not imported here to keep startup fast
+    default=None,
+    help="Key type to generate, default is jwt_keytype from config",
+)
+@click.pass_context
+def keys_prefill(ctx: Any, count: int, keytype: Optional[str]) -> None:
+    """Pregenerate keypairs into the pool so that first boot does not need to wait for keygen"""
+    from miniwerk.config import KeyType
+    from miniwerk.jwt import prefill_keypool
 
     async def call() -> int:
         """Do the call"""
-        config = MWConfig.singleton()
-        await create_rasenmaeher_manifest()
-        await create_all_product_manifests()
-        if config.extcert:
-            LOGGER.info("EXTernal certificate handling specified")
-        elif config.mkcert:
-            await get_mk_certs()
-        else:
-            await get_le_certs()
+        for keypath in await prefill_keypool(count, KeyType(keytype) if keytype else None):
+            click.echo(keypath)
         return 0
 
     ctx.exit(asyncio.get_event_loop().run_until_complete(call()))
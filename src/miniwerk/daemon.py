@@ -0,0 +1,118 @@
+"""Long-running mode that keeps certs and manifests fresh"""
+
+from typing import Optional, List
+import asyncio
+import logging
+import random
+import signal
+from pathlib import Path
+
+from .config import MWConfig
+from .certs import get_certs
+from .helpers import cert_expires_in
+from .manifests import create_rasenmaeher_manifest, create_all_product_manifests, manifest_token_expires_in
+from .stages import reported_run
+
+LOGGER = logging.getLogger(__name__)
+
+
+def active_cert_paths(config: MWConfig) -> List[Path]:
+    """The certs we are responsible for renewing, empty if certs are handled externally"""
+    if config.extcert:
+        return []
+    if config.mkcert:
+        return [config.mk_lineage_dir(lineage) / "fullchain.pem" for lineage in config.local_cert_lineages.keys()]
+    return [config.le_lineage_dir(lineage) / "fullchain.pem" for lineage in config.cert_lineages.keys()]
+
+
+def due_in(config: MWConfig) -> float:
+    """Seconds until the first cert or manifest token is due for renewal (negative if overdue),
+    at most daemon_max_interval"""
+    candidates: List[float] = [float(config.daemon_max_interval)]
+    for certpath in active_cert_paths(config):
+        expires_in = cert_expires_in(certpath)
+        if expires_in is not None:
+            candidates.append(expires_in - config.cert_renew_before)
+    for manifest_dir in config.product_manifest_paths.values():
+        expires_in = manifest_token_expires_in(manifest_dir / "kraftwerk-init.json")
+        if expires_in is not None:
+            candidates.append(expires_in - config.csr_jwt_renew_before)
+    return min(candidates)
+
+
+def next_check_delay(config: MWConfig) -> float:
+    """Seconds until the cert or a manifest token is due for renewal, clamped to the configured interval
+    and jittered a bit earlier so that a fleet does not hit the CA at the same time"""
+    delay = max(due_in(config), float(config.daemon_min_interval))
+    return delay * (1.0 - config.daemon_jitter * random.random())  # nosec  # not for crypto
+
+
+def backoff_delay(config: MWConfig, failures: int) -> float:
+    """daemon_min_interval doubled for each consecutive failure after the first, capped at daemon_max_interval"""
+    return float(min(config.daemon_min_interval * 2 ** min(failures - 1, 32), config.daemon_max_interval))
+
+
+async def refresh() -> None:
+    """Renew whatever needs renewing"""
+    with reported_run("daemon"):
+        await create_rasenmaeher_manifest()
+        await create_all_product_manifests()
+        await get_certs()
+
+
+async def run_daemon(max_runs: Optional[int] = None) -> int:
+    """Run refresh and sleep until something is due, SIGHUP reloads config and checks immediately,
+    SIGTERM/SIGINT stop. max_runs is mainly for testing"""
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    stop = asyncio.Event()
+
+    def reload() -> None:
+        """Handle SIGHUP"""
+        LOGGER.info("Got SIGHUP, reloading config")
+        try:
+            MWConfig.reload()
+        except ValueError as exc:
+            LOGGER.error("Config reload failed, keeping the old one: {}".format(exc))
+        wakeup.set()
+
+    def shutdown() -> None:
+        """Handle SIGTERM/SIGINT"""
+        LOGGER.info("Stopping")
+        stop.set()
+
+    loop.add_signal_handler(signal.SIGHUP, reload)
+    loop.add_signal_handler(signal.SIGTERM, shutdown)
+    loop.add_signal_handler(signal.SIGINT, shutdown)
+    runs = 0
+    failures = 0
+    try:
+        while not stop.is_set():
+            wakeup.clear()
+            config = MWConfig.singleton()
+            try:
+                await refresh()
+                if due_in(config) > 0:
+                    failures = 0
+                    delay = next_check_delay(config)
+                else:
+                    # Refreshed fine but something is still due, retrying right away would just loop
+                    failures += 1
+                    delay = backoff_delay(config, failures)
+                    LOGGER.warning("Still due for renewal after refresh, check cert_renew_before/csr_jwt_renew_before")
+            except Exception as exc:  # pylint: disable=W0718  # keep running and retry
+                failures += 1
+                delay = backoff_delay(config, failures)
+                LOGGER.exception("Refresh failed ({} in a row): {}".format(failures, exc))
+            runs += 1
+            if max_runs is not None and runs >= max_runs:
+                break
+            LOGGER.info("Next check in {:.0f}s".format(delay))
+            waiters = [asyncio.create_task(wakeup.wait()), asyncio.create_task(stop.wait())]
+            _, pending = await asyncio.wait(waiters, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+    finally:
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+    return 0
@@ -1,53 +1,342 @@
 """Helpers"""
 
+from typing import AsyncIterator, Sequence, Optional, Dict, List, Mapping
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import datetime
+import fcntl
+import hashlib
 import logging
 import asyncio
+import os
+import shlex
+import shutil
+import signal
+import time
+import uuid
+import weakref
 from pathlib import Path
-import subprocess  # nosec
 
+from cryptography import x509
 
-from .jwt import PRIVDIR_MODE
+from .config import CopyMode, CopyTarget, LocalCAEngine, MWConfig
+from .report import add_bytes_written, add_subprocess, in_context, measure
 
 LOGGER = logging.getLogger(__name__)
+# What "mkcert -CAROOT" said, it does not change while we run
+CAROOT_CACHE: Dict[str, Path] = {}
+CERTBOT_LOCKS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
 
 
-def certs_copy(copydir: Path, sourcedir: Path) -> None:
-    """Copy certs"""
-    copydir.mkdir(parents=True, exist_ok=True)
-    copydir.chmod(PRIVDIR_MODE)
-    for fpth in sourcedir.iterdir():
+def set_owner_mode(pth: Path, mode: Optional[int] = None, uid: Optional[int] = None, gid: Optional[int] = None) -> None:
+    """chown and chmod if given, None means leave as is"""
+    if uid is not None or gid is not None:
+        os.chown(pth, -1 if uid is None else uid, -1 if gid is None else gid)
+    if mode is not None:
+        pth.chmod(mode)
+
+
+def fsync_dir(dirpth: Path) -> None:
+    """fsync the directory so that a rename in it survives a crash"""
+    dirfd = os.open(dirpth, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def write_if_changed(  # pylint: disable=R0913,R0917
+    tgtpth: Path,
+    data: bytes,
+    mode: Optional[int] = None,
+    uid: Optional[int] = None,
+    gid: Optional[int] = None,
+    fsync: bool = False,
+) -> bool:
+    """Write data via temp file and os.replace so readers never see a partial file, skipped if the file
+    already has the same content. Owner and mode are set before the file appears. With fsync the data and
+    the rename are flushed to disk before returning. Returns True if the file was written"""
+    try:
+        if tgtpth.stat().st_size == len(data) and tgtpth.read_bytes() == data:
+            LOGGER.debug("{} is unchanged".format(tgtpth))
+            set_owner_mode(tgtpth, mode, uid, gid)
+            return False
+    except FileNotFoundError:
+        pass
+    tmppth = tgtpth.with_name(f".{tgtpth.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with tmppth.open("wb") as fpntr:
+            fpntr.write(data)
+            if fsync:
+                fpntr.flush()
+                os.fsync(fpntr.fileno())
+        set_owner_mode(tmppth, mode, uid, gid)
+        os.replace(tmppth, tgtpth)
+        if fsync:
+            fsync_dir(tgtpth.parent)
+    finally:
+        tmppth.unlink(missing_ok=True)
+    add_bytes_written(len(data))
+    LOGGER.info("Wrote {}".format(tgtpth))
+    return True
+
+
+def certbot_lock() -> asyncio.Lock:
+    """Certbot standalone binds port 80 and locks its config dir, so even for different deployments
+    only one can run at a time, other processes are kept out with the file lock on certbot.lock"""
+    loop = asyncio.get_running_loop()
+    if loop not in CERTBOT_LOCKS:
+        CERTBOT_LOCKS[loop] = asyncio.Lock()
+    return CERTBOT_LOCKS[loop]
+
+
+@asynccontextmanager
+async def file_lock(lockpath: Path, timeout: float) -> AsyncIterator[None]:
+    """Exclusive advisory lock (flock) on lockpath, raises TimeoutError if not acquired in timeout seconds.
+
+    Each holder opens the file itself so this excludes other tasks of this process as well as other processes,
+    the lock is released by the kernel if the holder dies"""
+    lockpath.parent.mkdir(parents=True, exist_ok=True)
+    fdesc = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            try:
+                fcntl.flock(fdesc, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError("Could not lock {} in {}s".format(lockpath, timeout)) from None
+                if delay == 0.01:
+                    LOGGER.info("Waiting for lock {}".format(lockpath))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        yield
+    finally:
+        os.close(fdesc)
+
+
+def read_pems(sourcedir: Path) -> Dict[str, bytes]:
+    """Read the .pem files from sourcedir (resolving symlinks), keyed by name"""
+    ret: Dict[str, bytes] = {}
+    for fpth in sorted(sourcedir.iterdir()):
         if not fpth.name.endswith(".pem"):
             LOGGER.debug("Skipping {}".format(fpth))
             continue
         absfpth = fpth.resolve(strict=True)
         LOGGER.debug("{} resolved to {}".format(fpth, absfpth))
-        tgtpth = copydir / fpth.name
-        tgtpth.write_bytes(absfpth.read_bytes())
-        LOGGER.info("Wrote {}".format(tgtpth))
+        ret[fpth.name] = absfpth.read_bytes()
+    return ret
+
+
+def swap_copy(target: CopyTarget, files: Dict[str, bytes]) -> bool:
+    """Write the files to a new versioned dir and atomically point the copydir symlink to it, the previous
+    version is kept around for readers that are still using it. Returns True if the symlink was changed"""
+    copydir = target.path
+    hasher = hashlib.sha256()
+    for name, data in sorted(files.items()):
+        hasher.update(name.encode("utf-8") + b"\0" + hashlib.sha256(data).digest())
+    versiondir = copydir.parent / f".{copydir.name}.{hasher.hexdigest()[:16]}"
+    previous = os.readlink(copydir) if copydir.is_symlink() else None
+    if previous == versiondir.name and versiondir.is_dir():
+        LOGGER.debug("{} is unchanged".format(copydir))
+        return False
+    versiondir.mkdir(parents=True, exist_ok=True)
+    set_owner_mode(versiondir, target.dir_mode, target.uid, target.gid)
+    for name, data in files.items():
+        write_if_changed(versiondir / name, data, target.file_mode, target.uid, target.gid)
+    tmplink = copydir.with_name(f".{copydir.name}.{uuid.uuid4().hex}.lnk")
+    os.symlink(versiondir.name, tmplink)  # relative so it works from any mount point
+    os.replace(tmplink, copydir)
+    LOGGER.info("Pointed {} to {}".format(copydir, versiondir))
+    for olddir in copydir.parent.glob(f".{copydir.name}.*"):
+        if olddir.name in (versiondir.name, previous) or not olddir.is_dir():
+            continue
+        LOGGER.debug("Removing old version {}".format(olddir))
+        shutil.rmtree(olddir)
+    return True
+
+
+def copy_files(target: CopyTarget, files: Dict[str, bytes], mode: CopyMode = CopyMode.FILES) -> bool:
+    """Write the files to the target, only changed files are written and never in place,
+    returns True if anything changed"""
+    copydir = target.path
+    copydir.parent.mkdir(parents=True, exist_ok=True)
+    if mode == CopyMode.SYMLINK:
+        if copydir.is_symlink() or not copydir.exists():
+            return swap_copy(target, files)
+        LOGGER.warning("{} is a real directory, can't swap it, copying files instead".format(copydir))
+    copydir.mkdir(parents=True, exist_ok=True)
+    set_owner_mode(copydir, target.dir_mode, target.uid, target.gid)
+    changed = False
+    for name, data in files.items():
+        changed = write_if_changed(copydir / name, data, target.file_mode, target.uid, target.gid) or changed
+    return changed
+
+
+def certs_copy(copydir: Path, sourcedir: Path, mode: CopyMode = CopyMode.FILES) -> bool:
+    """Copy certs, returns True if anything changed"""
+    return copy_files(CopyTarget(path=copydir), read_pems(sourcedir), mode)
 
 
-async def call_cmd(cmd: str) -> int:
-    """Do the boilerplate for calling cmd and reporting output/return code"""
-    LOGGER.debug("Calling create_subprocess_shell(({})".format(cmd))
-    process = await asyncio.create_subprocess_shell(
-        cmd,
+async def certs_copy_targets(sourcedir: Path, targets: Sequence[CopyTarget], mode: CopyMode = CopyMode.FILES) -> bool:
+    """Read the certs once and write them to all the targets concurrently, returns True if anything changed"""
+    loop = asyncio.get_event_loop()
+    with measure("certs_copy:{}".format(sourcedir.name)):
+        files = await loop.run_in_executor(None, read_pems, sourcedir)
+        results = await asyncio.gather(
+            *(loop.run_in_executor(None, in_context(copy_files, target, files, mode)) for target in targets)
+        )
+    return any(results)
+
+
+@dataclass
+class CmdResult:
+    """What happened when we ran a command"""
+
+    args: List[str]
+    returncode: int
+    duration: float
+    timed_out: bool = False
+
+
+async def log_stream(stream: Optional[asyncio.StreamReader], prefix: str, level: int) -> None:
+    """Log lines from the stream as they arrive"""
+    if stream is None:
+        return
+    async for line in stream:
+        LOGGER.log(level, "{}: {}".format(prefix, line.decode("utf-8", errors="replace").rstrip()))
+
+
+async def kill_process_group(process: "asyncio.subprocess.Process", grace: float = 5.0) -> None:
+    """SIGTERM the whole process group, SIGKILL if it does not go away in grace seconds"""
+    for sig in (signal.Signals.SIGTERM, signal.Signals.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(process.wait(), timeout=grace)
+            return
+        except TimeoutError:
+            LOGGER.warning("Process group {} did not exit on {}".format(process.pid, sig.name))
+
+
+async def run_cmd(args: Sequence[str], timeout: float = 60.0, env: Optional[Mapping[str, str]] = None) -> CmdResult:
+    """Run the command (no shell), stdout is logged as INFO and stderr as WARNING line by line as it comes.
+    On timeout the whole process tree is killed. env is added to our environment"""
+    args = [str(arg) for arg in args]
+    prefix = Path(args[0]).name
+    LOGGER.debug("Calling create_subprocess_exec({})".format(args))
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, **env} if env else None,
+        start_new_session=True,  # own process group so we can kill everything it spawned
     )
-    out, err = await asyncio.wait_for(process.communicate(), timeout=60)
-    if err:
-        LOGGER.warning(err)
-    LOGGER.info(out)
+    timed_out = False
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                log_stream(process.stdout, prefix, logging.INFO),
+                log_stream(process.stderr, prefix, logging.WARNING),
+                process.wait(),
+            ),
+            timeout=timeout,
+        )
+    except TimeoutError:
+        LOGGER.error("{} did not finish in {}s, killing it".format(shlex.join(args), timeout))
+        timed_out = True
+        await kill_process_group(process)
     assert isinstance(process.returncode, int)  # at this point it is, keep mypy happy
-    if process.returncode != 0:
-        LOGGER.error("{} returned nonzero code: {} (process: {})".format(cmd, process.returncode, process))
-        LOGGER.error(err)
-        LOGGER.error(out)
+    result = CmdResult(
+        args=args, returncode=process.returncode, duration=time.monotonic() - started, timed_out=timed_out
+    )
+    add_subprocess(prefix, result.duration, result.returncode)
+    if result.returncode != 0:
+        LOGGER.error(
+            "{} returned nonzero code: {} (took {:.2f}s)".format(shlex.join(args), result.returncode, result.duration)
+        )
+    else:
+        LOGGER.info("{} finished in {:.2f}s".format(prefix, result.duration))
+    return result
 
-    return process.returncode
 
+async def call_cmd(cmd: str, timeout: float = 60.0) -> int:
+    """Split the command line and run it, returns the exit code"""
+    return (await run_cmd(shlex.split(cmd), timeout)).returncode
 
-def mkcert_ca_cert() -> Path:
+
+async def mkcert_caroot(config: Optional[MWConfig] = None) -> Path:
+    """mkcert CA directory: mkcert_caroot from config, CAROOT from env or what "mkcert -CAROOT" says,
+    mkcert is asked only once per process. The builtin engine does not need the binary and uses
+    the mkcert default for Linux ($XDG_DATA_HOME/mkcert) instead"""
+    if config is None:
+        config = MWConfig.singleton()
+    if config.mkcert_caroot:
+        return config.mkcert_caroot
+    if os.environ.get("CAROOT"):
+        return Path(os.environ["CAROOT"])
+    if config.localca_engine == LocalCAEngine.BUILTIN:
+        return Path(os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share") / "mkcert"
+    if "mkcert" not in CAROOT_CACHE:
+        process = await asyncio.create_subprocess_exec(
+            "mkcert", "-CAROOT", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await asyncio.wait_for(process.communicate(), config.mkcert_timeout)
+        if process.returncode != 0:
+            raise RuntimeError("mkcert -CAROOT failed: {}".format(stderr.decode("utf-8", errors="replace")))
+        CAROOT_CACHE["mkcert"] = Path(stdout.decode("utf-8").strip())
+        LOGGER.debug("mkcert CAROOT is {}".format(CAROOT_CACHE["mkcert"]))
+    return CAROOT_CACHE["mkcert"]
+
+
+async def mkcert_ca_cert(config: Optional[MWConfig] = None) -> Path:
     """get mkcert root CA cert"""
-    caroot = Path(subprocess.check_output("mkcert -CAROOT", shell=True).decode("utf-8").strip())  # nosec
-    return caroot / "rootCA.pem"
+    return (await mkcert_caroot(config)) / "rootCA.pem"
+
+
+def load_cert(certpath: Path) -> Optional[x509.Certificate]:
+    """Load the first cert from the PEM file, None if it does not exist or can't be parsed"""
+    if not certpath.exists():
+        LOGGER.debug("{} does not exist".format(certpath))
+        return None
+    try:
+        return x509.load_pem_x509_certificate(certpath.read_bytes())
+    except ValueError as exc:
+        LOGGER.warning("Could not parse {}: {}".format(certpath, exc))
+        return None
+
+
+def cert_expires_in(certpath: Path) -> Optional[float]:
+    """Seconds until the cert expires, None if there is no (valid) cert"""
+    cert = load_cert(certpath)
+    if cert is None:
+        return None
+    return (cert.not_valid_after_utc - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+
+def cert_needs_renewal(certpath: Path, fqdns: Sequence[str], renew_before: int) -> bool:
+    """Check if the cert is missing, expires within renew_before seconds or does not cover exactly the fqdns"""
+    cert = load_cert(certpath)
+    if cert is None:
+        return True
+    try:
+        sans = set(
+            cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName)
+        )
+    except x509.ExtensionNotFound as exc:
+        LOGGER.warning("No SANs in {}: {}".format(certpath, exc))
+        return True
+    expires_in = cert.not_valid_after_utc - datetime.datetime.now(datetime.timezone.utc)
+    if expires_in.total_seconds() < renew_before:
+        LOGGER.info("{} expires at {}, renewal needed".format(certpath, cert.not_valid_after_utc))
+        return True
+    if sans != set(fqdns):
+        LOGGER.info("{} names differ, missing: {}, extra: {}".format(certpath, set(fqdns) - sans, sans - set(fqdns)))
+        return True
+    LOGGER.info("{} is valid until {} and has all the names".format(certpath, cert.not_valid_after_utc))
+    return False
@@ -1,25 +1,241 @@
 """JWT wrappers"""
 
-from typing import Tuple
+from typing import Tuple, Dict, Any, List, Optional, Iterable, Iterator, AsyncIterator, Deque
 import asyncio
+import base64
+import collections
+import concurrent.futures
+import copy
+import dataclasses
+import hashlib
+import json
 import logging
+import os
 from pathlib import Path
 import stat
+import uuid
 
 
-from multikeyjwt.keygen import generate_keypair
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+from libadvian.binpackers import uuid_to_b64
 from multikeyjwt import Issuer, Verifier
 
-from .config import MWConfig
+from .config import MWConfig, KeyType
+from .helpers import file_lock, write_if_changed
+from .report import add_bytes_written, in_context, measure
 
 LOGGER = logging.getLogger(__name__)
 PUBDIR_MODE = stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH | stat.S_IXGRP | stat.S_IXOTH
 PRIVDIR_MODE = stat.S_IRWXU
+# Loaded key material keyed by path, value is (file signature, loaded object), issuers also keep the algorithm
+ISSUER_CACHE: Dict[Path, Tuple[Any, Issuer, str]] = {}
+VERIFIER_CACHE: Dict[Path, Tuple[Any, Verifier]] = {}
+JWKS_CACHE: Dict[Path, Tuple[Any, bytes]] = {}
 
 
-async def check_create_keypair() -> Tuple[Path, Path]:
-    """Check if we have keypair, if not create it, returns the file paths"""
-    config = MWConfig.singleton()
+def file_signature(pth: Path) -> Tuple[int, int, int, int]:
+    """Inode, device, mtime and size, if any of these change we consider the file changed"""
+    stt = pth.stat()
+    return stt.st_ino, stt.st_dev, stt.st_mtime_ns, stt.st_size
+
+
+def pubdir_signature(pubdir: Path) -> Tuple[Tuple[str, Tuple[int, int, int, int]], ...]:
+    """Signatures of all the public keys the Verifier would load from the directory"""
+    return tuple(
+        sorted(
+            (fpth.name, file_signature(fpth)) for fpth in pubdir.iterdir() if fpth.is_file() and fpth.suffix == ".pub"
+        )
+    )
+
+
+def clear_key_cache() -> None:
+    """Forget all loaded key material"""
+    ISSUER_CACHE.clear()
+    VERIFIER_CACHE.clear()
+    JWKS_CACHE.clear()
+
+
+def key_algorithm(key: Any) -> str:
+    """JWT algorithm for the key, the same choice multikeyjwt>=1.7 makes by itself"""
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        return "ES256"
+    return "RS256"
+
+
+def load_issuer(privkeypath: Path) -> Issuer:
+    """Get Issuer for the key, the PEM is parsed again only if the file has changed.
+
+    Returns a shallow copy with its own config so callers can change lifetime etc without affecting others"""
+    signature = file_signature(privkeypath)
+    cached = ISSUER_CACHE.get(privkeypath)
+    if cached is None or cached[0] != signature:
+        LOGGER.debug("Loading private key {}".format(privkeypath))
+        algorithm = key_algorithm(serialization.load_pem_private_key(privkeypath.read_bytes(), password=None))
+        cached = (signature, Issuer(privkeypath=privkeypath, keypasswd=None), algorithm)
+        ISSUER_CACHE[privkeypath] = cached
+    issuer = copy.copy(cached[1])
+    issuer.config = dataclasses.replace(cached[1].config)
+    # multikeyjwt<1.7 signs with config.algorithm (default RS256) whatever the key is
+    setattr(issuer.config, "algorithm", cached[2])
+    return issuer
+
+
+def load_verifier(pubkeypath: Path) -> Verifier:
+    """Get Verifier for the public keys directory, keys are parsed again only if the files have changed"""
+    signature = pubdir_signature(pubkeypath)
+    cached = VERIFIER_CACHE.get(pubkeypath)
+    if cached is None or cached[0] != signature:
+        LOGGER.debug("Loading public keys from {}".format(pubkeypath))
+        verifier = Verifier(pubkeypath=pubkeypath)
+        # multikeyjwt<1.7 verifies only with config.algorithm (default RS256), newer ones pick per key
+        algorithms = {key_algorithm(pubkey) for pubkey in verifier.pubkeys}
+        if len(algorithms) == 1:
+            setattr(verifier.config, "algorithm", algorithms.pop())
+        elif algorithms:
+            LOGGER.warning("{} has both RSA and EC keys, multikeyjwt<1.7 can only verify RSA".format(pubkeypath))
+        cached = (signature, verifier)
+        VERIFIER_CACHE[pubkeypath] = cached
+    return cached[1]
+
+
+def b64url_uint(value: int, length: Optional[int] = None) -> str:
+    """Unsigned big-endian integer in base64url without padding"""
+    if length is None:
+        length = max(1, (value.bit_length() + 7) // 8)
+    return base64.urlsafe_b64encode(value.to_bytes(length, "big")).rstrip(b"=").decode("ascii")
+
+
+def jwk_thumbprint(jwk: Dict[str, str]) -> str:
+    """RFC 7638 SHA-256 thumbprint of the required members"""
+    required = ("crv", "kty", "x", "y") if jwk["kty"] == "EC" else ("e", "kty", "n")
+    canonical = json.dumps({name: jwk[name] for name in required}, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(hashlib.sha256(canonical.encode("utf-8")).digest()).rstrip(b"=").decode("ascii")
+
+
+def public_jwk(pubkey: rsa.RSAPublicKey | ec.EllipticCurvePublicKey) -> Dict[str, str]:
+    """JWK of the public key with the thumbprint as kid, alg is what multikeyjwt signs with"""
+    jwk: Dict[str, str]
+    if isinstance(pubkey, rsa.RSAPublicKey):
+        numbers = pubkey.public_numbers()
+        jwk = {"kty": "RSA", "alg": "RS256", "n": b64url_uint(numbers.n), "e": b64url_uint(numbers.e)}
+    else:
+        if not isinstance(pubkey.curve, ec.SECP256R1):
+            raise ValueError("Only P-256 EC keys are supported, not {}".format(pubkey.curve.name))
+        ecnumbers = pubkey.public_numbers()
+        jwk = {
+            "kty": "EC",
+            "alg": "ES256",
+            "crv": "P-256",
+            "x": b64url_uint(ecnumbers.x, 32),
+            "y": b64url_uint(ecnumbers.y, 32),
+        }
+    jwk["use"] = "sig"
+    jwk["kid"] = jwk_thumbprint(jwk)
+    return jwk
+
+
+def load_jwks(pubdir: Path) -> bytes:
+    """JWKS JSON of all the public keys the Verifier would load from the directory, built again only if
+    the keys have changed. Every key in the dir is active so the old and new key can overlap during rotation"""
+    signature = pubdir_signature(pubdir)
+    cached = JWKS_CACHE.get(pubdir)
+    if cached is None or cached[0] != signature:
+        LOGGER.debug("Building JWKS from {}".format(pubdir))
+        keys: Dict[str, Dict[str, str]] = {}
+        for name, _ in signature:
+            pubkey = serialization.load_pem_public_key((pubdir / name).read_bytes())
+            if not isinstance(pubkey, (rsa.RSAPublicKey, ec.EllipticCurvePublicKey)):
+                LOGGER.warning("{} is not RSA or EC key, skipping".format(pubdir / name))
+                continue
+            jwk = public_jwk(pubkey)
+            keys[jwk["kid"]] = jwk
+        cached = (signature, json.dumps({"keys": list(keys.values())}, separators=(",", ":")).encode("utf-8"))
+        JWKS_CACHE[pubdir] = cached
+    return cached[1]
+
+
+def generate_jwt_keypair(privkeypath: Path, keytype: KeyType = KeyType.RSA) -> Tuple[Path, Path]:
+    """Generate keypair for signing JWTs, public key goes next to the private one with .pub suffix,
+    returns paths of .key and .pub"""
+    ckp: rsa.RSAPrivateKey | ec.EllipticCurvePrivateKey
+    if keytype == KeyType.ECDSA:
+        ckp = ec.generate_private_key(ec.SECP256R1())
+    else:
+        ckp = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    written = privkeypath.write_bytes(
+        ckp.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+    )
+    pubkeypath = privkeypath.with_suffix(".pub")
+    written += pubkeypath.write_bytes(
+        ckp.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    )
+    add_bytes_written(written)
+    return privkeypath, pubkeypath
+
+
+def pool_keypair(pooldir: Path, keytype: KeyType) -> Path:
+    """Generate a keypair into the pool dir, the .key file appears (atomically) only after the .pub is ready"""
+    tmppath = pooldir / f"{uuid.uuid4()}.tmp"
+    _, pubkeypath = generate_jwt_keypair(tmppath, keytype)
+    privkeypath = pubkeypath.with_suffix(".key")
+    tmppath.rename(privkeypath)
+    return privkeypath
+
+
+def claim_pooled_keypair(pooldir: Path, privkeypath: Path, pubkeypath: Path) -> bool:
+    """Move a pregenerated keypair from the pool to given paths, returns False if the pool is empty"""
+    if not pooldir.is_dir():
+        return False
+    for candidate in sorted(pooldir.glob("*.key")):
+        claimed = candidate.with_suffix(f".claimed{os.getpid()}")
+        try:
+            candidate.rename(claimed)
+        except FileNotFoundError:
+            LOGGER.debug("{} was claimed by someone else".format(candidate))
+            continue
+        pubcandidate = candidate.with_suffix(".pub")
+        write_if_changed(pubkeypath, pubcandidate.read_bytes(), mode=0o644)
+        pubcandidate.unlink()
+        claimed.replace(privkeypath)
+        LOGGER.info("Claimed pregenerated keypair {}".format(candidate))
+        return True
+    return False
+
+
+async def prefill_keypool(
+    count: int, keytype: Optional[KeyType] = None, config: Optional[MWConfig] = None
+) -> List[Path]:
+    """Pregenerate count keypairs into the pool in parallel, returns paths to the private keys"""
+    if config is None:
+        config = MWConfig.singleton()
+    if keytype is None:
+        keytype = config.jwt_keytype
+    pooldir = config.keypool_path / keytype.value
+    pooldir.mkdir(parents=True, exist_ok=True)
+    pooldir.chmod(PRIVDIR_MODE)
+    loop = asyncio.get_event_loop()
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        return list(
+            await asyncio.gather(
+                *(loop.run_in_executor(executor, pool_keypair, pooldir, keytype) for _ in range(count))
+            )
+        )
+
+
+async def check_create_keypair(config: Optional[MWConfig] = None) -> Tuple[Path, Path]:
+    """Check if we have keypair, if not create it, returns the file paths
+
+    Creation is done under a file lock, whoever waited for it uses the keypair the holder created"""
+    if config is None:
+        config = MWConfig.singleton()
     privkeypath = config.data_path / "private" / "jwt.key"
     privdir = privkeypath.parent
     privdir.mkdir(parents=True, exist_ok=True)
@@ -32,21 +248,91 @@ async def check_create_keypair() -> Tuple[Path, Path]:
     if privkeypath.exists() and pubkeypath.exists():
         return privkeypath, pubkeypath
 
-    LOGGER.info("Generating keypair, this will take a moment")
-    _, cpk = await asyncio.get_event_loop().run_in_executor(None, generate_keypair, privkeypath, None)
-    pubkeypath.write_bytes(cpk.read_bytes())
-    LOGGER.info("Wrote {}".format(pubkeypath))
+    async with file_lock(config.locks_path / "jwt_keypair.lock", config.lock_timeout):
+        if privkeypath.exists() and pubkeypath.exists():
+            LOGGER.info("Keypair was created while we waited for the lock")
+            return privkeypath, pubkeypath
+
+        if claim_pooled_keypair(config.keypool_path / config.jwt_keytype.value, privkeypath, pubkeypath):
+            return privkeypath, pubkeypath
+
+        LOGGER.info("Generating keypair, this will take a moment")
+        with measure("keygen"):
+            _, cpk = await asyncio.get_event_loop().run_in_executor(
+                None, in_context(generate_jwt_keypair, privkeypath, config.jwt_keytype)
+            )
+            write_if_changed(pubkeypath, cpk.read_bytes(), mode=0o644)
 
     return privkeypath, pubkeypath
 
 
-async def get_issuer() -> Issuer:
+async def get_issuer(config: Optional[MWConfig] = None) -> Issuer:
     """Get JWT issuer, init keys if needed"""
-    privkeypath, _ = await check_create_keypair()
-    return Issuer(privkeypath=privkeypath, keypasswd=None)
+    privkeypath, _ = await check_create_keypair(config)
+    return load_issuer(privkeypath)
 
 
-async def get_verifier() -> Verifier:
+async def get_verifier(config: Optional[MWConfig] = None) -> Verifier:
     """Get JWT verifier, init keys if needed"""
-    _, pubkeypath = await check_create_keypair()
-    return Verifier(pubkeypath=pubkeypath.parent)
+    _, pubkeypath = await check_create_keypair(config)
+    return load_verifier(pubkeypath.parent)
+
+
+def csr_claims(subject: str) -> Dict[str, Any]:
+    """Claims for a CSR enrollment token for subject"""
+    return {"sub": subject, "csr": True, "nonce": uuid_to_b64(uuid.uuid4())}
+
+
+def sign_csr_batch(privkeypath: Path, lifetime: int, subjects: List[str]) -> List[str]:
+    """Issue CSR tokens for the subjects, runs in the worker processes which keep the issuer in ISSUER_CACHE"""
+    issuer = load_issuer(privkeypath)
+    issuer.config.lifetime = lifetime
+    return [issuer.issue(csr_claims(subject)) for subject in subjects]
+
+
+def batched_subjects(subjects: Iterable[str], count: int, batch_size: int) -> Iterator[List[str]]:
+    """Repeat each subject count times and chunk into lists of batch_size, consumes subjects lazily"""
+    batch: List[str] = []
+    for subject in subjects:
+        for _ in range(count):
+            batch.append(subject)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+async def mint_csr_tokens(  # pylint: disable=R0913,R0917
+    subjects: Iterable[str],
+    count: int = 1,
+    lifetime: Optional[int] = None,
+    batch_size: int = 100,
+    workers: Optional[int] = None,
+    config: Optional[MWConfig] = None,
+) -> AsyncIterator[Tuple[str, str]]:
+    """Mint count CSR tokens per subject, yields (subject, token) in input order as the batches get signed.
+
+    Signing is done in batches over a process pool, only a couple of batches per worker are in flight at a
+    time so that subjects can be an arbitrarily long (lazy) iterable. lifetime defaults to csr_jwt_lifetime"""
+    if config is None:
+        config = MWConfig.singleton()
+    if lifetime is None:
+        lifetime = config.csr_jwt_lifetime
+    if workers is None:
+        workers = os.cpu_count() or 1
+    privkeypath, _ = await check_create_keypair(config)
+    loop = asyncio.get_event_loop()
+    pending: Deque[Tuple[List[str], "asyncio.Future[List[str]]"]] = collections.deque()
+    with measure("jwt_mint"), concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in batched_subjects(subjects, count, batch_size):
+            pending.append((batch, loop.run_in_executor(executor, sign_csr_batch, privkeypath, lifetime, batch)))
+            if len(pending) < workers * 2:
+                continue
+            done, future = pending.popleft()
+            for subject, token in zip(done, await future):
+                yield subject, token
+        while pending:
+            done, future = pending.popleft()
+            for subject, token in zip(done, await future):
+                yield subject, token
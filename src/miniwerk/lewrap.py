@@ -1,17 +1,26 @@
 """Wrap letsencrypt"""
 
-from typing import List, Tuple
+from typing import List, Tuple, Optional
+import asyncio
 import logging
 from pathlib import Path
 
-from .config import MWConfig
-from .helpers import certs_copy, call_cmd
+from .config import MWConfig, LEEngine, LE_MAX_SANS
+from .helpers import certbot_lock, certs_copy_targets, run_cmd, cert_needs_renewal, file_lock
+from .report import measure
 
 LOGGER = logging.getLogger(__name__)
 
 
-async def call_certbot(config: MWConfig) -> Tuple[int, List[str]]:
-    """Construct Certbot command and call the entrypoint, returns the args for easier unit testing"""
+async def call_certbot(config: MWConfig, lineage: Optional[str] = None) -> Tuple[int, List[str]]:
+    """Construct Certbot command and call the entrypoint, returns the args for easier unit testing
+
+    lineage is the cert-name from config.cert_lineages, default is the main one (le_cert_name)"""
+    if lineage is None:
+        lineage = config.le_cert_name
+    fqdns = config.cert_lineages[lineage]
+    if len(fqdns) > LE_MAX_SANS:
+        raise ValueError("{} names but Let's Encrypt allows at most {} per cert".format(len(fqdns), LE_MAX_SANS))
     args: List[str] = [
         "certonly",
         "--key-type",
@@ -25,31 +34,64 @@ async def call_certbot(config: MWConfig) -> Tuple[int, List[str]]:
         "--work-dir",
         str(config.le_work_path),
         "--cert-name",
-        config.le_cert_name,
+        lineage,
         "--agree-tos",
         "--no-eff-email",
         "-m",
         config.le_email,
         "--domains",
-        ",".join(config.fqdns),
+        ",".join(fqdns),
     ]
     if config.le_test:
         args.append("--staging")
 
+    certpath = config.le_lineage_dir(lineage) / "fullchain.pem"
+    if not cert_needs_renewal(certpath, fqdns, config.cert_renew_before):
+        LOGGER.info("Current cert for {} is fine, not calling certbot".format(lineage))
+        return 0, args
+    if certpath.exists():
+        # We decided it is due, certbot would keep it until its own 30 day window if cert_renew_before is longer
+        args[args.index("--keep-until-expiring")] = "--force-renewal"
+
     if config.ci:
         LOGGER.info("Running under CI, not actually calling certbot")
         return 0, args
 
-    cmd = "certbot " + " ".join(args)
-    return await call_cmd(cmd), args
+    async with (
+        certbot_lock(),
+        file_lock(config.locks_path / "certbot.lock", config.lock_timeout + config.certbot_timeout),
+    ):
+        # Someone else may have got the cert while we waited
+        if not cert_needs_renewal(config.le_lineage_dir(lineage) / "fullchain.pem", fqdns, config.cert_renew_before):
+            LOGGER.info("Cert for {} was renewed while we waited for the lock".format(lineage))
+            return 0, args
+        with measure("certbot:{}".format(lineage)):
+            result = await run_cmd(["certbot"] + args, config.certbot_timeout)
+    return result.returncode, args
+
+
+async def get_le_certs(config: Optional[MWConfig] = None) -> Path:
+    """Get certs from LE for each lineage, copy them to the configured paths, return the main copy path
 
+    Certbot standalone needs port 80 and locks the config dir so lineages are done one at a time,
+    the ones whose names did not change and are not about to expire are skipped without calling certbot"""
+    if config is None:
+        config = MWConfig.singleton()
+    if config.le_engine == LEEngine.ACME:
+        from .acmewrap import get_acme_certs  # pylint: disable=import-outside-toplevel  # heavy and optional
 
-async def get_le_certs() -> Path:
-    """Get certs from LE, copy them to the configured path, return configured path"""
-    config = MWConfig.singleton()
-    retcode, _ = await call_certbot(config)
-    if retcode != 0:
-        raise RuntimeError("Certbot returned error")
-    copydir = config.le_copy_path / config.le_cert_name
-    certs_copy(copydir, config.le_cert_dir)
-    return copydir
+        await get_acme_certs(config)
+    else:
+        for lineage in config.cert_lineages.keys():
+            retcode, _ = await call_certbot(config, lineage)
+            if retcode != 0:
+                raise RuntimeError("Certbot returned error for {}".format(lineage))
+    await asyncio.gather(
+        *(
+            certs_copy_targets(
+                config.le_lineage_dir(lineage), config.lineage_copy_targets(lineage), config.certs_copy_mode
+            )
+            for lineage in config.cert_lineages.keys()
+        )
+    )
+    return config.le_copy_path / config.le_cert_name
@@ -0,0 +1,222 @@
+"""Issue certs in-process with a mkcert compatible CA (localca_engine=builtin)
+
+The CA is rootCA.pem + rootCA-key.pem in the mkcert CAROOT so certs from this and from mkcert are
+trusted the same way, if there is no CA yet one is created. Issuing runs in a process pool where each
+worker keeps the CA loaded"""
+
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import os
+from pathlib import Path
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+from .config import MWConfig, KeyType
+from .helpers import cert_needs_renewal, certs_copy_targets, file_lock, mkcert_caroot, write_if_changed
+from .jwt import PRIVDIR_MODE, file_signature
+from .report import in_context, measure
+
+LOGGER = logging.getLogger(__name__)
+CAKey = rsa.RSAPrivateKey | ec.EllipticCurvePrivateKey
+# Loaded CAs keyed by CAROOT, value is (file signatures, cert, key)
+CA_CACHE: Dict[Path, Tuple[object, x509.Certificate, CAKey]] = {}
+# Same as mkcert, the maximum Apple platforms accept
+LEAF_VALIDITY_DAYS = 825
+
+
+def private_key(keytype: KeyType) -> CAKey:
+    """New private key, RSA is 2048 bits like mkcert"""
+    if keytype == KeyType.ECDSA:
+        return ec.generate_private_key(ec.SECP256R1())
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def key_pem(key: CAKey) -> bytes:
+    """PKCS8 PEM without encryption"""
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def create_ca(caroot: Path) -> None:
+    """Create rootCA.pem and rootCA-key.pem like mkcert does (RSA 3072, 10 years)"""
+    LOGGER.info("Creating local CA in {}".format(caroot))
+    caroot.mkdir(parents=True, exist_ok=True)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=3072)
+    name = x509.Name(
+        [
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "miniwerk development CA"),
+            x509.NameAttribute(NameOID.COMMON_NAME, "miniwerk {}".format(os.uname().nodename)),
+        ]
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=3650))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=False,
+                content_commitment=False,
+                key_encipherment=False,
+                data_encipherment=False,
+                key_agreement=False,
+                key_cert_sign=True,
+                crl_sign=False,
+                encipher_only=False,
+                decipher_only=False,
+            ),
+            critical=True,
+        )
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    write_if_changed(caroot / "rootCA-key.pem", key_pem(key), mode=0o400)
+    write_if_changed(caroot / "rootCA.pem", cert.public_bytes(serialization.Encoding.PEM), mode=0o644)
+
+
+def load_ca(caroot: Path) -> Tuple[x509.Certificate, CAKey]:
+    """Get the CA cert and key, parsed again only if the files have changed"""
+    certpath, keypath = caroot / "rootCA.pem", caroot / "rootCA-key.pem"
+    signature = (file_signature(certpath), file_signature(keypath))
+    cached = CA_CACHE.get(caroot)
+    if cached is None or cached[0] != signature:
+        LOGGER.debug("Loading CA from {}".format(caroot))
+        key = serialization.load_pem_private_key(keypath.read_bytes(), password=None)
+        if not isinstance(key, (rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey)):
+            raise ValueError("{} is not RSA or EC key".format(keypath))
+        cached = (signature, x509.load_pem_x509_certificate(certpath.read_bytes()), key)
+        CA_CACHE[caroot] = cached
+    return cached[1], cached[2]
+
+
+def issue_cert(caroot: Path, names: Sequence[str], keytype: KeyType) -> Tuple[bytes, bytes]:
+    """Issue server cert for the names, returns (cert PEM, key PEM)"""
+    cacert, cakey = load_ca(caroot)
+    key = private_key(keytype)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(
+            x509.Name(
+                [
+                    x509.NameAttribute(NameOID.ORGANIZATION_NAME, "miniwerk development certificate"),
+                    x509.NameAttribute(NameOID.COMMON_NAME, names[0]),
+                ]
+            )
+        )
+        .issuer_name(cacert.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=LEAF_VALIDITY_DAYS))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(name) for name in names]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=True,
+                content_commitment=False,
+                key_encipherment=isinstance(key, rsa.RSAPrivateKey),
+                data_encipherment=False,
+                key_agreement=False,
+                key_cert_sign=False,
+                crl_sign=False,
+                encipher_only=False,
+                decipher_only=False,
+            ),
+            critical=True,
+        )
+        .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+        .add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(cakey.public_key()),
+            critical=False,
+        )
+        .sign(cakey, hashes.SHA256())
+    )
+    return cert.public_bytes(serialization.Encoding.PEM), key_pem(key)
+
+
+async def check_create_ca(caroot: Path, config: Optional[MWConfig] = None) -> None:
+    """Create the CA if there is none, keygen runs in the executor under a file lock so that processes
+    sharing the CAROOT can not leave the key of one next to the cert of the other"""
+    if config is None:
+        config = MWConfig.singleton()
+    # The cert is written last, if it is there the CA is complete
+    if (caroot / "rootCA.pem").exists():
+        return
+    async with file_lock(config.locks_path / "localca.lock", config.lock_timeout):
+        if (caroot / "rootCA.pem").exists():
+            LOGGER.info("CA was created while we waited for the lock")
+            return
+        await asyncio.get_event_loop().run_in_executor(None, in_context(create_ca, caroot))
+
+
+async def issue_certs(
+    caroot: Path,
+    name_sets: Mapping[str, Sequence[str]],
+    keytype: KeyType,
+    workers: Optional[int] = None,
+    config: Optional[MWConfig] = None,
+) -> Dict[str, Tuple[bytes, bytes]]:
+    """Issue a cert for each name set (keyed by lineage) in parallel, returns (cert PEM, key PEM) per lineage.
+
+    A single cert is issued in a thread, more go to a process pool"""
+    await check_create_ca(caroot, config)
+    loop = asyncio.get_event_loop()
+    if len(name_sets) == 1:
+        lineage, names = next(iter(name_sets.items()))
+        return {lineage: await loop.run_in_executor(None, issue_cert, caroot, names, keytype)}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = await asyncio.gather(
+            *(loop.run_in_executor(executor, issue_cert, caroot, names, keytype) for names in name_sets.values())
+        )
+    return dict(zip(name_sets.keys(), results))
+
+
+def write_lineage(livedir: Path, certpem: bytes, keypem: bytes, capem: bytes) -> None:
+    """Write the cert.pem/privkey.pem/fullchain.pem layout, key first"""
+    livedir.mkdir(parents=True, exist_ok=True)
+    livedir.chmod(PRIVDIR_MODE)
+    write_if_changed(livedir / "privkey.pem", keypem, mode=0o600)
+    write_if_changed(livedir / "cert.pem", certpem)
+    write_if_changed(livedir / "fullchain.pem", certpem + capem)
+
+
+async def get_localca_certs(config: MWConfig) -> List[str]:
+    """Issue the local CA lineages that need renewal and copy all of them to their targets,
+    returns the lineages that were issued"""
+    lineages = {
+        lineage: names
+        for lineage, names in config.local_cert_lineages.items()
+        if cert_needs_renewal(config.mk_lineage_dir(lineage) / "fullchain.pem", names, config.cert_renew_before)
+    }
+    caroot = await mkcert_caroot(config)
+    if lineages:
+        with measure("localca"):
+            issued = await issue_certs(caroot, lineages, config.keytype, config=config)
+            capem = (caroot / "rootCA.pem").read_bytes()
+            for lineage, (certpem, keypem) in issued.items():
+                write_lineage(config.mk_lineage_dir(lineage), certpem, keypem, capem)
+                LOGGER.info("Issued cert for {}".format(lineage))
+    await asyncio.gather(
+        *(
+            certs_copy_targets(
+                config.mk_lineage_dir(lineage), config.lineage_copy_targets(lineage), config.certs_copy_mode
+            )
+            for lineage in config.local_cert_lineages.keys()
+        )
+    )
+    return list(lineages.keys())
@@ -1,37 +1,303 @@
 """Handle manifests"""
 
-from typing import cast, List, Dict, Optional
+from typing import cast, Any, List, Dict, Iterable, Mapping, Optional, Set, Tuple
+from dataclasses import dataclass, field
+import asyncio
+import hashlib
 import logging
 import json
-import uuid
+import time
 from pathlib import Path
 
-from libadvian.binpackers import uuid_to_b64
+import jwt as pyJWT  # too easy to accidentally mix up with our own module
+from multikeyjwt import Issuer, Verifier
 
-from .config import MWConfig, ProductSettings
-from .jwt import get_issuer, PUBDIR_MODE, check_create_keypair
+from .config import MWConfig, ProductSettings, ManifestFormat
+from .helpers import file_lock, write_if_changed
+from .jwt import (
+    get_issuer,
+    get_verifier,
+    PUBDIR_MODE,
+    check_create_keypair,
+    load_issuer,
+    load_verifier,
+    load_jwks,
+    csr_claims,
+    file_signature,
+    pubdir_signature,
+)
+from .models import (
+    ProductEndpoints,
+    ProductInfo,
+    ProductManifest,
+    RasenmaeherInfo,
+    RasenmaeherInit,
+    RasenmaeherManifest,
+    RasenmaeherMTLS,
+    dump_product_manifest,
+    dump_rasenmaeher_manifest,
+)
+from .report import in_context, measure
 
 LOGGER = logging.getLogger(__name__)
 
 
-async def copy_jwt_pub(manifest_dir: Path) -> None:
-    """Copy miniwerks JWT public key to the manifest dir"""
-    _, mw_jwt_pub = await check_create_keypair()
+def manifest_digest(
+    manifest: Dict[str, Any], mw_jwt_pub: Optional[Path] = None, fmt: ManifestFormat = ManifestFormat.COMPACT
+) -> str:
+    """Hash of the manifest content (without the token), the public key the token is verified with and
+    the format (compact is left out so that the digests of existing manifests stay the same)"""
+    hasher = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8"))
+    if mw_jwt_pub is not None:
+        hasher.update(mw_jwt_pub.read_bytes())
+    if fmt != ManifestFormat.COMPACT:
+        hasher.update(fmt.value.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def load_manifest_state(config: Optional[MWConfig] = None) -> Dict[str, str]:
+    """Load the input digests of the manifests we have written, keyed by manifest path"""
+    if config is None:
+        config = MWConfig.singleton()
+    state_path = config.manifests_state_path
+    if not state_path.exists():
+        return {}
+    return cast(Dict[str, str], json.loads(state_path.read_text(encoding="utf-8")))
+
+
+async def save_manifest_digests(
+    digests: Mapping[Path, str], config: Optional[MWConfig] = None, removed: Iterable[Path] = ()
+) -> None:
+    """Record the input digests keyed by manifest (or published key) path and forget the removed paths,
+    the state file is written once for all of them. The file lock keeps other tasks and processes from
+    doing the same read-modify-write at the same time"""
+    if config is None:
+        config = MWConfig.singleton()
+    async with file_lock(config.locks_path / "manifests_state.lock", config.lock_timeout):
+        state = load_manifest_state(config)
+        changed = {str(manifest_path): digest for manifest_path, digest in digests.items()}
+        gone = {str(pth) for pth in removed} & set(state.keys())
+        if not gone and all(state.get(key) == digest for key, digest in changed.items()):
+            return
+        for key in gone:
+            del state[key]
+        state.update(changed)
+        state_path = config.manifests_state_path
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        write_if_changed(state_path, json.dumps(state).encode("utf-8"), fsync=True)
+
+
+@dataclass
+class ManifestDigests:
+    """State loaded once for a batch of manifests and the digests of the ones written, saved together"""
+
+    saved: Dict[str, str]
+    signature: Optional[Tuple[int, int, int, int]] = None
+    written: Dict[Path, str] = field(default_factory=dict)
+    removed: Set[Path] = field(default_factory=set)
+
+    @classmethod
+    def load(cls, config: MWConfig) -> "ManifestDigests":
+        """Load the saved state"""
+        digests = cls(saved={})
+        digests.reload(config)
+        return digests
+
+    def reload(self, config: MWConfig) -> None:
+        """Load the saved state again if the file has changed, eg. another process saved it"""
+        state_path = config.manifests_state_path
+        signature = file_signature(state_path) if state_path.exists() else None
+        if signature != self.signature:
+            self.saved = load_manifest_state(config)
+            self.signature = signature
+
+    def current(self, manifest_path: Path) -> Optional[str]:
+        """Digest the manifest was last written from"""
+        if manifest_path in self.written:
+            return self.written[manifest_path]
+        if manifest_path in self.removed:
+            return None
+        return self.saved.get(str(manifest_path))
+
+    def remove(self, manifest_path: Path) -> None:
+        """Forget the path"""
+        self.written.pop(manifest_path, None)
+        self.removed.add(manifest_path)
+
+    async def save(self, config: MWConfig) -> None:
+        """Save the changes to the state file"""
+        if self.written or self.removed:
+            await save_manifest_digests(self.written, config, self.removed)
+
+
+async def copy_jwt_pub(
+    manifest_dir: Path,
+    mw_jwt_pub: Optional[Path] = None,
+    config: Optional[MWConfig] = None,
+    digests: Optional[ManifestDigests] = None,
+) -> None:
+    """Copy miniwerks active JWT public keys (every .pub next to mw_jwt_pub) to the manifest dir and write
+    their JWKS as jwks.json, only changed files are written. If mw_jwt_pub is not given check/create the keypair
+
+    The published keys are recorded in the manifest state, the ones no longer in the source dir are removed so
+    that retired keys stop being trusted. Keys someone else put in the dir are left alone. If digests is given
+    the changes are only added to it and the caller saves them, otherwise they are saved here"""
+    if config is None:
+        config = MWConfig.singleton()
+    if digests is None:
+        digests = ManifestDigests.load(config)
+        await copy_jwt_pub(manifest_dir, mw_jwt_pub, config, digests)
+        await digests.save(config)
+        return
+    if mw_jwt_pub is None:
+        _, mw_jwt_pub = await check_create_keypair(config)
     LOGGER.debug("manifest_dir={}".format(manifest_dir))
-    pubkeypath = manifest_dir / "publickeys" / "kraftwerk.pub"
-    pubdir = pubkeypath.parent
+    srcdir = mw_jwt_pub.parent
+    pubdir = manifest_dir / "publickeys"
     pubdir.mkdir(parents=True, exist_ok=True)
     pubdir.chmod(PUBDIR_MODE)
-    LOGGER.debug("pubkeypath={}, exists: {}".format(pubkeypath, pubkeypath.exists()))
-    if pubkeypath.exists():
-        return
-    pubkeypath.write_bytes(mw_jwt_pub.read_bytes())
-    LOGGER.info("Wrote {}".format(pubkeypath))
+    active = {name for name, _ in pubdir_signature(srcdir)}
+    for name in sorted(active):
+        data = (srcdir / name).read_bytes()
+        if write_if_changed(pubdir / name, data, mode=0o644):
+            LOGGER.info("Wrote {}".format(pubdir / name))
+        digest = hashlib.sha256(data).hexdigest()
+        if digests.current(pubdir / name) != digest:
+            digests.written[pubdir / name] = digest
+    for name, _ in pubdir_signature(pubdir):
+        if name in active:
+            continue
+        if digests.current(pubdir / name) is None:
+            LOGGER.debug("{} was not published by us, leaving it".format(pubdir / name))
+            continue
+        (pubdir / name).unlink()
+        digests.remove(pubdir / name)
+        LOGGER.info("Removed retired key {}".format(pubdir / name))
+    if write_if_changed(manifest_dir / "jwks.json", load_jwks(srcdir), mode=0o644):
+        LOGGER.info("Wrote {}".format(manifest_dir / "jwks.json"))
+
 
+def token_expires_in(token: str) -> float:
+    """Seconds until the token expires, signature is not checked"""
+    claims = pyJWT.decode(token, options={"verify_signature": False})
+    return float(claims["exp"]) - time.time()
 
-def get_product_config(productname: str) -> Optional[ProductSettings]:
+
+def manifest_token_expires_in(manifest_path: Path) -> Optional[float]:
+    """Seconds until the csr_jwt in product manifest expires, None if there is no readable token"""
+    try:
+        token = json.loads(manifest_path.read_text(encoding="utf-8"))["rasenmaeher"]["init"]["csr_jwt"]
+        return token_expires_in(token)
+    except (OSError, ValueError, KeyError, TypeError, pyJWT.InvalidTokenError) as exc:
+        LOGGER.warning("Could not read token from {}: {}".format(manifest_path, exc))
+        return None
+
+
+@dataclass
+class TokenStatus:
+    """Result of verifying the csr_jwt of a product manifest"""
+
+    manifest_path: Path
+    subject: Optional[str] = None
+    expires_in: Optional[float] = None
+    error: Optional[str] = None
+
+    @property
+    def valid(self) -> bool:
+        """Signature and expiry are fine"""
+        return self.error is None
+
+    def needs_renewal(self, renew_before: int) -> bool:
+        """Invalid or expires within renew_before seconds"""
+        return not self.valid or self.expires_in is None or self.expires_in < renew_before
+
+
+def verify_manifest_token(manifest_path: Path, verifier: Verifier) -> TokenStatus:
+    """Verify the csr_jwt in the product manifest, expires_in is filled also for expired tokens when possible"""
+    status = TokenStatus(manifest_path=manifest_path)
+    try:
+        token = json.loads(manifest_path.read_text(encoding="utf-8"))["rasenmaeher"]["init"]["csr_jwt"]
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        status.error = "Could not read token: {}".format(exc)
+        return status
+    try:
+        claims = verifier.decode(token)
+    except pyJWT.PyJWTError as exc:
+        status.error = "{}: {}".format(type(exc).__name__, exc)
+        try:
+            status.expires_in = token_expires_in(token)
+        except (pyJWT.PyJWTError, KeyError, ValueError, TypeError):
+            pass
+        return status
+    status.subject = claims.get("sub")
+    if "exp" not in claims:
+        status.error = "Token has no expiry"
+        return status
+    status.expires_in = float(claims["exp"]) - time.time()
+    return status
+
+
+async def verify_manifests(
+    manifests_base: Optional[Path] = None, chunk_size: int = 64, config: Optional[MWConfig] = None
+) -> List[TokenStatus]:
+    """Verify the tokens of all product manifests under manifests_base (default from config) with the cached
+    verifier, chunks of manifests are verified in parallel in the executor. Sorted by path"""
+    if config is None:
+        config = MWConfig.singleton()
+    if manifests_base is None:
+        manifests_base = config.manifests_base
+    verifier = await get_verifier(config)
+    paths = sorted(manifests_base.rglob("kraftwerk-init.json"))
+
+    def verify_chunk(chunk: List[Path]) -> List[TokenStatus]:
+        """Verify a chunk of manifests"""
+        return [verify_manifest_token(manifest_path, verifier) for manifest_path in chunk]
+
+    loop = asyncio.get_event_loop()
+    with measure("verify_manifests"):
+        chunks = await asyncio.gather(
+            *(
+                loop.run_in_executor(None, verify_chunk, paths[idx : idx + chunk_size])
+                for idx in range(0, len(paths), chunk_size)
+            )
+        )
+    return [status for chunk in chunks for status in chunk]
+
+
+def manifest_is_current(
+    manifest_path: Path,
+    digest: str,
+    check_token: bool = False,
+    config: Optional[MWConfig] = None,
+    digests: Optional[ManifestDigests] = None,
+) -> bool:
+    """Check that manifest exists, was written from the same inputs and (optionally) that its csr_jwt is valid
+    and not about to expire. The state is read from digests if given, otherwise from disk"""
+    if config is None:
+        config = MWConfig.singleton()
+    if not manifest_path.exists():
+        return False
+    if digests is None:
+        digests = ManifestDigests.load(config)
+    if digests.current(manifest_path) != digest:
+        LOGGER.info("Inputs for {} have changed".format(manifest_path))
+        return False
+    if check_token:
+        status = verify_manifest_token(manifest_path, load_verifier(config.data_path / "publickeys"))
+        if not status.valid:
+            LOGGER.info("Token in {} is not valid, renewing: {}".format(manifest_path, status.error))
+            return False
+        assert status.expires_in is not None  # valid tokens always have it, keep mypy happy
+        if status.needs_renewal(config.csr_jwt_renew_before):
+            LOGGER.info("Token in {} expires in {:.0f}s, renewing".format(manifest_path, status.expires_in))
+            return False
+    return True
+
+
+def get_product_config(productname: str, config: Optional[MWConfig] = None) -> Optional[ProductSettings]:
     """Get normalized product config"""
-    config = MWConfig.singleton()
+    if config is None:
+        config = MWConfig.singleton()
     product_config = getattr(config, productname, None)
     if not product_config:
         LOGGER.error("No config for {}".format(productname))
@@ -44,101 +310,155 @@ def get_product_config(productname: str) -> Optional[ProductSettings]:
     return product_config
 
 
-async def create_rasenmaeher_manifest() -> Path:
+def product_endpoints(productname: str, config: MWConfig) -> Optional[ProductEndpoints]:
+    """Format the URIs of the product, None if the product has no config"""
+    product_config = get_product_config(productname, config)
+    if not product_config:
+        return None
+    apihost, userhost = product_config.api_host, product_config.user_host
+    return ProductEndpoints(
+        api=f"https://{apihost}.{config.domain}:{product_config.api_port}{product_config.api_base}",
+        uri=f"https://{userhost}.{config.domain}:{product_config.user_port}{product_config.user_base}",
+        certcn=f"{productname}.{config.domain}",
+    )
+
+
+def build_rasenmaeher_manifest(config: MWConfig) -> RasenmaeherManifest:
+    """The RASENMAEHER manifest for the config"""
+    manifest = RasenmaeherManifest(dns=config.domain, deployment=config.domain.split(".")[0])
+    for productname in config.product_manifest_paths.keys():
+        endpoints = product_endpoints(productname, config)
+        if endpoints:
+            manifest.products[productname] = endpoints
+    return manifest
+
+
+def build_product_manifest(productname: str, config: MWConfig) -> Optional[ProductManifest]:
+    """The product manifest without csr_jwt, None if the product has no config"""
+    endpoints = product_endpoints(productname, config)
+    if not endpoints:
+        return None
+    rm_port = config.rasenmaeher.api_port
+    if rm_port != 443:
+        rm_uri = f"https://{config.domain}:{rm_port}/"
+    else:
+        rm_uri = f"https://{config.domain}/"
+    mtls_uri = rm_uri.replace("https://", "https://mtls.")
+    return ProductManifest(
+        deployment=config.domain.split(".")[0],
+        rasenmaeher=RasenmaeherInfo(init=RasenmaeherInit(base_uri=rm_uri), mtls=RasenmaeherMTLS(base_uri=mtls_uri)),
+        product=ProductInfo(dns=endpoints.certcn, api=endpoints.api, uri=endpoints.uri),
+    )
+
+
+async def create_rasenmaeher_manifest(config: Optional[MWConfig] = None) -> Path:
     """create manifest for RASENMAEHER"""
-    config = MWConfig.singleton()
+    if config is None:
+        config = MWConfig.singleton()
     manifest_path = config.manifests_base / "rasenmaeher" / "kraftwerk-rasenmaeher-init.json"
     manifest_dir = manifest_path.parent
     manifest_dir.mkdir(parents=True, exist_ok=True)
     LOGGER.debug("manifest_dir={}".format(manifest_dir))
-    await copy_jwt_pub(manifest_dir)
-
-    if manifest_path.exists():
-        LOGGER.info("{} already exists, not overwriting".format(manifest_path))
-        return manifest_path
+    digests = ManifestDigests.load(config)
+    await copy_jwt_pub(manifest_dir, config=config, digests=digests)
 
-    manifest = {
-        "dns": config.domain,
-        "deployment": config.domain.split(".")[0],
-        "products": cast(Dict[str, Dict[str, str]], {}),
-    }
-    for productname in config.product_manifest_paths.keys():
-        product_config = get_product_config(productname)
-        if not product_config:
-            LOGGER.error("No config for {}".format(productname))
-            continue
-        apihost = product_config.api_host
-        userhost = product_config.user_host
-        manifest["products"][productname] = {  # type: ignore[index]   # false positive
-            "api": f"https://{apihost}.{config.domain}:{product_config.api_port}{product_config.api_base}",
-            "uri": f"https://{userhost}.{config.domain}:{product_config.user_port}{product_config.user_base}",
-            "certcn": f"{productname}.{config.domain}",
-        }
-    manifest_path.write_text(json.dumps(manifest), encoding="utf-8")
-    LOGGER.info("Wrote {}".format(manifest_path))
+    manifest = build_rasenmaeher_manifest(config)
+    digest = manifest_digest(manifest.model_dump(), fmt=config.manifest_format)
+    if manifest_is_current(manifest_path, digest, config=config, digests=digests):
+        LOGGER.info("{} is up to date".format(manifest_path))
+    else:
+        write_if_changed(manifest_path, dump_rasenmaeher_manifest(manifest, config.manifest_format), fsync=True)
+        digests.written[manifest_path] = digest
+        LOGGER.info("Wrote {}".format(manifest_path))
+    await digests.save(config)
     return manifest_path
 
 
-async def create_product_manifest(productname: str) -> Path:
-    """create manisfest for given product"""
-    config = MWConfig.singleton()
+async def create_product_manifest(
+    productname: str,
+    issuer: Optional[Issuer] = None,
+    mw_jwt_pub: Optional[Path] = None,
+    config: Optional[MWConfig] = None,
+    digests: Optional[ManifestDigests] = None,
+) -> Path:
+    """create manisfest for given product, pass issuer and mw_jwt_pub to skip the keypair check.
+    If digests is given the new digest is only added to it and the caller saves it, otherwise it is saved here"""
+    if config is None:
+        config = MWConfig.singleton()
+    with measure("manifest:{}".format(productname)):
+        if digests is not None:
+            return await _create_product_manifest(productname, issuer, mw_jwt_pub, config, digests)
+        digests = ManifestDigests.load(config)
+        manifest_path = await _create_product_manifest(productname, issuer, mw_jwt_pub, config, digests)
+        await digests.save(config)
+        return manifest_path
+
+
+async def _create_product_manifest(
+    productname: str, issuer: Optional[Issuer], mw_jwt_pub: Optional[Path], config: MWConfig, digests: ManifestDigests
+) -> Path:
+    """Do the work for create_product_manifest"""
     manifest_path = config.manifests_base / productname / "kraftwerk-init.json"
     manifest_dir = manifest_path.parent
     manifest_dir.mkdir(parents=True, exist_ok=True)
     LOGGER.debug("manifest_dir={}".format(manifest_dir))
-    await copy_jwt_pub(manifest_dir)
+    if mw_jwt_pub is None:
+        _, mw_jwt_pub = await check_create_keypair(config)
+    await copy_jwt_pub(manifest_dir, mw_jwt_pub, config, digests)
 
-    if manifest_path.exists():
-        LOGGER.info("{} already exists, not overwriting".format(manifest_path))
+    manifest = build_product_manifest(productname, config)
+    if not manifest:
         return manifest_path
-
-    issuer = await get_issuer()
-    issuer.config.lifetime = 3600 * 24  # 24h
-    token = issuer.issue(
-        {
-            "sub": f"{productname}.{config.domain}",
-            "csr": True,
-            "nonce": uuid_to_b64(uuid.uuid4()),
-        }
-    )
-    rm_port = config.rasenmaeher.api_port
-    if rm_port != 443:
-        rm_uri = f"https://{config.domain}:{rm_port}/"
-    else:
-        rm_uri = f"https://{config.domain}/"
-    mtls_uri = rm_uri.replace("https://", "https://mtls.")
-    product_config = get_product_config(productname)
-    if not product_config:
-        LOGGER.error("No config for {}".format(productname))
+    digest = manifest_digest(manifest.model_dump(), mw_jwt_pub, config.manifest_format)
+    if manifest_is_current(manifest_path, digest, check_token=True, config=config, digests=digests):
+        LOGGER.info("{} is up to date".format(manifest_path))
         return manifest_path
-    apihost = product_config.api_host
-    userhost = product_config.user_host
-    manifest = {
-        "deployment": config.domain.split(".")[0],
-        "rasenmaeher": {
-            "init": {"base_uri": rm_uri, "csr_jwt": token},
-            "mtls": {"base_uri": mtls_uri},
-            "certcn": "rasenmaeher",
-        },
-        "product": {
-            "dns": f"{productname}.{config.domain}",
-            "api": f"https://{apihost}.{config.domain}:{product_config.api_port}{product_config.api_base}",
-            "uri": f"https://{userhost}.{config.domain}:{product_config.user_port}{product_config.user_base}",
-        },
-    }
-    manifest_path.write_text(json.dumps(manifest), encoding="utf-8")
-    LOGGER.info("Wrote {}".format(manifest_path))
+
+    async with file_lock(config.locks_path / "manifest-{}.lock".format(productname), config.lock_timeout):
+        # Someone else may have written it while we waited, they saved their state when done
+        digests.reload(config)
+        if manifest_is_current(manifest_path, digest, check_token=True, config=config, digests=digests):
+            LOGGER.info("{} was written while we waited for the lock".format(manifest_path))
+            return manifest_path
+        if issuer is None:
+            issuer = await get_issuer(config)
+        issuer.config.lifetime = config.csr_jwt_lifetime
+        loop = asyncio.get_event_loop()
+        with measure("jwt_sign:{}".format(productname)):
+            manifest.rasenmaeher.init.csr_jwt = await loop.run_in_executor(
+                None, issuer.issue, csr_claims(manifest.product.dns)
+            )
+        data = dump_product_manifest(manifest, config.manifest_format)
+        await loop.run_in_executor(None, in_context(write_if_changed, manifest_path, data, fsync=True))
+        digests.written[manifest_path] = digest
+        LOGGER.info("Wrote {}".format(manifest_path))
     return manifest_path
 
 
-async def create_all_product_manifests() -> List[Path]:
-    """Handle all products"""
-    config = MWConfig.singleton()
-    ret = []
+async def create_all_product_manifests(config: Optional[MWConfig] = None) -> List[Path]:
+    """Handle all products, keypair is checked, issuer and state loaded and the state saved only once,
+    products are done in parallel"""
+    if config is None:
+        config = MWConfig.singleton()
+    privkeypath, mw_jwt_pub = await check_create_keypair(config)
+    issuer = load_issuer(privkeypath)
+    issuer.config.lifetime = config.csr_jwt_lifetime
+    limiter = asyncio.Semaphore(config.manifest_concurrency)
+    digests = ManifestDigests.load(config)
+
+    async def limited(productname: str) -> Path:
+        """Do the creation under the concurrency limit"""
+        async with limiter:
+            return await create_product_manifest(productname, issuer, mw_jwt_pub, config, digests)
+
+    productnames = []
     for productname in config.product_manifest_paths.keys():
         product_config = getattr(config, productname, None)
         if not product_config:
             LOGGER.error("No config for {}".format(productname))
             continue
-        ret.append(await create_product_manifest(productname))
-    return ret
+        productnames.append(productname)
+    try:
+        return list(await asyncio.gather(*(limited(productname) for productname in productnames)))
+    finally:
+        await digests.save(config)
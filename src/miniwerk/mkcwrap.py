@@ -1,12 +1,14 @@
 """Wrap mkcert calls"""
 
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 import logging
 from pathlib import Path
 
-from .config import MWConfig, KeyType
-from .helpers import certs_copy, call_cmd, mkcert_ca_cert
+from .config import MWConfig, KeyType, LocalCAEngine
+from .helpers import certs_copy_targets, run_cmd, mkcert_caroot, mkcert_ca_cert, cert_needs_renewal, write_if_changed
 from .jwt import PRIVDIR_MODE
+from .localca import get_localca_certs
+from .report import measure
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,32 +25,43 @@ async def call_mkcert(config: MWConfig) -> Tuple[int, List[str]]:
     ]
     if config.keytype == KeyType.ECDSA:
         args.append("--ecdsa")
-    args.append(" ".join(config.fqdns))
+    args.extend(config.fqdns)
+
+    if not cert_needs_renewal(config.mk_cert_dir / "fullchain.pem", config.fqdns, config.cert_renew_before):
+        LOGGER.info("Current cert is fine, not calling mkcert")
+        return 0, args
 
     if config.ci:
         LOGGER.info("Running under CI, not actually calling mkcert")
         return 0, args
 
-    cmd = "mkcert " + " ".join(args)
-    retcode = await call_cmd(cmd)
-    if retcode == 0:
-        fullchain = (config.mk_cert_dir / "cert.pem").read_bytes()
-        fullchain += mkcert_ca_cert().read_bytes()
-        (config.mk_cert_dir / "fullchain.pem").write_bytes(fullchain)
+    with measure("mkcert"):
+        caroot = await mkcert_caroot(config)
+        retcode = (await run_cmd(["mkcert"] + args, config.mkcert_timeout, {"CAROOT": str(caroot)})).returncode
+        if retcode == 0:
+            await assemble_fullchain(config)
     return retcode, args
 
 
-async def get_mk_certs() -> Path:
-    """Get certs from mkcert, copy them to the configured path, return configured path"""
-    config = MWConfig.singleton()
-    retcode, _ = await call_mkcert(config)
-    if retcode != 0:
-        raise RuntimeError("mkcert returned error")
+async def assemble_fullchain(config: MWConfig) -> bool:
+    """fullchain.pem is cert.pem + the mkcert CA cert, written only if either has changed"""
+    fullchain = (config.mk_cert_dir / "cert.pem").read_bytes() + (await mkcert_ca_cert(config)).read_bytes()
+    return write_if_changed(config.mk_cert_dir / "fullchain.pem", fullchain)
+
+
+async def get_mk_certs(config: Optional[MWConfig] = None) -> Path:
+    """Get certs from mkcert (or the builtin local CA), copy them to the configured path, return configured path"""
+    if config is None:
+        config = MWConfig.singleton()
     copydir = config.le_copy_path / config.le_cert_name
-    certs_copy(copydir, config.mk_cert_dir)
-    pubdir = Path("/ca_public")
-    pubdir.mkdir(parents=True, exist_ok=True)
-    capath = pubdir / "miniwerk_ca.pem"
-    capath.write_bytes(mkcert_ca_cert().read_bytes())
-    LOGGER.info("Wrote {}".format(capath))
+    if config.localca_engine == LocalCAEngine.BUILTIN:
+        await get_localca_certs(config)
+    else:
+        retcode, _ = await call_mkcert(config)
+        if retcode != 0:
+            raise RuntimeError("mkcert returned error")
+        await certs_copy_targets(config.mk_cert_dir, config.cert_copy_targets, config.certs_copy_mode)
+    config.ca_public_path.mkdir(parents=True, exist_ok=True)
+    capath = config.ca_public_path / "miniwerk_ca.pem"
+    write_if_changed(capath, (await mkcert_ca_cert(config)).read_bytes(), mode=0o644)
     return copydir
@@ -0,0 +1,75 @@
+"""Typed shapes of the manifests we write"""
+
+from typing import Dict
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+from .config import ManifestFormat
+
+
+class ProductEndpoints(BaseModel):
+    """Product entry in the RASENMAEHER manifest"""
+
+    api: str = Field(description="Integration API base URI")
+    uri: str = Field(description="User facing URI")
+    certcn: str = Field(description="CN of the product mTLS cert")
+
+
+class RasenmaeherManifest(BaseModel):
+    """kraftwerk-rasenmaeher-init.json"""
+
+    dns: str
+    deployment: str
+    products: Dict[str, ProductEndpoints] = Field(default_factory=dict)
+
+
+class RasenmaeherInit(BaseModel):
+    """Where and with what the product enrolls"""
+
+    base_uri: str
+    csr_jwt: str = Field(default="", description="Filled in last, the digest is calculated without it")
+
+
+class RasenmaeherMTLS(BaseModel):
+    """mTLS side of RASENMAEHER"""
+
+    base_uri: str
+
+
+class RasenmaeherInfo(BaseModel):
+    """RASENMAEHER part of the product manifest"""
+
+    init: RasenmaeherInit
+    mtls: RasenmaeherMTLS
+    certcn: str = "rasenmaeher"
+
+
+class ProductInfo(BaseModel):
+    """Product part of the product manifest"""
+
+    dns: str
+    api: str
+    uri: str
+
+
+class ProductManifest(BaseModel):
+    """kraftwerk-init.json"""
+
+    deployment: str
+    rasenmaeher: RasenmaeherInfo
+    product: ProductInfo
+
+
+# The serializers are built once here instead of on every dump
+RASENMAEHER_MANIFEST_ADAPTER = TypeAdapter(RasenmaeherManifest)
+PRODUCT_MANIFEST_ADAPTER = TypeAdapter(ProductManifest)
+
+
+def dump_rasenmaeher_manifest(manifest: RasenmaeherManifest, fmt: ManifestFormat = ManifestFormat.COMPACT) -> bytes:
+    """Serialize to JSON bytes"""
+    return RASENMAEHER_MANIFEST_ADAPTER.dump_json(manifest, indent=2 if fmt == ManifestFormat.PRETTY else None)
+
+
+def dump_product_manifest(manifest: ProductManifest, fmt: ManifestFormat = ManifestFormat.COMPACT) -> bytes:
+    """Serialize to JSON bytes"""
+    return PRODUCT_MANIFEST_ADAPTER.dump_json(manifest, indent=2 if fmt == ManifestFormat.PRETTY else None)
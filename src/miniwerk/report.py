@@ -0,0 +1,180 @@
+"""Timing/IO instrumentation for the stages of a run, see measure() and reporting()"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field, asdict
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+RetT = TypeVar("RetT")
+# Executor threads update the records too
+RECORD_LOCK = threading.Lock()
+
+
+@dataclass
+class SubprocessRecord:
+    """One external command"""
+
+    program: str
+    duration: float
+    returncode: int
+
+
+@dataclass
+class StageRecord:
+    """Measurements for one stage, cpu is process-wide so it includes whatever ran concurrently"""
+
+    name: str
+    parent: Optional[str] = None
+    path: str = ""  # names from the outermost stage down to this one joined with /
+    wall: float = 0.0
+    cpu: float = 0.0
+    bytes_written: int = 0
+    subprocesses: List[SubprocessRecord] = field(default_factory=list)
+
+
+@dataclass
+class RunReport:
+    """All the stages of one command run"""
+
+    command: str
+    started: float = field(default_factory=time.time)
+    wall: float = 0.0
+    cpu: float = 0.0
+    stages: List[StageRecord] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain dict for JSON"""
+        return asdict(self)
+
+
+CURRENT_REPORT: ContextVar[Optional[RunReport]] = ContextVar("CURRENT_REPORT", default=None)
+STAGE_STACK: ContextVar[Tuple[StageRecord, ...]] = ContextVar("STAGE_STACK", default=())
+
+
+@contextlib.contextmanager
+def reporting(command: str) -> Iterator[RunReport]:
+    """Collect the stages measured within into a report"""
+    report = RunReport(command=command)
+    token = CURRENT_REPORT.set(report)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield report
+    finally:
+        report.wall = time.perf_counter() - wall_start
+        report.cpu = time.process_time() - cpu_start
+        CURRENT_REPORT.reset(token)
+
+
+@contextlib.contextmanager
+def measure(name: str) -> Iterator[StageRecord]:
+    """Measure the block as a stage of the current report (if there is one), nests via contextvars"""
+    stack = STAGE_STACK.get()
+    record = StageRecord(
+        name=name,
+        parent=stack[-1].name if stack else None,
+        path="/".join([stage.name for stage in stack] + [name]),
+    )
+    report = CURRENT_REPORT.get()
+    if report is not None:
+        with RECORD_LOCK:
+            report.stages.append(record)
+    token = STAGE_STACK.set(stack + (record,))
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record.wall = time.perf_counter() - wall_start
+        record.cpu = time.process_time() - cpu_start
+        STAGE_STACK.reset(token)
+
+
+def add_bytes_written(count: int) -> None:
+    """Count written bytes to the current stage and its parents"""
+    stack = STAGE_STACK.get()
+    report = CURRENT_REPORT.get()
+    if not stack or report is None:
+        return
+    with RECORD_LOCK:
+        for stage in stack:
+            stage.bytes_written += count
+
+
+def add_subprocess(program: str, duration: float, returncode: int) -> None:
+    """Record external command run in the current stage"""
+    stack = STAGE_STACK.get()
+    report = CURRENT_REPORT.get()
+    if not stack or report is None:
+        return
+    with RECORD_LOCK:
+        stack[-1].subprocesses.append(SubprocessRecord(program=program, duration=duration, returncode=returncode))
+
+
+def in_context(func: Callable[..., RetT], *args: Any, **kwargs: Any) -> Callable[[], RetT]:
+    """Wrap func so that it sees the current stage when run in an executor thread"""
+    return functools.partial(copy_context().run, func, *args, **kwargs)
+
+
+def prometheus_escape(value: str) -> str:
+    """Escape label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def stage_totals(report: RunReport) -> Tuple[Dict[str, StageRecord], Dict[Tuple[str, str], float]]:
+    """Stages summed by path and subprocess durations summed by (path, program)"""
+    totals: Dict[str, StageRecord] = {}
+    subprocesses: Dict[Tuple[str, str], float] = {}
+    for stage in report.stages:
+        total = totals.setdefault(stage.path, StageRecord(name=stage.name, path=stage.path))
+        total.wall += stage.wall
+        total.cpu += stage.cpu
+        total.bytes_written += stage.bytes_written
+        for sub in stage.subprocesses:
+            key = (stage.path, sub.program)
+            subprocesses[key] = subprocesses.get(key, 0.0) + sub.duration
+    return totals, subprocesses
+
+
+def to_prometheus(report: RunReport) -> str:
+    """Render in Prometheus text exposition format for the node_exporter textfile collector
+
+    Series are labeled with the stage path so that the same stage under different parents (like the
+    deployments of a batch) stays separate, stages measured more than once under the same path are summed
+    because duplicate series make the collector reject the whole file"""
+    cmd = prometheus_escape(report.command)
+    totals, subprocesses = stage_totals(report)
+    lines = [
+        "# HELP miniwerk_run_timestamp_seconds When the run started",
+        "# TYPE miniwerk_run_timestamp_seconds gauge",
+        f'miniwerk_run_timestamp_seconds{{command="{cmd}"}} {report.started}',
+        "# HELP miniwerk_run_wall_seconds Wall-clock time of the whole run",
+        "# TYPE miniwerk_run_wall_seconds gauge",
+        f'miniwerk_run_wall_seconds{{command="{cmd}"}} {report.wall}',
+        "# HELP miniwerk_run_cpu_seconds CPU time of the whole run",
+        "# TYPE miniwerk_run_cpu_seconds gauge",
+        f'miniwerk_run_cpu_seconds{{command="{cmd}"}} {report.cpu}',
+    ]
+    metrics = (
+        ("wall_seconds", "Wall-clock time per stage", "wall"),
+        ("cpu_seconds", "Process CPU time during the stage", "cpu"),
+        ("bytes_written", "Bytes written during the stage", "bytes_written"),
+    )
+    for suffix, helptext, attr in metrics:
+        lines.append(f"# HELP miniwerk_stage_{suffix} {helptext}")
+        lines.append(f"# TYPE miniwerk_stage_{suffix} gauge")
+        for path, stage in totals.items():
+            labels = f'command="{cmd}",stage="{prometheus_escape(stage.name)}",path="{prometheus_escape(path)}"'
+            lines.append(f"miniwerk_stage_{suffix}{{{labels}}} {getattr(stage, attr)}")
+    lines.append("# HELP miniwerk_subprocess_duration_seconds Duration of external commands")
+    lines.append("# TYPE miniwerk_subprocess_duration_seconds gauge")
+    for (path, program), duration in subprocesses.items():
+        labels = (
+            f'command="{cmd}",stage="{prometheus_escape(totals[path].name)}",path="{prometheus_escape(path)}",'
+            + f'program="{prometheus_escape(program)}"'
+        )
+        lines.append(f"miniwerk_subprocess_duration_seconds{{{labels}}} {duration}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,207 @@
+"""HTTP service for the manifests (miniwerk serve)
+
+Paths mirror the layout under manifests_base, the manifests are built once into memory and each product
+manifest response gets a freshly minted csr_jwt. The product ETags are weak, they cover the manifest
+content and a time bucket of csr_jwt_lifetime - csr_jwt_renew_before seconds instead of the token itself.
+Pollers that already have the manifest get 304 without anything being signed until the bucket changes,
+by then their token is about to expire and they get a new one"""
+
+from typing import Dict, Optional
+from dataclasses import dataclass
+import asyncio
+import hashlib
+import logging
+import signal
+import time
+
+from aiohttp import web
+from multikeyjwt import Issuer
+
+from .config import MWConfig
+from .jwt import check_create_keypair, csr_claims, load_issuer, load_jwks
+from .manifests import build_product_manifest, build_rasenmaeher_manifest, manifest_digest
+from .models import ProductManifest, dump_product_manifest, dump_rasenmaeher_manifest
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedFile:
+    """Static response body and its ETag"""
+
+    body: bytes = b""
+    etag: str = ""
+
+    @classmethod
+    def from_body(cls, body: bytes) -> "CachedFile":
+        """Strong ETag from the body"""
+        return cls(body=body, etag='"{}"'.format(hashlib.sha256(body).hexdigest()))
+
+
+@dataclass
+class CachedManifest:
+    """Product manifest without the token and the digest of its inputs"""
+
+    manifest: ProductManifest
+    digest: str
+
+
+def etag_matches(request: web.Request, etag: str) -> bool:
+    """Check If-None-Match using the weak comparison"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    wanted = etag.removeprefix("W/")
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == wanted:
+            return True
+    return False
+
+
+class ManifestServer:
+    """Keeps the manifests and the issuer in memory and serves them"""
+
+    def __init__(self, config: Optional[MWConfig] = None) -> None:
+        self.config = config if config is not None else MWConfig.singleton()
+        self.issuer: Optional[Issuer] = None
+        self.pubkey = CachedFile()
+        self.jwks = CachedFile()
+        self.rasenmaeher = CachedFile()
+        self.products: Dict[str, CachedManifest] = {}
+
+    async def refresh(self, config: Optional[MWConfig] = None) -> None:
+        """(Re)build the cache, creates the keypair if needed"""
+        if config is not None:
+            self.config = config
+        config = self.config
+        privkeypath, pubkeypath = await check_create_keypair(config)
+        issuer = load_issuer(privkeypath)
+        issuer.config.lifetime = config.csr_jwt_lifetime
+        pubkey = CachedFile.from_body(pubkeypath.read_bytes())
+        jwks = CachedFile.from_body(load_jwks(pubkeypath.parent))
+        rasenmaeher = CachedFile.from_body(
+            dump_rasenmaeher_manifest(build_rasenmaeher_manifest(config), config.manifest_format)
+        )
+        products: Dict[str, CachedManifest] = {}
+        for productname in config.product_manifest_paths.keys():
+            manifest = build_product_manifest(productname, config)
+            if not manifest:
+                continue
+            digest = manifest_digest(manifest.model_dump(), pubkeypath, config.manifest_format)
+            products[productname] = CachedManifest(manifest=manifest, digest=digest)
+        # Swap everything at once, no awaits from here on
+        self.issuer = issuer
+        self.pubkey = pubkey
+        self.jwks = jwks
+        self.rasenmaeher = rasenmaeher
+        self.products = products
+        LOGGER.info("Serving manifests for {}".format(", ".join(sorted(products.keys())) or "no products"))
+
+    @staticmethod
+    def respond(request: web.Request, etag: str, body: bytes, content_type: str) -> web.Response:
+        """200 with body or 304 if the client has it already"""
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request, etag):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type=content_type, headers=headers)
+
+    async def get_rasenmaeher_manifest(self, request: web.Request) -> web.Response:
+        """kraftwerk-rasenmaeher-init.json"""
+        return self.respond(request, self.rasenmaeher.etag, self.rasenmaeher.body, "application/json")
+
+    def product_etag(self, cached: CachedManifest) -> str:
+        """Weak ETag from the manifest digest and the current token bucket, the bucket changes before
+        a token served in it gets within csr_jwt_renew_before of expiring"""
+        window = max(self.config.csr_jwt_lifetime - self.config.csr_jwt_renew_before, 1)
+        return 'W/"{}-{}"'.format(cached.digest, int(time.time() // window))
+
+    async def get_product_manifest(self, request: web.Request) -> web.Response:
+        """kraftwerk-init.json with a fresh csr_jwt"""
+        cached = self.products.get(request.match_info["productname"])
+        if cached is None:
+            raise web.HTTPNotFound()
+        etag = self.product_etag(cached)
+        if etag_matches(request, etag):
+            return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        issuer = self.issuer
+        assert issuer is not None  # refresh was called
+        manifest = cached.manifest.model_copy(deep=True)
+        manifest.rasenmaeher.init.csr_jwt = await asyncio.get_running_loop().run_in_executor(
+            None, issuer.issue, csr_claims(manifest.product.dns)
+        )
+        return self.respond(
+            request, etag, dump_product_manifest(manifest, self.config.manifest_format), "application/json"
+        )
+
+    def check_name(self, request: web.Request) -> None:
+        """404 unless the path is for RASENMAEHER or a product we have"""
+        name = request.match_info["productname"]
+        if name != "rasenmaeher" and name not in self.products:
+            raise web.HTTPNotFound()
+
+    async def get_pubkey(self, request: web.Request) -> web.Response:
+        """publickeys/kraftwerk.pub"""
+        self.check_name(request)
+        return self.respond(request, self.pubkey.etag, self.pubkey.body, "application/x-pem-file")
+
+    async def get_jwks(self, request: web.Request) -> web.Response:
+        """jwks.json, all the active public keys"""
+        self.check_name(request)
+        return self.respond(request, self.jwks.etag, self.jwks.body, "application/jwk-set+json")
+
+    def make_app(self) -> web.Application:
+        """The aiohttp application, call refresh before serving"""
+        app = web.Application()
+        app.router.add_get("/rasenmaeher/kraftwerk-rasenmaeher-init.json", self.get_rasenmaeher_manifest)
+        app.router.add_get("/{productname}/kraftwerk-init.json", self.get_product_manifest)
+        app.router.add_get("/{productname}/publickeys/kraftwerk.pub", self.get_pubkey)
+        app.router.add_get("/{productname}/jwks.json", self.get_jwks)
+        return app
+
+
+async def run_server(config: Optional[MWConfig] = None) -> int:
+    """Serve until SIGTERM/SIGINT, SIGHUP reloads the config and rebuilds the cache"""
+    if config is None:
+        config = MWConfig.singleton()
+    server = ManifestServer(config)
+    await server.refresh()
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, config.serve_host, config.serve_port)
+    await site.start()
+    LOGGER.info("Listening on {}:{}".format(config.serve_host, config.serve_port))
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    reloads = set()
+
+    async def reload() -> None:
+        """Do the reload"""
+        try:
+            await server.refresh(MWConfig.reload())
+        except ValueError as exc:
+            LOGGER.error("Config reload failed, keeping the old one: {}".format(exc))
+
+    def handle_hup() -> None:
+        """Handle SIGHUP"""
+        LOGGER.info("Got SIGHUP, reloading config")
+        task = asyncio.create_task(reload())
+        reloads.add(task)
+        task.add_done_callback(reloads.discard)
+
+    def shutdown() -> None:
+        """Handle SIGTERM/SIGINT"""
+        LOGGER.info("Stopping")
+        stop.set()
+
+    loop.add_signal_handler(signal.SIGHUP, handle_hup)
+    loop.add_signal_handler(signal.SIGTERM, shutdown)
+    loop.add_signal_handler(signal.SIGINT, shutdown)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+    return 0
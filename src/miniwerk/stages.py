@@ -0,0 +1,102 @@
+"""Run the init stages concurrently while respecting dependencies between them"""
+
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Sequence
+from dataclasses import dataclass, field
+import asyncio
+import contextlib
+import json
+import logging
+from pathlib import Path
+
+from .config import MWConfig
+from .helpers import write_if_changed
+from .report import RunReport, StageRecord, measure, reporting, to_prometheus
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    """A named unit of work, it starts as soon as all stages it depends on are done"""
+
+    name: str
+    func: Callable[[], Awaitable[Any]]
+    depends: Sequence[str] = field(default_factory=tuple)
+
+
+async def run_stages(stages: Sequence[Stage]) -> Dict[str, float]:
+    """Run the stages, returns wall-clock seconds per stage keyed by name.
+
+    Dependencies must be listed before the stages that depend on them (which also rules out cycles),
+    if any stage fails the rest are cancelled and the failures are raised as ExceptionGroup."""
+    seen: set[str] = set()
+    for stage in stages:
+        if stage.name in seen:
+            raise ValueError("Duplicate stage {}".format(stage.name))
+        for dep in stage.depends:
+            if dep not in seen:
+                raise ValueError("Stage {} depends on {} which is not defined before it".format(stage.name, dep))
+        seen.add(stage.name)
+
+    tasks: Dict[str, "asyncio.Task[Any]"] = {}
+    records: Dict[str, StageRecord] = {}
+
+    async def run(stage: Stage) -> Any:
+        """Wait for dependencies and run the stage"""
+        await asyncio.gather(*(tasks[dep] for dep in stage.depends))
+        LOGGER.debug("Starting stage {}".format(stage.name))
+        with measure(stage.name) as records[stage.name]:
+            ret = await stage.func()
+        LOGGER.debug("Stage {} took {:.3f}s".format(stage.name, records[stage.name].wall))
+        return ret
+
+    async with asyncio.TaskGroup() as tgroup:
+        for stage in stages:
+            tasks[stage.name] = tgroup.create_task(run(stage), name=stage.name)
+    return {name: record.wall for name, record in records.items()}
+
+
+def log_stage_summary(timings: Dict[str, float], total: float) -> None:
+    """Log the per-stage timings"""
+    LOGGER.info("Stage timings:")
+    width = max((len(name) for name in timings), default=0)
+    for name, took in timings.items():
+        LOGGER.info("  {}  {:8.3f}s".format(name.ljust(width), took))
+    LOGGER.info("  {}  {:8.3f}s".format("total (wall)".ljust(width), total))
+
+
+def write_report_files(report: RunReport, report_path: Optional[Path], metrics_textfile: Optional[Path]) -> None:
+    """Write the report as JSON to report_path and in Prometheus format to metrics_textfile, None skips"""
+    if report_path:
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        write_if_changed(report_path, json.dumps(report.to_dict(), indent=2).encode("utf-8"))
+    if metrics_textfile:
+        metrics_textfile.parent.mkdir(parents=True, exist_ok=True)
+        write_if_changed(metrics_textfile, to_prometheus(report).encode("utf-8"), mode=0o644)
+
+
+def save_run_report(report: RunReport, config: Optional[MWConfig] = None) -> None:
+    """Write the report to report_path and metrics_textfile if they are configured"""
+    if config is None:
+        config = MWConfig.singleton()
+    write_report_files(report, config.report_path, config.metrics_textfile)
+
+
+@contextlib.contextmanager
+def reported_run(command: str, config: Optional[MWConfig] = None) -> Iterator[RunReport]:
+    """Collect a report of the block and save it when done (also on failure)"""
+    try:
+        with reporting(command) as report:
+            yield report
+    finally:
+        save_run_report(report, config)
+
+
+@contextlib.contextmanager
+def reported_to(command: str, report_path: Optional[Path], metrics_textfile: Optional[Path]) -> Iterator[RunReport]:
+    """Like reported_run but with explicit paths, for runs that have no single config (batch)"""
+    try:
+        with reporting(command) as report:
+            yield report
+    finally:
+        write_report_files(report, report_path, metrics_textfile)
@@ -1,14 +1,18 @@
 """pytest automagics"""
 
-from typing import Generator
+from typing import Generator, Callable, Sequence
+import datetime
 import logging
 from pathlib import Path
 
 import pytest
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 from libadvian.logging import init_logging
 from libadvian.testhelpers import nice_tmpdir_ses, monkeysession  # pylint: disable=W0611
 
-
 init_logging(logging.DEBUG)
 LOGGER = logging.getLogger(__name__)
 
@@ -26,3 +30,42 @@ def default_env(monkeysession: pytest.MonkeyPatch, nice_tmpdir_ses: str) -> Gene
         mpatch.setenv("MW_DOMAIN", "pytest.pvarki.fi")
         mpatch.setenv("MW_LE_EMAIL", "example@example.com")
         yield None
+
+
+CertFactory = Callable[[Path, Sequence[str], int], Path]
+
+
+@pytest.fixture(scope="session")
+def selfsigned_cert() -> CertFactory:
+    """Returns factory for writing self-signed cert (fullchain.pem + privkey.pem) for names valid for days"""
+
+    def factory(certdir: Path, names: Sequence[str], days: int) -> Path:
+        """Write the cert, return path to fullchain.pem"""
+        key = ec.generate_private_key(ec.SECP256R1())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, names[0])])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=days))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(name) for name in names]), critical=False)
+            .sign(key, hashes.SHA256())
+        )
+        certdir.mkdir(parents=True, exist_ok=True)
+        certpem = cert.public_bytes(serialization.Encoding.PEM)
+        (certdir / "cert.pem").write_bytes(certpem)
+        (certdir / "fullchain.pem").write_bytes(certpem)
+        (certdir / "privkey.pem").write_bytes(
+            key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption(),
+            )
+        )
+        return certdir / "fullchain.pem"
+
+    return factory
@@ -0,0 +1,234 @@
+"""Test the in-process ACME engine, offline against a stub client and against Pebble
+(https://github.com/letsencrypt/pebble)
+
+The Pebble test is skipped unless MW_TEST_PEBBLE_DIRECTORY is set, for example run pebble-challtestsrv and
+``pebble -dnsserver 127.0.0.1:8053`` and then::
+
+    MW_TEST_PEBBLE_DIRECTORY=https://localhost:14000/dir py.test tests/test_acmewrap.py
+
+Pebble validates HTTP-01 on port 5002 by default, MW_TEST_PEBBLE_HTTP_PORT changes the port we listen on"""
+
+from typing import Any, List, Optional, Set, Tuple
+import asyncio
+import datetime
+import logging
+import os
+from pathlib import Path
+
+import pytest
+from cryptography import x509
+
+from miniwerk.config import MWConfig, CertSharding, KeyType, LEEngine
+from miniwerk.helpers import cert_needs_renewal
+from miniwerk.lewrap import get_le_certs
+from miniwerk.localca import create_ca, issue_cert
+
+from .conftest import CertFactory
+
+try:
+    from acme import challenges, messages, standalone
+    from miniwerk import acmewrap  # pylint: disable=C0412
+except (ImportError, AttributeError) as exc:  # acme/josepy break with pyOpenSSL newer than the locked one
+    pytest.skip("acme is not importable: {}".format(exc), allow_module_level=True)
+
+LOGGER = logging.getLogger(__name__)
+PEBBLE_DIRECTORY = os.environ.get("MW_TEST_PEBBLE_DIRECTORY")
+
+
+class StubACME:
+    """Stands in for acme.client.ClientV2, certs come from a local CA"""
+
+    def __init__(self, caroot: Path) -> None:
+        self.caroot = caroot
+        self.orders: List[List[str]] = []
+        self.answered: List[str] = []
+
+    def new_account(self, newreg: messages.NewRegistration) -> messages.RegistrationResource:
+        """Register"""
+        assert newreg.terms_of_service_agreed
+        return messages.RegistrationResource(uri="https://acme.invalid/acct/1", body=messages.Registration())
+
+    def new_order(self, csr_pem: bytes) -> messages.OrderResource:
+        """Order with pending HTTP-01 challenge for each name in the CSR"""
+        csr = x509.load_pem_x509_csr(csr_pem)
+        names = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(
+            x509.DNSName
+        )
+        self.orders.append(names)
+        authzrs = [
+            messages.AuthorizationResource(
+                uri=f"https://acme.invalid/authz/{name}",
+                body=messages.Authorization(
+                    identifier=messages.Identifier(typ=messages.IDENTIFIER_FQDN, value=name),
+                    status=messages.STATUS_PENDING,
+                    challenges=[
+                        messages.ChallengeBody(
+                            chall=challenges.HTTP01(token=os.urandom(32)),
+                            uri=f"https://acme.invalid/chall/{name}",
+                            status=messages.STATUS_PENDING,
+                        )
+                    ],
+                ),
+            )
+            for name in names
+        ]
+        return messages.OrderResource(body=messages.Order(), authorizations=authzrs, csr_pem=csr_pem)
+
+    def answer_challenge(self, challb: messages.ChallengeBody, response: challenges.ChallengeResponse) -> None:
+        """Record the answer"""
+        assert isinstance(response, challenges.HTTP01Response)
+        self.answered.append(challb.uri)
+
+    def poll_and_finalize(self, orderr: messages.OrderResource, deadline: datetime.datetime) -> Any:
+        """Issue the cert"""
+        assert deadline > datetime.datetime.now()
+        names = [authzr.body.identifier.value for authzr in orderr.authorizations]
+        certpem, _ = issue_cert(self.caroot, names, KeyType.ECDSA)
+        return orderr.update(fullchain_pem=(certpem + (self.caroot / "rootCA.pem").read_bytes()).decode("utf-8"))
+
+
+class StubServers:
+    """Stands in for the HTTP-01 responder"""
+
+    instances: List["StubServers"] = []
+
+    def __init__(self, address: Tuple[str, int], resources: Set[Any]) -> None:
+        self.address = address
+        self.resources = resources
+        self.running = False
+        StubServers.instances.append(self)
+
+    def serve_forever(self) -> None:
+        """Start"""
+        self.running = True
+
+    def shutdown_and_server_close(self) -> None:
+        """Stop"""
+        self.running = False
+
+
+# pylint: disable=W0621
+
+
+@pytest.fixture
+def stub(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> StubACME:
+    """Stub client and responder in place of the real ones"""
+    create_ca(tmp_path / "ca")
+    stub = StubACME(tmp_path / "ca")
+
+    def make_client(config: MWConfig, account_key: Any, regr: Optional[messages.RegistrationResource] = None) -> Any:
+        """Return the stub"""
+        assert config.acme_path.exists()
+        assert account_key is not None
+        LOGGER.debug("regr={}".format(regr))
+        return stub
+
+    monkeypatch.setattr(acmewrap, "make_client", make_client)
+    monkeypatch.setattr(standalone, "HTTP01DualNetworkedServers", StubServers)
+    StubServers.instances.clear()
+    return stub
+
+
+@pytest.mark.asyncio
+async def test_offline(tmp_path: Path, stub: StubACME) -> None:
+    """Order all the lineages through one responder, concurrent callers wait for the lock and do not re-order"""
+    config = MWConfig(  # type: ignore[call-arg]
+        CI=False,
+        le_engine=LEEngine.ACME,
+        acme_http_port=8402,
+        cert_sharding=CertSharding.PRODUCT,
+        products="fake",
+        data_path=tmp_path / "data",
+    )
+    await asyncio.gather(acmewrap.get_acme_certs(config), acmewrap.get_acme_certs(config))
+    assert sorted(stub.orders) == sorted(list(fqdns) for fqdns in config.cert_lineages.values())
+    assert len(stub.answered) == sum(len(fqdns) for fqdns in config.cert_lineages.values())
+    assert len(StubServers.instances) == 1
+    assert StubServers.instances[0].address == ("", 8402)
+    assert len(StubServers.instances[0].resources) == len(stub.answered)
+    assert not StubServers.instances[0].running
+    for lineage, fqdns in config.cert_lineages.items():
+        livedir = config.le_lineage_dir(lineage)
+        assert not cert_needs_renewal(livedir / "fullchain.pem", fqdns, 0)
+        assert (livedir / "privkey.pem").stat().st_mode & 0o777 == 0o600
+        assert (livedir / "chain.pem").read_bytes() == (tmp_path / "ca" / "rootCA.pem").read_bytes()
+    assert len(list(config.acme_path.glob("regr-*.json"))) == 1
+
+    await acmewrap.get_acme_certs(config)
+    assert len(stub.orders) == len(config.cert_lineages)
+
+
+@pytest.mark.asyncio
+async def test_certbot_lineage_untouched(tmp_path: Path, stub: StubACME, selfsigned_cert: CertFactory) -> None:
+    """Certbot's symlinked lineage is left as it is, the acme engine uses its own live dir"""
+    config = MWConfig(  # type: ignore[call-arg]
+        CI=False,
+        le_engine=LEEngine.ACME,
+        acme_http_port=8402,
+        data_path=tmp_path / "data",
+        le_copy_path=tmp_path / "le_certs",
+    )
+    lineage = config.le_cert_name
+    # Same layout as certbot: live/ has symlinks to the latest version in archive/
+    archive = config.le_config_path / "archive" / lineage
+    selfsigned_cert(archive, config.fqdns, 1)
+    (archive / "chain.pem").write_bytes((archive / "cert.pem").read_bytes())
+    certbot_live = config.le_config_path / "live" / lineage
+    certbot_live.mkdir(parents=True)
+    for name in ("cert", "chain", "fullchain", "privkey"):
+        (archive / f"{name}.pem").rename(archive / f"{name}1.pem")
+        (certbot_live / f"{name}.pem").symlink_to(Path("..", "..", "archive", lineage, f"{name}1.pem"))
+    (config.le_config_path / "renewal").mkdir()
+    (config.le_config_path / "renewal" / f"{lineage}.conf").write_text(
+        f"archive_dir = {archive}\ncert = {certbot_live / 'cert.pem'}\n", encoding="utf-8"
+    )
+    archived = {pth.name: pth.read_bytes() for pth in archive.iterdir()}
+
+    await get_le_certs(config)
+    assert len(stub.orders) == 1
+    livedir = config.le_lineage_dir(lineage)
+    assert livedir == config.acme_path / "live" / lineage
+    assert not cert_needs_renewal(livedir / "fullchain.pem", config.fqdns, 0)
+    for name in ("cert", "chain", "fullchain", "privkey"):
+        assert (certbot_live / f"{name}.pem").is_symlink()
+        assert (certbot_live / f"{name}.pem").readlink() == Path("..", "..", "archive", lineage, f"{name}1.pem")
+    assert {pth.name: pth.read_bytes() for pth in archive.iterdir()} == archived
+    assert (config.le_copy_path / lineage / "fullchain.pem").read_bytes() == (livedir / "fullchain.pem").read_bytes()
+    # Switching back finds certbot's lineage as it was
+    config.le_engine = LEEngine.CERTBOT
+    assert config.le_lineage_dir(lineage) == certbot_live
+    assert config.le_cert_dir == certbot_live
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not PEBBLE_DIRECTORY, reason="MW_TEST_PEBBLE_DIRECTORY not set")
+async def test_pebble(tmp_path: Path) -> None:
+    """Get certs for two lineages concurrently, then reuse the account without ordering again"""
+    get_acme_certs = acmewrap.get_acme_certs
+
+    config = MWConfig(  # type: ignore[call-arg]
+        CI=False,
+        le_engine=LEEngine.ACME,
+        acme_directory=PEBBLE_DIRECTORY,
+        acme_http_port=int(os.environ.get("MW_TEST_PEBBLE_HTTP_PORT", "5002")),
+        acme_verify_ssl=False,
+        cert_sharding=CertSharding.PRODUCT,
+        products="fake",
+        data_path=tmp_path / "data",
+    )
+    await get_acme_certs(config)
+    assert len(config.cert_lineages) == 2
+    for lineage, fqdns in config.cert_lineages.items():
+        livedir = config.le_lineage_dir(lineage)
+        assert not cert_needs_renewal(livedir / "fullchain.pem", fqdns, 0)
+        assert (livedir / "privkey.pem").stat().st_mode & 0o777 == 0o600
+        assert (livedir / "chain.pem").read_bytes()
+    regrs = list(config.acme_path.glob("regr-*.json"))
+    assert len(regrs) == 1
+    fullchains = {
+        lineage: (config.le_lineage_dir(lineage) / "fullchain.pem").read_bytes() for lineage in config.cert_lineages
+    }
+
+    await get_acme_certs(config)
+    for lineage, fullchain in fullchains.items():
+        assert (config.le_lineage_dir(lineage) / "fullchain.pem").read_bytes() == fullchain
@@ -0,0 +1,118 @@
+"""Test the multi-deployment batch mode"""
+
+from typing import Any, Dict, List
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+import pytest
+from libadvian.binpackers import ensure_str
+
+from miniwerk.batch import load_deployments, run_batch
+from miniwerk.config import MWConfig
+
+from .conftest import CertFactory
+
+LOGGER = logging.getLogger(__name__)
+
+
+def deployments(tmp_path: Path, count: int) -> List[Dict[str, Any]]:
+    """Config objects with separate dirs, the last one uses external certs"""
+    ret: List[Dict[str, Any]] = []
+    for idx in range(count):
+        base = tmp_path / f"dep{idx}"
+        ret.append(
+            {
+                "domain": f"dep{idx}.pytest.pvarki.fi",
+                "data_path": str(base / "data"),
+                "manifests_base": str(base / "pvarkishares"),
+                "le_copy_path": str(base / "le_certs"),
+                "products": "fake",
+                "extcert": idx == count - 1,
+            }
+        )
+    return ret
+
+
+@pytest.mark.asyncio
+async def test_run_batch(tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """Provision deployments concurrently, each gets its own keys, manifests and certs"""
+    singleton = MWConfig._singleton  # pylint: disable=W0212
+    batchfile = tmp_path / "batch.json"
+    batchfile.write_text(json.dumps(deployments(tmp_path, 3)), encoding="utf-8")
+    configs = load_deployments(batchfile)
+    for config in configs[:-1]:
+        selfsigned_cert(config.le_cert_dir, config.fqdns, 90)
+    results = await run_batch(configs, workers=2)
+    LOGGER.debug("results={}".format(results))
+    assert [result.domain for result in results] == [config.domain for config in configs]
+    assert not any(result.error for result in results)
+    pubkeys = set()
+    for config in configs:
+        manifest = json.loads((config.manifests_base / "fake" / "kraftwerk-init.json").read_text(encoding="utf-8"))
+        assert manifest["product"]["dns"] == f"fake.{config.domain}"
+        assert not (config.manifests_base / "tak").exists()
+        pubkeys.add((config.data_path / "publickeys" / "kraftwerk.pub").read_bytes())
+    assert len(pubkeys) == 3
+    assert (configs[0].le_copy_path / "rasenmaeher" / "fullchain.pem").exists()
+    assert not (configs[-1].le_copy_path / "rasenmaeher").exists()
+    # The singleton is not touched by any of this
+    assert MWConfig._singleton is singleton  # pylint: disable=W0212
+
+
+@pytest.mark.asyncio
+async def test_failure_isolated(tmp_path: Path) -> None:
+    """One failing deployment does not stop the others"""
+    configs = [MWConfig(**item) for item in deployments(tmp_path, 2)]
+    # No cert for the Let's Encrypt one, CI mode skips certbot so copying fails
+    results = await run_batch(configs)
+    assert results[0].error
+    assert not results[1].error
+    assert (configs[1].manifests_base / "fake" / "kraftwerk-init.json").exists()
+    # The failed deployment finished its manifests before the error was reported
+    assert (configs[0].manifests_base / "fake" / "kraftwerk-init.json").exists()
+
+
+def test_shared_paths(tmp_path: Path) -> None:
+    """Deployments must not share dirs"""
+    items = deployments(tmp_path, 2)
+    items[1]["data_path"] = items[0]["data_path"]
+    batchfile = tmp_path / "batch.json"
+    batchfile.write_text(json.dumps(items), encoding="utf-8")
+    with pytest.raises(ValueError, match="data_path"):
+        load_deployments(batchfile)
+    batchfile.write_text(json.dumps({"domain": "foo"}), encoding="utf-8")
+    with pytest.raises(ValueError, match="list"):
+        load_deployments(batchfile)
+
+
+@pytest.mark.asyncio
+async def test_batch_cli(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Run via the CLI without the single deployment config in the environment, report and metrics are written"""
+    items = deployments(tmp_path, 2)
+    items[0]["extcert"] = True
+    for item in items:
+        item["le_email"] = "example@example.com"
+    batchfile = tmp_path / "batch.json"
+    batchfile.write_text(json.dumps(items), encoding="utf-8")
+    metricspath = tmp_path / "miniwerk.prom"
+    with monkeypatch.context() as mpatch:
+        mpatch.delenv("MW_DOMAIN")
+        mpatch.delenv("MW_LE_EMAIL")
+        mpatch.setenv("MW_METRICS_TEXTFILE", str(metricspath))
+        process = await asyncio.create_subprocess_shell(
+            f"miniwerk batch {batchfile} --report-path {tmp_path / 'report.json'}",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        out = await asyncio.wait_for(process.communicate(), 60)
+    LOGGER.debug("stderr={}".format(ensure_str(out[1])))
+    assert process.returncode == 0
+    lines = ensure_str(out[0]).splitlines()
+    assert lines[0].startswith("dep0.pytest.pvarki.fi OK")
+    assert lines[1].startswith("dep1.pytest.pvarki.fi OK")
+    assert json.loads((tmp_path / "report.json").read_text(encoding="utf-8"))["command"] == "batch"
+    series = [line.rsplit(" ", 1)[0] for line in metricspath.read_text(encoding="utf-8").splitlines()]
+    series = [name for name in series if not name.startswith("#")]
+    assert len(series) == len(set(series))
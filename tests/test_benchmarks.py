@@ -0,0 +1,197 @@
+"""Benchmarks for the hot paths, compared against stored baselines to catch regressions
+
+Skipped unless MW_BENCHMARK=1 since timings depend on the machine, run them on the one the baselines
+were recorded on. Runs offline (CI mode), set MW_BENCHMARK_SAVE=1 to store the medians as new baselines and
+MW_BENCHMARK_TOLERANCE (default 5.0) to change how many times slower than baseline is still ok,
+ABS_SLACK keeps the microsecond-scale ones from flaking on scheduler noise"""
+
+from typing import Any, Awaitable, Callable, Dict, Generator, List, Optional
+import json
+import logging
+import os
+import statistics
+import time
+import uuid
+from pathlib import Path
+
+import pytest
+from pydantic import create_model
+
+from miniwerk.config import MWConfig, ProductSettings, KeyType
+from miniwerk.helpers import certs_copy
+from miniwerk.jwt import check_create_keypair, get_issuer
+from miniwerk.manifests import create_all_product_manifests
+
+from .conftest import CertFactory
+
+LOGGER = logging.getLogger(__name__)
+BASELINES_PATH = Path(__file__).parent / "benchmark_baselines.json"
+TOLERANCE = float(os.environ.get("MW_BENCHMARK_TOLERANCE", "5.0"))
+SAVE = os.environ.get("MW_BENCHMARK_SAVE", "") == "1"
+ABS_SLACK = 0.01
+pytestmark = pytest.mark.skipif(
+    os.environ.get("MW_BENCHMARK", "") != "1" and not SAVE, reason="benchmarks are opt-in, set MW_BENCHMARK=1"
+)
+
+# pylint: disable=W0621,W0212
+
+
+class Bench:
+    """Time things and compare the median to the stored baseline"""
+
+    def __init__(self) -> None:
+        self.baselines: Dict[str, float] = {}
+        if BASELINES_PATH.exists():
+            self.baselines = json.loads(BASELINES_PATH.read_text(encoding="utf-8"))
+        self.results: Dict[str, float] = {}
+
+    def check(self, name: str, timings: List[float], compare: bool = True) -> float:
+        """Record the median and compare to baseline"""
+        median = statistics.median(timings)
+        self.results[name] = float("{:.6g}".format(median))
+        baseline = self.baselines.get(name)
+        LOGGER.info(
+            "benchmark {}: median {:.6f}s (baseline {}) over {} rounds".format(name, median, baseline, len(timings))
+        )
+        if compare and baseline is not None and not SAVE:
+            assert median <= baseline * TOLERANCE + ABS_SLACK, "{} took {:.6f}s, baseline {:.6f}s".format(
+                name, median, baseline
+            )
+        return median
+
+    def run(
+        self, name: str, func: Callable[[], Any], rounds: int = 5, setup: Optional[Callable[[], Any]] = None
+    ) -> float:
+        """Run func rounds times"""
+        timings: List[float] = []
+        for _ in range(rounds):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return self.check(name, timings)
+
+    async def arun(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Any]],
+        rounds: int = 5,
+        setup: Optional[Callable[[], Any]] = None,
+        compare: bool = True,
+    ) -> float:
+        """Run the coroutine function rounds times, compare=False only records the result"""
+        timings: List[float] = []
+        for _ in range(rounds):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            await func()
+            timings.append(time.perf_counter() - started)
+        return self.check(name, timings, compare)
+
+
+@pytest.fixture(scope="module")
+def bench() -> Generator[Bench, None, None]:
+    """Shared benchmark state, saves baselines at the end if asked to"""
+    state = Bench()
+    yield state
+    if SAVE:
+        merged = {**state.baselines, **state.results}
+        BASELINES_PATH.write_text(json.dumps(merged, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+
+
+@pytest.fixture(autouse=True)
+def restore_singleton() -> Generator[None, None, None]:
+    """Put the original config singleton back after each test (other test modules check it)"""
+    orig = MWConfig._singleton
+    yield None
+    MWConfig._singleton = orig
+
+
+def many_products_config(count: int, **kwargs: Any) -> MWConfig:
+    """Config with count products, each with its own settings field"""
+    names = [f"product{idx}" for idx in range(count)]
+    fields: Dict[str, Any] = {
+        name: (ProductSettings, ProductSettings(api_host=name, user_host=name, api_port=4626, user_port=4626))
+        for name in names
+    }
+    model = create_model("BenchConfig", __base__=MWConfig, **fields)
+    return model(products=",".join(names), **kwargs)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("count", [1, 10, 100])
+async def test_bench_product_manifests(bench: Bench, tmp_path: Path, count: int) -> None:
+    """Create all product manifests from scratch"""
+    await check_create_keypair()  # keep keygen out of this one
+
+    def setup() -> None:
+        """Fresh manifests dir so everything gets written"""
+        MWConfig._singleton = many_products_config(count, manifests_base=tmp_path / uuid.uuid4().hex)
+
+    async def func() -> None:
+        """Do it"""
+        assert len(await create_all_product_manifests()) == count
+
+    await bench.arun(f"product_manifests_{count}", func, rounds=3, setup=setup)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("keytype", [KeyType.ECDSA, KeyType.RSA])
+async def test_bench_keypair(bench: Bench, tmp_path: Path, keytype: KeyType) -> None:
+    """Keypair check when the keys need to be generated and when they exist"""
+
+    def setup() -> None:
+        """Fresh data dir so the keys get generated"""
+        MWConfig._singleton = MWConfig(  # type: ignore[call-arg]
+            data_path=tmp_path / uuid.uuid4().hex, jwt_keytype=keytype
+        )
+
+    # RSA prime search time varies too much to compare one round against a baseline
+    await bench.arun(
+        f"keypair_cold_{keytype.value}", check_create_keypair, rounds=1, setup=setup, compare=keytype != KeyType.RSA
+    )
+    await bench.arun(f"keypair_warm_{keytype.value}", check_create_keypair, rounds=20)
+
+
+@pytest.mark.asyncio
+async def test_bench_jwt_issue(bench: Bench) -> None:
+    """Token issuance with the cached issuer"""
+    tokens = 100
+
+    async def func() -> None:
+        """Issue a batch"""
+        issuer = await get_issuer()
+        for idx in range(tokens):
+            issuer.issue({"sub": f"bench{idx}", "csr": True})
+
+    await bench.arun(f"jwt_issue_{tokens}", func)
+
+
+def test_bench_fqdns(bench: Bench) -> None:
+    """FQDN table computation and cached access"""
+    config = many_products_config(30, subdomains="mtls,api,www")
+
+    def invalidate() -> None:
+        """Assigning a field drops the cached tables"""
+        config.subdomains = "mtls,api,www"
+
+    bench.run("fqdns_cold_30x3", lambda: config.fqdns, rounds=20, setup=invalidate)
+    bench.run("fqdns_warm_30x3", lambda: config.fqdns, rounds=20)
+
+
+def test_bench_certs_copy(bench: Bench, tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """Copy a large chain to a fresh dir and then to a dir where nothing changed"""
+    sourcedir = tmp_path / "source"
+    selfsigned_cert(sourcedir, ["bench.pvarki.fi"], 90)
+    chain = (sourcedir / "fullchain.pem").read_bytes()
+    (sourcedir / "fullchain.pem").write_bytes(chain * 200)
+    copydirs: List[Path] = []
+
+    def setup() -> None:
+        """New target"""
+        copydirs.append(tmp_path / uuid.uuid4().hex)
+
+    bench.run("certs_copy_cold", lambda: certs_copy(copydirs[-1], sourcedir), setup=setup)
+    bench.run("certs_copy_unchanged", lambda: certs_copy(copydirs[-1], sourcedir))
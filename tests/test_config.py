@@ -67,3 +67,78 @@ def test_kc_in_fqdns() -> None:
     """Test the singleton fetcher"""
     cfg = MWConfig.singleton()
     assert f"kc.{cfg.domain}" in cfg.fqdns
+
+
+def test_copy_targets_env(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Copy targets from env JSON"""
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_COPY_TARGETS", '[{"path": "/tak_certs", "file_mode": "0640", "gid": 1000}]')
+        # Generic variables must not leak into the targets
+        mpatch.setenv("UID", "4242")
+        mpatch.setenv("GID", "4343")
+        mpatch.setenv("FILE_MODE", "777")
+        cfg = MWConfig()  # type: ignore[call-arg]
+        targets = cfg.cert_copy_targets
+        assert len(targets) == 2
+        assert targets[0].path == cfg.le_copy_path / cfg.le_cert_name
+        assert str(targets[1].path) == "/tak_certs"
+        assert targets[1].file_mode == 0o640
+        assert targets[1].gid == 1000
+        assert targets[1].uid is None
+        assert targets[0].uid is None
+        assert targets[0].gid is None
+        assert targets[0].file_mode == 0o600
+
+
+def test_derived_memoized() -> None:
+    """Derived tables are computed once and recomputed when fields change"""
+    cfg = MWConfig()  # type: ignore[call-arg]
+    fqdns = cfg.fqdns
+    assert cfg.fqdns is fqdns
+    paths = cfg.product_manifest_paths
+    assert cfg.product_manifest_paths is paths
+    assert "tak" in cfg.product_manifest_paths
+    cfg.products = "fake, tak,fake,"
+    assert cfg.product_names == ("fake", "tak")
+    assert "tak.pytest.pvarki.fi" in cfg.fqdns
+    assert "bl.pytest.pvarki.fi" not in cfg.fqdns
+    assert len(cfg.fqdns) == len(set(cfg.fqdns))
+    assert set(cfg.product_manifest_paths.keys()) == {"fake", "tak"}
+
+
+def test_invalid_names(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Invalid product/subdomain names fail at load time"""
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_PRODUCTS", "fake,not valid")
+        with pytest.raises(ValueError):
+            MWConfig()  # type: ignore[call-arg]
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_SUBDOMAINS", "-mtls")
+        with pytest.raises(ValueError):
+            MWConfig()  # type: ignore[call-arg]
+
+
+def test_cert_lineages(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Names are sharded per product when needed"""
+    cfg = MWConfig()  # type: ignore[call-arg]
+    assert dict(cfg.cert_lineages) == {"rasenmaeher": cfg.fqdns}
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_CERT_SHARDING", "product")
+        cfg = MWConfig()  # type: ignore[call-arg]
+        lineages = cfg.cert_lineages
+        assert list(lineages.keys())[0] == "rasenmaeher"
+        assert set(lineages["rasenmaeher"]) == {
+            "mtls.pytest.pvarki.fi",
+            "pytest.pvarki.fi",
+            "kc.pytest.pvarki.fi",
+            "mtls.kc.pytest.pvarki.fi",
+        }
+        assert lineages["rasenmaeher-tak"] == ("tak.pytest.pvarki.fi", "mtls.tak.pytest.pvarki.fi")
+        assert sorted(fqdn for names in lineages.values() for fqdn in names) == sorted(cfg.fqdns)
+        assert cfg.lineage_copy_targets("rasenmaeher-tak")[0].path == cfg.le_copy_path / "rasenmaeher-tak"
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_PRODUCTS", ",".join(f"product{idx}" for idx in range(60)))
+        cfg = MWConfig()  # type: ignore[call-arg]
+        assert len(cfg.fqdns) > 100
+        assert len(cfg.cert_lineages) == 61
+        assert all(len(names) <= 100 for names in cfg.cert_lineages.values())
@@ -1,12 +1,20 @@
 """Test CLI scripts"""
 
+from typing import Dict
 import asyncio
+import json
+import sys
 
 import pytest
 from libadvian.binpackers import ensure_str
 
 from miniwerk import __version__
 
+# Things that must not be imported just to parse the CLI
+HEAVY_MODULES = ("multikeyjwt", "cryptography", "jwt", "pydantic", "pydantic_settings", "libadvian.binpackers")
+# Cumulative import time budget for miniwerk.console in microseconds, generous on purpose so slow CI won't flake
+IMPORT_BUDGET_US = 300_000
+
 
 @pytest.mark.asyncio
 async def test_version_cli():  # type: ignore
@@ -22,3 +30,101 @@ async def test_version_cli():  # type: ignore
     assert process.returncode == 0
     # Check output
     assert ensure_str(out[0]).strip().endswith(__version__)
+
+
+@pytest.mark.asyncio
+async def test_fqdns_cli(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test the fqdns listing and the Let's Encrypt limit check"""
+    cmd = "miniwerk fqdns"
+    process = await asyncio.create_subprocess_shell(
+        cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out = await asyncio.wait_for(process.communicate(), 10)
+    assert process.returncode == 0
+    assert "kc.pytest.pvarki.fi" in ensure_str(out[0]).splitlines()
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_PRODUCTS", ",".join(f"product{idx}" for idx in range(60)))
+        process = await asyncio.create_subprocess_shell(
+            cmd + " --lineages",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        out = await asyncio.wait_for(process.communicate(), 10)
+        assert process.returncode == 0
+        assert "rasenmaeher-product0 product0.pytest.pvarki.fi" in ensure_str(out[0]).splitlines()
+
+        mpatch.setenv("MW_CERT_SHARDING", "single")
+        process = await asyncio.create_subprocess_shell(
+            cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        out = await asyncio.wait_for(process.communicate(), 10)
+        assert process.returncode == 1
+        assert "at most 100" in ensure_str(out[1])
+
+
+@pytest.mark.asyncio
+async def test_tokens_cli() -> None:
+    """Mint tokens for subjects from args and stdin"""
+    process = await asyncio.create_subprocess_shell(
+        "miniwerk tokens -n 2 -f - fake.pytest.pvarki.fi",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out = await asyncio.wait_for(process.communicate(b"tak.pytest.pvarki.fi\n\n"), 30)
+    assert process.returncode == 0
+    lines = [json.loads(line) for line in ensure_str(out[0]).splitlines()]
+    assert [line["sub"] for line in lines] == ["fake.pytest.pvarki.fi"] * 2 + ["tak.pytest.pvarki.fi"] * 2
+    assert all(line["csr_jwt"] for line in lines)
+
+
+@pytest.mark.asyncio
+async def test_verify_cli() -> None:
+    """Verify freshly created manifests"""
+    process = await asyncio.create_subprocess_shell(
+        "miniwerk manifests && miniwerk verify",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out = await asyncio.wait_for(process.communicate(), 30)
+    assert process.returncode == 0
+    assert "fake/kraftwerk-init.json OK fake.pytest.pvarki.fi" in ensure_str(out[0])
+
+    process = await asyncio.create_subprocess_shell(
+        f"miniwerk verify --renew-before {3600 * 25}",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    await asyncio.wait_for(process.communicate(), 30)
+    assert process.returncode == 1
+
+
+@pytest.mark.asyncio
+async def test_cli_import_time() -> None:
+    """Make sure --version does not import the heavy stuff and console imports within budget"""
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-X",
+        "importtime",
+        "-c",
+        "from miniwerk.console import cligrp; cligrp(['--version'])",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out = await asyncio.wait_for(process.communicate(), 10)
+    assert process.returncode == 0
+    assert ensure_str(out[0]).strip().endswith(__version__)
+    cumulative: Dict[str, int] = {}
+    for line in ensure_str(out[1]).splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumul, name = line[len("import time:") :].split("|")
+        cumulative[name.strip()] = int(cumul)
+    for modname in cumulative:
+        assert not any(modname == heavy or modname.startswith(heavy + ".") for heavy in HEAVY_MODULES), modname
+    assert cumulative["miniwerk.console"] < IMPORT_BUDGET_US
@@ -0,0 +1,98 @@
+"""Test the daemon mode"""
+
+from typing import Any, List, Set, Tuple
+import asyncio
+import logging
+import os
+import signal
+from pathlib import Path
+
+import pytest
+
+from miniwerk.config import MWConfig
+from miniwerk import daemon
+from miniwerk.daemon import run_daemon, next_check_delay, backoff_delay
+
+from .conftest import CertFactory
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_next_check_delay(monkeypatch: pytest.MonkeyPatch, tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """Delay follows the cert expiry and is clamped"""
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_DATA_PATH", str(tmp_path / "data"))
+        mpatch.setenv("MW_MANIFESTS_BASE", str(tmp_path / "manifests"))
+        mpatch.setenv("MW_MKCERT", "true")
+        mpatch.setenv("MW_DAEMON_JITTER", "0")
+        mpatch.setenv("MW_DAEMON_MAX_INTERVAL", str(3600 * 24 * 365))
+        config = MWConfig()  # type: ignore[call-arg]
+        # No cert, no manifests -> max interval
+        assert next_check_delay(config) == 3600 * 24 * 365
+        selfsigned_cert(config.mk_cert_dir, config.fqdns, 32)
+        delay = next_check_delay(config)
+        # cert expires in ~32 days, renew 30 days before
+        assert 3600 * 24 < delay < 3600 * 24 * 3
+        mpatch.setattr(config, "daemon_max_interval", 3600)
+        assert next_check_delay(config) == 3600
+        mpatch.setattr(config, "daemon_min_interval", 7200)
+        assert next_check_delay(config) == 7200
+        mpatch.setattr(config, "daemon_jitter", 0.5)
+        assert 3600 <= next_check_delay(config) <= 7200
+
+
+@pytest.mark.asyncio
+async def test_daemon_sighup(monkeypatch: pytest.MonkeyPatch) -> None:
+    """SIGHUP wakes the daemon and reloads config"""
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_EXTCERT", "true")
+        orig = MWConfig.reload()
+        task = asyncio.create_task(run_daemon(max_runs=2))
+        await asyncio.sleep(0.5)
+        assert not task.done()
+        os.kill(os.getpid(), signal.SIGHUP)
+        assert await asyncio.wait_for(task, timeout=10) == 0
+        assert MWConfig.singleton() is not orig
+        assert MWConfig.singleton().extcert
+    MWConfig.reload()
+
+
+def test_backoff_delay() -> None:
+    """Doubles from min interval and stops at max interval"""
+    config = MWConfig(daemon_min_interval=60, daemon_max_interval=600)  # type: ignore[call-arg]
+    assert [backoff_delay(config, failures) for failures in range(1, 7)] == [60, 120, 240, 480, 600, 600]
+    assert backoff_delay(config, 1000) == 600
+
+
+@pytest.mark.asyncio
+async def test_daemon_backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Consecutive failures and refreshes that leave something due back off, success resets"""
+    outcomes = ["fail", "fail", "due", "fail", "ok", "fail"]
+    delays: List[float] = []
+
+    async def fake_refresh() -> None:
+        """Fail or not as told"""
+        if outcomes[0] == "fail":
+            raise RuntimeError("certbot returned error")
+
+    def fake_due_in(_config: MWConfig) -> float:
+        """Still due after the refresh unless told ok"""
+        return -1.0 if outcomes[0] == "due" else 3600.0
+
+    async def fake_wait(waiters: Set["asyncio.Task[Any]"], **kwargs: Any) -> Tuple[Set[Any], Set[Any]]:
+        """Do not sleep, record the delay"""
+        delays.append(kwargs["timeout"])
+        outcomes.pop(0)
+        return set(), set(waiters)
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_EXTCERT", "true")
+        mpatch.setenv("MW_DAEMON_JITTER", "0")
+        MWConfig.reload()
+        mpatch.setattr(daemon, "refresh", fake_refresh)
+        mpatch.setattr(daemon, "due_in", fake_due_in)
+        mpatch.setattr(asyncio, "wait", fake_wait)
+        assert await run_daemon(max_runs=6) == 0
+    MWConfig.reload()
+    assert delays[:4] == [60, 120, 240, 480]
+    assert delays[4] > 60  # from next_check_delay
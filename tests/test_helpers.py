@@ -0,0 +1,174 @@
+"""Test the helpers"""
+
+import asyncio
+import logging
+import os
+import stat
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from miniwerk.config import CopyMode, CopyTarget
+from miniwerk.helpers import cert_needs_renewal, certs_copy, certs_copy_targets, run_cmd, call_cmd, file_lock
+
+from .conftest import CertFactory
+
+LOGGER = logging.getLogger(__name__)
+NAMES = ["pytest.pvarki.fi", "mtls.pytest.pvarki.fi"]
+
+
+def test_cert_precheck_valid(tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """Valid cert with same names does not need renewal"""
+    pth = selfsigned_cert(tmp_path, NAMES, 90)
+    assert not cert_needs_renewal(pth, NAMES, 3600 * 24 * 30)
+    assert not cert_needs_renewal(pth, list(reversed(NAMES)), 3600 * 24 * 30)
+
+
+def test_cert_precheck_expiring(tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """Cert expiring soon needs renewal"""
+    pth = selfsigned_cert(tmp_path, NAMES, 10)
+    assert cert_needs_renewal(pth, NAMES, 3600 * 24 * 30)
+
+
+def test_cert_precheck_names(tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """Changed names need renewal"""
+    pth = selfsigned_cert(tmp_path, NAMES, 90)
+    assert cert_needs_renewal(pth, NAMES + ["kc.pytest.pvarki.fi"], 3600 * 24 * 30)
+    assert cert_needs_renewal(pth, NAMES[:1], 3600 * 24 * 30)
+
+
+def test_cert_precheck_missing(tmp_path: Path) -> None:
+    """Missing or broken file needs renewal"""
+    assert cert_needs_renewal(tmp_path / "fullchain.pem", NAMES, 3600)
+    (tmp_path / "fullchain.pem").write_text("not a cert", encoding="utf-8")
+    assert cert_needs_renewal(tmp_path / "fullchain.pem", NAMES, 3600)
+
+
+def make_source(tmp_path: Path) -> Path:
+    """Source dir with certbot-like symlinks"""
+    archive = tmp_path / "archive"
+    archive.mkdir()
+    live = tmp_path / "live"
+    live.mkdir()
+    for name in ("cert", "fullchain", "privkey"):
+        (archive / f"{name}1.pem").write_text(f"{name} data", encoding="utf-8")
+        (live / f"{name}.pem").symlink_to(archive / f"{name}1.pem")
+    (live / "README").write_text("not a pem", encoding="utf-8")
+    return live
+
+
+def test_certs_copy_files(tmp_path: Path) -> None:
+    """Only changed files get written"""
+    source = make_source(tmp_path)
+    copydir = tmp_path / "copy" / "rasenmaeher"
+    assert certs_copy(copydir, source)
+    assert {fpth.name for fpth in copydir.iterdir()} == {"cert.pem", "fullchain.pem", "privkey.pem"}
+    assert not (copydir / "cert.pem").is_symlink()
+    mtimes = {fpth.name: fpth.stat().st_mtime_ns for fpth in copydir.iterdir()}
+    assert not certs_copy(copydir, source)
+    (tmp_path / "archive" / "cert1.pem").write_text("new cert data", encoding="utf-8")
+    assert certs_copy(copydir, source)
+    assert (copydir / "cert.pem").read_text(encoding="utf-8") == "new cert data"
+    assert (copydir / "privkey.pem").stat().st_mtime_ns == mtimes["privkey.pem"]
+    assert not list(copydir.glob(".*"))
+
+
+def test_certs_copy_symlink(tmp_path: Path) -> None:
+    """Directory swap via symlink"""
+    source = make_source(tmp_path)
+    copydir = tmp_path / "copy" / "rasenmaeher"
+    assert certs_copy(copydir, source, CopyMode.SYMLINK)
+    assert copydir.is_symlink()
+    first = copydir.resolve()
+    assert (copydir / "fullchain.pem").read_text(encoding="utf-8") == "fullchain data"
+    assert not certs_copy(copydir, source, CopyMode.SYMLINK)
+    for gen in range(2):
+        (tmp_path / "archive" / "fullchain1.pem").write_text(f"fullchain {gen}", encoding="utf-8")
+        assert certs_copy(copydir, source, CopyMode.SYMLINK)
+    assert (copydir / "fullchain.pem").read_text(encoding="utf-8") == "fullchain 1"
+    # current and previous are kept
+    assert len([fpth for fpth in copydir.parent.iterdir() if fpth.is_dir() and not fpth.is_symlink()]) == 2
+    assert not first.exists()
+
+
+def test_certs_copy_symlink_realdir(tmp_path: Path) -> None:
+    """Existing real dir falls back to file copying"""
+    source = make_source(tmp_path)
+    copydir = tmp_path / "copy" / "rasenmaeher"
+    copydir.mkdir(parents=True)
+    assert certs_copy(copydir, source, CopyMode.SYMLINK)
+    assert not copydir.is_symlink()
+    assert (copydir / "privkey.pem").read_text(encoding="utf-8") == "privkey data"
+
+
+@pytest.mark.asyncio
+async def test_certs_copy_targets(tmp_path: Path) -> None:
+    """Copy to multiple targets with their own modes"""
+    source = make_source(tmp_path)
+    targets = [
+        CopyTarget(path=tmp_path / "one" / "rasenmaeher"),
+        CopyTarget(path=tmp_path / "two" / "certs", file_mode=0o640, dir_mode=0o750, gid=os.getgid()),
+    ]
+    assert await certs_copy_targets(source, targets)
+    assert stat.S_IMODE((tmp_path / "one" / "rasenmaeher" / "privkey.pem").stat().st_mode) == 0o600
+    assert stat.S_IMODE((tmp_path / "two" / "certs").stat().st_mode) == 0o750
+    assert stat.S_IMODE((tmp_path / "two" / "certs" / "privkey.pem").stat().st_mode) == 0o640
+    assert (tmp_path / "two" / "certs" / "cert.pem").read_text(encoding="utf-8") == "cert data"
+    assert not await certs_copy_targets(source, targets)
+
+
+@pytest.mark.asyncio
+async def test_run_cmd_streams(caplog: pytest.LogCaptureFixture) -> None:
+    """Output is logged line by line and result is structured"""
+    with caplog.at_level(logging.INFO):
+        result = await run_cmd(
+            [sys.executable, "-c", "import sys; print('out1'); print('out2'); print('err1', file=sys.stderr)"]
+        )
+    assert result.returncode == 0
+    assert not result.timed_out
+    assert result.duration > 0
+    messages = [(rec.levelno, rec.getMessage()) for rec in caplog.records]
+    assert (logging.INFO, f"{Path(sys.executable).name}: out1") in messages
+    assert (logging.INFO, f"{Path(sys.executable).name}: out2") in messages
+    assert (logging.WARNING, f"{Path(sys.executable).name}: err1") in messages
+
+
+@pytest.mark.asyncio
+async def test_run_cmd_returncode() -> None:
+    """Nonzero exit and the shlex wrapper"""
+    result = await run_cmd([sys.executable, "-c", "raise SystemExit(3)"])
+    assert result.returncode == 3
+    assert await call_cmd(f"{sys.executable} -c 'raise SystemExit(0)'") == 0
+
+
+@pytest.mark.asyncio
+async def test_run_cmd_timeout() -> None:
+    """Timeout kills the whole tree"""
+    started = time.monotonic()
+    result = await run_cmd(["sh", "-c", "sleep 30 & sleep 30"], timeout=0.5)
+    assert time.monotonic() - started < 10
+    assert result.timed_out
+    assert result.returncode != 0
+
+
+@pytest.mark.asyncio
+async def test_file_lock(tmp_path: Path) -> None:
+    """Lock excludes other holders, waiter gets it when released or times out"""
+    lockpath = tmp_path / "locks" / "test.lock"
+    async with file_lock(lockpath, 1.0):
+        with pytest.raises(TimeoutError):
+            async with file_lock(lockpath, 0.1):
+                pass
+
+        async def waiter() -> float:
+            """Get the lock and tell when"""
+            async with file_lock(lockpath, 5.0):
+                return asyncio.get_event_loop().time()
+
+        task = asyncio.create_task(waiter())
+        await asyncio.sleep(0.2)
+        assert not task.done()
+        release = asyncio.get_event_loop().time()
+    assert await task >= release
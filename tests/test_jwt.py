@@ -0,0 +1,211 @@
+"""Test the JWT helpers"""
+
+import asyncio
+import json
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import jwt as pyJWT
+import pytest
+from multikeyjwt.keygen import generate_keypair
+
+from miniwerk.config import KeyType, MWConfig
+from miniwerk import jwt as mwjwt
+from miniwerk.jwt import (
+    check_create_keypair,
+    get_issuer,
+    get_verifier,
+    load_issuer,
+    load_verifier,
+    ISSUER_CACHE,
+    pool_keypair,
+    claim_pooled_keypair,
+    prefill_keypool,
+    mint_csr_tokens,
+    batched_subjects,
+    jwk_thumbprint,
+    load_jwks,
+    JWKS_CACHE,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_cached_verifier() -> None:
+    """Verifier is reused while keys do not change"""
+    verifier1 = await get_verifier()
+    verifier2 = await get_verifier()
+    assert verifier1 is verifier2
+
+
+@pytest.mark.asyncio
+async def test_cached_issuer_config() -> None:
+    """Issuers share the key but not the config"""
+    issuer1 = await get_issuer()
+    issuer2 = await get_issuer()
+    assert issuer1 is not issuer2
+    issuer1.config.lifetime = 10
+    assert issuer2.config.lifetime != 10
+    verifier = await get_verifier()
+    claims = verifier.decode(issuer2.issue({"sub": "pytest"}))
+    assert claims["sub"] == "pytest"
+
+
+def test_key_change_reloads(tmp_path: Path) -> None:
+    """Changing the key files must invalidate the cache"""
+    privdir = tmp_path / "private"
+    privdir.mkdir()
+    pubdir = tmp_path / "publickeys"
+    pubdir.mkdir()
+    privkeypath = privdir / "jwt.key"
+    _, pubkey = generate_keypair(privkeypath, None)
+    (pubdir / "kraftwerk.pub").write_bytes(pubkey.read_bytes())
+    issuer = load_issuer(privkeypath)
+    cached = ISSUER_CACHE[privkeypath]
+    load_issuer(privkeypath)
+    assert ISSUER_CACHE[privkeypath] is cached
+    verifier = load_verifier(pubdir)
+    token = issuer.issue({"sub": "old"})
+    assert verifier.decode(token)["sub"] == "old"
+
+    # Rotate the keypair
+    privkeypath.unlink()
+    _, pubkey = generate_keypair(privkeypath, None)
+    (pubdir / "kraftwerk.pub").write_bytes(pubkey.read_bytes())
+    new_issuer = load_issuer(privkeypath)
+    assert ISSUER_CACHE[privkeypath] is not cached
+    new_verifier = load_verifier(pubdir)
+    assert new_verifier is not verifier
+    assert new_verifier.decode(new_issuer.issue({"sub": "new"}))["sub"] == "new"
+    with pytest.raises(Exception):
+        new_verifier.decode(token)
+
+
+def test_pool_claim(tmp_path: Path) -> None:
+    """Claim pregenerated keypairs from the pool"""
+    pooldir = tmp_path / "keypool"
+    pooldir.mkdir()
+    pubdir = tmp_path / "publickeys"
+    pubdir.mkdir()
+    privkeypath = tmp_path / "jwt.key"
+    pubkeypath = pubdir / "kraftwerk.pub"
+    assert not claim_pooled_keypair(pooldir, privkeypath, pubkeypath)
+    pool_keypair(pooldir, KeyType.ECDSA)
+    pool_keypair(pooldir, KeyType.ECDSA)
+    assert len(list(pooldir.glob("*.key"))) == 2
+    assert claim_pooled_keypair(pooldir, privkeypath, pubkeypath)
+    assert len(list(pooldir.glob("*.key"))) == 1
+    assert len(list(pooldir.glob("*.pub"))) == 1
+    assert privkeypath.exists()
+    issuer = load_issuer(privkeypath)
+    verifier = load_verifier(pubdir)
+    assert verifier.decode(issuer.issue({"sub": "pooled"}))["sub"] == "pooled"
+    # multikeyjwt<1.7 uses these instead of looking at the key
+    assert getattr(issuer.config, "algorithm") == "ES256"
+    assert getattr(verifier.config, "algorithm") == "ES256"
+    assert pyJWT.get_unverified_header(issuer.issue({"sub": "pooled"}))["alg"] == "ES256"
+
+
+@pytest.mark.asyncio
+async def test_prefill_keypool() -> None:
+    """Prefill the pool via the async API"""
+    config = MWConfig.singleton()
+    keypaths = await prefill_keypool(2, KeyType.ECDSA)
+    assert len(keypaths) == 2
+    for keypath in keypaths:
+        assert keypath.parent == config.keypool_path / "ecdsa"
+        assert keypath.exists()
+        assert keypath.with_suffix(".pub").exists()
+
+
+def test_batched_subjects() -> None:
+    """Subjects are repeated and chunked"""
+    batches = list(batched_subjects(iter(["a", "b", "c"]), 2, 4))
+    assert batches == [["a", "a", "b", "b"], ["c", "c"]]
+
+
+@pytest.mark.asyncio
+async def test_mint_csr_tokens() -> None:
+    """Mint tokens in batches over the process pool, order is kept"""
+    subjects = [f"product{idx}.pytest.pvarki.fi" for idx in range(5)]
+    minted = [item async for item in mint_csr_tokens(iter(subjects), count=2, lifetime=600, batch_size=3, workers=2)]
+    assert [subject for subject, _ in minted] == [subject for subject in subjects for _ in range(2)]
+    verifier = await get_verifier()
+    tokens = set()
+    for subject, token in minted:
+        claims = verifier.decode(token)
+        assert claims["sub"] == subject
+        assert claims["csr"]
+        assert claims["exp"] - claims["iat"] == 600
+        tokens.add(token)
+    assert len(tokens) == 10
+
+
+@pytest.mark.asyncio
+async def test_keypair_created_once(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Concurrent callers wait for the lock and use the keypair the first one made"""
+    config = MWConfig(data_path=tmp_path / "data", jwt_keytype=KeyType.ECDSA)  # type: ignore[call-arg]
+    calls = []
+    orig = mwjwt.generate_jwt_keypair
+
+    def counting(privkeypath: Path, keytype: KeyType = KeyType.RSA) -> Tuple[Path, Path]:
+        """Count the calls"""
+        calls.append(privkeypath)
+        return orig(privkeypath, keytype)
+
+    monkeypatch.setattr(mwjwt, "generate_jwt_keypair", counting)
+    results = await asyncio.gather(*(check_create_keypair(config) for _ in range(4)))
+    assert len(calls) == 1
+    assert len(set(results)) == 1
+    assert (config.locks_path / "jwt_keypair.lock").exists()
+    _, pubkeypath = results[0]
+    assert [pth.name for pth in pubkeypath.parent.iterdir()] == ["kraftwerk.pub"]  # no temp files left
+    assert pubkeypath.stat().st_mode & 0o777 == 0o644
+
+
+def test_jwk_thumbprint() -> None:
+    """Example from RFC 7638 section 3.1"""
+    jwk = {
+        "kty": "RSA",
+        "n": (
+            "0vx7agoebGcQSuuPiLJXZptN9nndrQmbXEps2aiAFbWhM78LhWx4cbbfAAtVT86zwu1RK7aPFFxuhDR1L6tSoc_BJECPebWK"
+            "RXjBZCiFV4n3oknjhMstn64tZ_2W-5JsGY4Hc5n9yBXArwl93lqt7_RN5w6Cf0h4QyQ5v-65YGjQR0_FDW2QvzqY368QQMic"
+            "AtaSqzs8KJZgnYb9c7d0zgdAZHzu6qMQvRL5hajrn1n91CbOpbISD08qNLyrdkt-bFTWhAI4vMQFh6WeZu0fM4lFd2NcRwr3"
+            "XPksINHaQ-G_xBniIqbw0Ls1jF44-csFCur-kEgU8awapJzKnqDKgw"
+        ),
+        "e": "AQAB",
+        "alg": "RS256",
+        "kid": "2011-04-29",
+    }
+    assert jwk_thumbprint(jwk) == "NzbLsXh8uDCcd-6MNwXF4W_7noWXFZAfHkxZsRGC9Xs"
+
+
+def test_jwks_rotation(tmp_path: Path) -> None:
+    """All keys in the dir are in the JWKS, tokens verify with it, rebuilt only on change"""
+    pubdir = tmp_path / "publickeys"
+    pubdir.mkdir()
+    issuers = []
+    for name, keytype in (("old", KeyType.RSA), ("kraftwerk", KeyType.ECDSA)):
+        privkeypath, pubkeypath = mwjwt.generate_jwt_keypair(tmp_path / f"{name}.key", keytype)
+        (pubdir / f"{name}.pub").write_bytes(pubkeypath.read_bytes())
+        issuers.append(load_issuer(privkeypath))
+    jwks = load_jwks(pubdir)
+    assert load_jwks(pubdir) is jwks
+    keys = json.loads(jwks)["keys"]
+    assert sorted(key["kty"] for key in keys) == ["EC", "RSA"]
+    keyset = pyJWT.PyJWKSet.from_json(jwks.decode("utf-8"))
+    for issuer in issuers:
+        token = issuer.issue({"sub": "pytest"})
+        for key in keyset.keys:
+            try:
+                assert pyJWT.decode(token, key=key.key, algorithms=[key.algorithm_name])["sub"] == "pytest"
+                break
+            except pyJWT.InvalidTokenError:
+                continue
+        else:
+            pytest.fail("token did not verify")
+    (pubdir / "old.pub").unlink()
+    assert len(json.loads(load_jwks(pubdir))["keys"]) == 1
+    assert JWKS_CACHE[pubdir][1] is not jwks
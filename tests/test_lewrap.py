@@ -1,12 +1,17 @@
 """Test the LW wrapper (what little we can)"""
 
-from typing import List
+from typing import Any, List
 import logging
+from pathlib import Path
 
 import pytest
 
+from miniwerk import lewrap
 from miniwerk.lewrap import call_certbot
 from miniwerk.config import MWConfig
+from miniwerk.helpers import CmdResult
+
+from .conftest import CertFactory
 
 LOGGER = logging.getLogger(__name__)
 
@@ -62,3 +67,62 @@ async def test_live_config(monkeypatch: pytest.MonkeyPatch) -> None:
         _, args = await call_certbot(config)
         check_common_args(args, config)
         assert "--staging" not in args
+
+
+@pytest.mark.asyncio
+async def test_valid_cert_skips_certbot(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, selfsigned_cert: CertFactory
+) -> None:
+    """Cert with all the names and far from expiry means certbot is not called"""
+
+    async def no_call(*args: Any, **kwargs: Any) -> CmdResult:
+        """Fail if called"""
+        raise AssertionError("Should not call certbot")
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("CI", "false")
+        mpatch.setenv("MW_DATA_PATH", str(tmp_path))
+        mpatch.setattr(lewrap, "run_cmd", no_call)
+        config = MWConfig()  # type: ignore[call-arg]
+        assert config.ci is False
+        selfsigned_cert(config.le_cert_dir, config.fqdns, 90)
+        retcode, args = await call_certbot(config)
+        assert retcode == 0
+        check_common_args(args, config)
+
+
+@pytest.mark.asyncio
+async def test_lineage_args(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Sharded lineage gets its own cert-name and names"""
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_CERT_SHARDING", "product")
+        config = MWConfig()  # type: ignore[call-arg]
+        _, args = await call_certbot(config, "rasenmaeher-tak")
+        assert args[args.index("--cert-name") + 1] == "rasenmaeher-tak"
+        assert args[args.index("--domains") + 1] == "tak.pytest.pvarki.fi,mtls.tak.pytest.pvarki.fi"
+
+
+@pytest.mark.asyncio
+async def test_expiring_cert_forces_renewal(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, selfsigned_cert: CertFactory
+) -> None:
+    """Cert inside cert_renew_before but outside certbot's own window is renewed anyway"""
+    calls: List[List[str]] = []
+
+    async def record(args: List[str], *_args: Any, **_kwargs: Any) -> CmdResult:
+        """Record the call"""
+        calls.append(list(args))
+        return CmdResult(args=list(args), returncode=0, duration=0.0)
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("CI", "false")
+        mpatch.setenv("MW_DATA_PATH", str(tmp_path))
+        mpatch.setenv("MW_CERT_RENEW_BEFORE", str(3600 * 24 * 60))
+        mpatch.setattr(lewrap, "run_cmd", record)
+        config = MWConfig()  # type: ignore[call-arg]
+        selfsigned_cert(config.le_cert_dir, config.fqdns, 45)
+        retcode, args = await call_certbot(config)
+        assert retcode == 0
+        assert calls == [["certbot"] + args]
+        assert "--force-renewal" in args
+        assert "--keep-until-expiring" not in args
@@ -0,0 +1,108 @@
+"""Test the builtin local CA"""
+
+from typing import List
+import asyncio
+import logging
+from pathlib import Path
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
+
+from miniwerk.config import MWConfig, CertSharding, KeyType, LocalCAEngine
+from miniwerk.helpers import cert_needs_renewal
+from miniwerk import localca
+from miniwerk.localca import check_create_ca, issue_certs, load_ca
+from miniwerk.mkcwrap import get_mk_certs
+
+LOGGER = logging.getLogger(__name__)
+
+
+def localca_config(tmp_path: Path) -> MWConfig:
+    """Config with all paths in tmp_path"""
+    return MWConfig(  # type: ignore[call-arg]
+        mkcert=True,
+        localca_engine=LocalCAEngine.BUILTIN,
+        mkcert_caroot=tmp_path / "caroot",
+        ca_public_path=tmp_path / "ca_public",
+        data_path=tmp_path / "data",
+        le_copy_path=tmp_path / "le_certs",
+    )
+
+
+@pytest.mark.asyncio
+async def test_product_lineages(tmp_path: Path) -> None:
+    """One cert per product signed by the created CA, second run does not write anything"""
+    config = localca_config(tmp_path)
+    config.cert_sharding = CertSharding.PRODUCT
+    assert len(config.local_cert_lineages) > 1
+    await get_mk_certs(config)
+    cacert = x509.load_pem_x509_certificate((tmp_path / "caroot" / "rootCA.pem").read_bytes())
+    assert (tmp_path / "ca_public" / "miniwerk_ca.pem").read_bytes() == (
+        tmp_path / "caroot" / "rootCA.pem"
+    ).read_bytes()
+    capub = cacert.public_key()
+    assert isinstance(capub, rsa.RSAPublicKey)
+    mtimes = {}
+    for lineage, names in config.local_cert_lineages.items():
+        certpath = config.mk_lineage_dir(lineage) / "fullchain.pem"
+        cert = x509.load_pem_x509_certificate(certpath.read_bytes())
+        assert cert.issuer == cacert.subject
+        assert cert.signature_hash_algorithm is not None
+        capub.verify(cert.signature, cert.tbs_certificate_bytes, padding.PKCS1v15(), cert.signature_hash_algorithm)
+        sans = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        assert set(sans.get_values_for_type(x509.DNSName)) == set(names)
+        assert isinstance(cert.public_key(), ec.EllipticCurvePublicKey)
+        for target in config.lineage_copy_targets(lineage):
+            assert (target.path / "fullchain.pem").read_bytes() == certpath.read_bytes()
+        mtimes[certpath] = certpath.stat().st_mtime_ns
+    await get_mk_certs(config)
+    assert {certpath: certpath.stat().st_mtime_ns for certpath in mtimes} == mtimes
+
+
+@pytest.mark.asyncio
+async def test_single_rsa(tmp_path: Path) -> None:
+    """Default sharding gives one cert, keytype is honored"""
+    config = localca_config(tmp_path)
+    assert list(config.local_cert_lineages.keys()) == [config.le_cert_name]
+    issued = await issue_certs(
+        tmp_path / "caroot", {"test": ["a.example.com", "b.example.com"]}, KeyType.RSA, config=config
+    )
+    cert = x509.load_pem_x509_certificate(issued["test"][0])
+    assert isinstance(cert.public_key(), rsa.RSAPublicKey)
+    assert b"PRIVATE KEY" in issued["test"][1]
+
+
+@pytest.mark.asyncio
+async def test_default_caroot(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Without mkcert_caroot or CAROOT the CA goes to $XDG_DATA_HOME/mkcert, mkcert is not needed"""
+    config = localca_config(tmp_path)
+    config.mkcert_caroot = None
+    monkeypatch.delenv("CAROOT", raising=False)
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "xdg"))
+    monkeypatch.setenv("PATH", str(tmp_path / "nobin"))
+    await get_mk_certs(config)
+    assert (tmp_path / "ca_public" / "miniwerk_ca.pem").read_bytes() == (
+        tmp_path / "xdg" / "mkcert" / "rootCA.pem"
+    ).read_bytes()
+    assert not cert_needs_renewal(config.mk_lineage_dir(config.le_cert_name) / "fullchain.pem", config.fqdns, 0)
+
+
+@pytest.mark.asyncio
+async def test_ca_created_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Concurrent callers wait for the lock and use the CA the first one made"""
+    config = localca_config(tmp_path)
+    calls: List[Path] = []
+    orig = localca.create_ca
+
+    def counting(caroot: Path) -> None:
+        """Count the calls"""
+        calls.append(caroot)
+        orig(caroot)
+
+    monkeypatch.setattr(localca, "create_ca", counting)
+    await asyncio.gather(*(check_create_ca(tmp_path / "caroot", config) for _ in range(4)))
+    assert calls == [tmp_path / "caroot"]
+    assert (config.locks_path / "localca.lock").exists()
+    cacert, cakey = load_ca(tmp_path / "caroot")
+    assert cacert.public_key() == cakey.public_key()
@@ -1,14 +1,21 @@
 """Test manifest creation"""
 
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
 import logging
 import json
 from pathlib import Path
 
 import pytest
+from multikeyjwt import Issuer
+from multikeyjwt.keygen import generate_keypair
 
-from miniwerk.config import MWConfig
-from miniwerk.jwt import get_verifier
-from miniwerk.manifests import create_all_product_manifests, create_rasenmaeher_manifest
+from miniwerk import manifests
+from miniwerk.config import MWConfig, ManifestFormat
+from miniwerk.helpers import file_lock
+from miniwerk.jwt import get_verifier, check_create_keypair, load_issuer
+from miniwerk.manifests import create_all_product_manifests, create_rasenmaeher_manifest, verify_manifests, copy_jwt_pub
+from miniwerk.models import ProductManifest
 
 LOGGER = logging.getLogger(__name__)
 
@@ -48,3 +55,213 @@ async def test_fakeproduct_manifest() -> None:
     assert claims["csr"]
     assert claims["nonce"]
     assert f"mtls.{config.domain}" in manifest["rasenmaeher"]["mtls"]["base_uri"]
+
+
+@pytest.mark.asyncio
+async def test_all_product_manifests_limited(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Check that concurrency limit of one still creates all manifests, with one keypair check"""
+    config = MWConfig.singleton()
+    calls = []
+    orig_check = check_create_keypair
+
+    async def counting_check(config: Optional[MWConfig] = None) -> Tuple[Path, Path]:
+        """Count the calls"""
+        calls.append(1)
+        return await orig_check(config)
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(config, "manifest_concurrency", 1)
+        mpatch.setattr(manifests, "check_create_keypair", counting_check)
+        pths = await create_all_product_manifests()
+    assert len(calls) == 1
+    assert {pth.parent.name for pth in pths} == set(config.product_manifest_paths.keys())
+    for pth in pths:
+        assert pth.exists()
+
+
+def manifest_mtimes(pths: List[Path]) -> Dict[str, int]:
+    """Map product name to manifest mtime"""
+    return {pth.parent.name: pth.stat().st_mtime_ns for pth in pths}
+
+
+@pytest.mark.asyncio
+async def test_unchanged_no_writes(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Re-running with same config must not sign or write anything"""
+    await create_rasenmaeher_manifest()
+    before = manifest_mtimes(await create_all_product_manifests())
+    rm_before = (await create_rasenmaeher_manifest()).stat().st_mtime_ns
+
+    def no_issue(*args: Any, **kwargs: Any) -> str:
+        """Fail if called"""
+        raise AssertionError("Should not sign anything")
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(Issuer, "issue", no_issue)
+        after = manifest_mtimes(await create_all_product_manifests())
+        rm_after = (await create_rasenmaeher_manifest()).stat().st_mtime_ns
+    assert before == after
+    assert rm_before == rm_after
+
+
+@pytest.mark.asyncio
+async def test_state_saved_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    """All the rewritten manifests go to the state file in one write"""
+    config = MWConfig.singleton()
+    saves: List[Dict[Path, str]] = []
+    orig_save = manifests.save_manifest_digests
+
+    async def counting_save(digests: Dict[Path, str], config: Optional[MWConfig] = None, removed: Any = ()) -> None:
+        """Record the calls"""
+        saves.append(dict(digests))
+        await orig_save(digests, config, removed)
+
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(config, "csr_jwt_renew_before", 3600 * 25)
+        mpatch.setattr(manifests, "save_manifest_digests", counting_save)
+        pths = await create_all_product_manifests()
+    assert len(saves) == 1
+    assert {pth for pth in saves[0] if pth.suffix == ".json"} == set(pths)
+    state = manifests.load_manifest_state(config)
+    assert all(state[str(pth)] == digest for pth, digest in saves[0].items())
+
+
+@pytest.mark.asyncio
+async def test_state_lock_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Saving the state waits for the lock without blocking the loop and gives up after lock_timeout"""
+    config = MWConfig.singleton()
+    monkeypatch.setattr(config, "lock_timeout", 0.2)
+    async with file_lock(config.locks_path / "manifests_state.lock", 5.0):
+        ticks = asyncio.create_task(asyncio.sleep(0.05))
+        with pytest.raises(TimeoutError):
+            await manifests.save_manifest_digests({config.manifests_base / "nosuch.json": "0"}, config)
+        assert ticks.done()
+    assert str(config.manifests_base / "nosuch.json") not in manifests.load_manifest_state(config)
+
+
+@pytest.mark.asyncio
+async def test_changed_config_rewrites(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Changing product config rewrites only that product (and RASENMAEHER)"""
+    config = MWConfig.singleton()
+    before = manifest_mtimes(await create_all_product_manifests())
+    rm_pth = await create_rasenmaeher_manifest()
+    rm_before = rm_pth.stat().st_mtime_ns
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(config.fake, "api_port", 4627)
+        pths = await create_all_product_manifests()
+        after = manifest_mtimes(pths)
+        await create_rasenmaeher_manifest()
+        assert rm_pth.stat().st_mtime_ns != rm_before
+        assert ":4627/" in json.loads(rm_pth.read_text(encoding="utf-8"))["products"]["fake"]["api"]
+    changed = {name for name in before if before[name] != after[name]}
+    assert changed == {"fake"}
+    fake_pth = [pth for pth in pths if pth.parent.name == "fake"][0]
+    assert ":4627/" in json.loads(fake_pth.read_text(encoding="utf-8"))["product"]["api"]
+
+
+@pytest.mark.asyncio
+async def test_expiring_token_rewrites(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Tokens about to expire get renewed"""
+    config = MWConfig.singleton()
+    before = manifest_mtimes(await create_all_product_manifests())
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(config, "csr_jwt_renew_before", 3600 * 25)
+        after = manifest_mtimes(await create_all_product_manifests())
+    assert all(before[name] != after[name] for name in before)
+
+
+@pytest.mark.asyncio
+async def test_verify_manifests(tmp_path: Path) -> None:
+    """Good, expired and tampered tokens"""
+    config = MWConfig.singleton()
+    pths = await create_all_product_manifests()
+    statuses = await verify_manifests(chunk_size=1)
+    assert {status.manifest_path for status in statuses} >= set(pths)
+    for status in statuses:
+        assert status.valid
+        assert not status.needs_renewal(config.csr_jwt_renew_before)
+        assert status.subject == f"{status.manifest_path.parent.name}.{config.domain}"
+
+    privkeypath, _ = await check_create_keypair()
+    issuer = load_issuer(privkeypath)
+    issuer.config.lifetime = -10
+    expired = issuer.issue({"sub": "expired"})
+    good = json.loads(pths[0].read_text(encoding="utf-8"))
+    for name, token in (("expired", expired), ("tampered", good["rasenmaeher"]["init"]["csr_jwt"][:-4] + "AAAA")):
+        (tmp_path / name).mkdir()
+        good["rasenmaeher"]["init"]["csr_jwt"] = token
+        (tmp_path / name / "kraftwerk-init.json").write_text(json.dumps(good), encoding="utf-8")
+    (tmp_path / "broken").mkdir()
+    (tmp_path / "broken" / "kraftwerk-init.json").write_text("{", encoding="utf-8")
+    statuses = await verify_manifests(tmp_path)
+    LOGGER.debug("statuses={}".format(statuses))
+    assert [status.manifest_path.parent.name for status in statuses] == ["broken", "expired", "tampered"]
+    assert not any(status.valid for status in statuses)
+    assert all(status.needs_renewal(0) for status in statuses)
+    assert statuses[0].expires_in is None
+    assert statuses[1].expires_in is not None and statuses[1].expires_in < 0
+    assert statuses[2].expires_in is not None and statuses[2].expires_in > 0
+
+
+@pytest.mark.asyncio
+async def test_manifest_format(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Changing the format rewrites the manifests, content stays the same"""
+    config = MWConfig.singleton()
+    pths = await create_all_product_manifests()
+    rm_pth = await create_rasenmaeher_manifest()
+    compact = {pth: json.loads(pth.read_bytes()) for pth in pths + [rm_pth]}
+    assert b"\n" not in rm_pth.read_bytes()
+    with monkeypatch.context() as mpatch:
+        mpatch.setattr(config, "manifest_format", ManifestFormat.PRETTY)
+        before = manifest_mtimes(pths)
+        after = manifest_mtimes(await create_all_product_manifests())
+        assert all(before[name] != after[name] for name in before)
+        await create_rasenmaeher_manifest()
+        assert b'\n  "dns"' in rm_pth.read_bytes()
+        assert json.loads(rm_pth.read_bytes()) == compact[rm_pth]
+        for pth in pths:
+            manifest = ProductManifest.model_validate_json(pth.read_bytes())
+            assert manifest.product.dns == f"{pth.parent.name}.{config.domain}"
+            assert manifest.rasenmaeher.init.csr_jwt
+            assert manifest.model_dump()["product"] == compact[pth]["product"]
+    await create_rasenmaeher_manifest()
+    assert b"\n" not in rm_pth.read_bytes()
+
+
+@pytest.mark.asyncio
+async def test_copy_jwt_pub(tmp_path: Path) -> None:
+    """Changed and added keys are copied and the JWKS follows them"""
+    _, mw_jwt_pub = await check_create_keypair()
+    srcdir = tmp_path / "src"
+    srcdir.mkdir()
+    srcpub = srcdir / "kraftwerk.pub"
+    srcpub.write_bytes(mw_jwt_pub.read_bytes())
+    manifest_dir = tmp_path / "product"
+    # The dir is shared with the product, keys it put there are not ours to remove
+    (manifest_dir / "publickeys").mkdir(parents=True)
+    (manifest_dir / "publickeys" / "product-own.pub").write_bytes(mw_jwt_pub.read_bytes())
+    await copy_jwt_pub(manifest_dir, srcpub)
+    assert (manifest_dir / "publickeys" / "kraftwerk.pub").read_bytes() == srcpub.read_bytes()
+    assert len(json.loads((manifest_dir / "jwks.json").read_bytes())["keys"]) == 1
+    mtime = (manifest_dir / "jwks.json").stat().st_mtime_ns
+    await copy_jwt_pub(manifest_dir, srcpub)
+    assert (manifest_dir / "jwks.json").stat().st_mtime_ns == mtime
+
+    # Rotate: new key in place, old one stays active for the overlap
+    (srcdir / "kraftwerk-old.pub").write_bytes(srcpub.read_bytes())
+    _, newpub = generate_keypair(tmp_path / "new.key", None)
+    srcpub.write_bytes(newpub.read_bytes())
+    await copy_jwt_pub(manifest_dir, srcpub)
+    assert (manifest_dir / "publickeys" / "kraftwerk.pub").read_bytes() == newpub.read_bytes()
+    assert (manifest_dir / "publickeys" / "kraftwerk-old.pub").exists()
+    assert len(json.loads((manifest_dir / "jwks.json").read_bytes())["keys"]) == 2
+
+    assert str(manifest_dir / "publickeys" / "kraftwerk-old.pub") in manifests.load_manifest_state()
+
+    # Retire the old key, it must not stay trusted in the product dir
+    (srcdir / "kraftwerk-old.pub").unlink()
+    await copy_jwt_pub(manifest_dir, srcpub)
+    assert not (manifest_dir / "publickeys" / "kraftwerk-old.pub").exists()
+    assert (manifest_dir / "publickeys" / "kraftwerk.pub").exists()
+    assert (manifest_dir / "publickeys" / "product-own.pub").exists()
+    assert str(manifest_dir / "publickeys" / "kraftwerk-old.pub") not in manifests.load_manifest_state()
+    assert len(json.loads((manifest_dir / "jwks.json").read_bytes())["keys"]) == 1
@@ -2,11 +2,15 @@
 
 from typing import List
 import logging
+from pathlib import Path
 
 import pytest
 
-from miniwerk.mkcwrap import call_mkcert
+from miniwerk.mkcwrap import call_mkcert, assemble_fullchain, get_mk_certs
 from miniwerk.config import MWConfig
+from miniwerk.helpers import mkcert_caroot, CAROOT_CACHE
+
+from .conftest import CertFactory
 
 LOGGER = logging.getLogger(__name__)
 
@@ -14,7 +18,8 @@ LOGGER = logging.getLogger(__name__)
 def check_common_args(args: List[str], config: MWConfig) -> None:
     """Common checks"""
     LOGGER.debug("args={}".format(args))
-    assert " ".join(config.fqdns) in args
+    for fqdn in config.fqdns:
+        assert fqdn in args
 
 
 @pytest.mark.asyncio
@@ -39,3 +44,45 @@ async def test_rsa_config(monkeypatch: pytest.MonkeyPatch) -> None:
         _, args = await call_mkcert(config)
         check_common_args(args, config)
         assert "--ecdsa" not in args
+
+
+@pytest.mark.asyncio
+async def test_caroot(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Config beats env beats (cached) mkcert"""
+    config = MWConfig()  # type: ignore[call-arg]
+    with monkeypatch.context() as mpatch:
+        mpatch.setitem(CAROOT_CACHE, "mkcert", tmp_path / "cached")
+        mpatch.delenv("CAROOT", raising=False)
+        assert await mkcert_caroot(config) == tmp_path / "cached"
+        mpatch.setenv("CAROOT", str(tmp_path / "env"))
+        assert await mkcert_caroot(config) == tmp_path / "env"
+        config.mkcert_caroot = tmp_path / "config"
+        assert await mkcert_caroot(config) == tmp_path / "config"
+
+
+@pytest.mark.asyncio
+async def test_fullchain_and_ca(tmp_path: Path, selfsigned_cert: CertFactory) -> None:
+    """fullchain.pem and the public CA are written only when the bytes change"""
+    config = MWConfig(  # type: ignore[call-arg]
+        mkcert=True,
+        mkcert_caroot=tmp_path / "caroot",
+        ca_public_path=tmp_path / "ca_public",
+        data_path=tmp_path / "data",
+        le_copy_path=tmp_path / "le_certs",
+    )
+    selfsigned_cert(config.mk_cert_dir, config.fqdns, 90)
+    selfsigned_cert(tmp_path / "caroot", ["Test CA"], 900).with_name("cert.pem").rename(
+        tmp_path / "caroot" / "rootCA.pem"
+    )
+    cabytes = (tmp_path / "caroot" / "rootCA.pem").read_bytes()
+    assert await assemble_fullchain(config)
+    assert not await assemble_fullchain(config)
+    assert (config.mk_cert_dir / "fullchain.pem").read_bytes().endswith(cabytes)
+
+    copydir = await get_mk_certs(config)
+    capath = tmp_path / "ca_public" / "miniwerk_ca.pem"
+    assert capath.read_bytes() == cabytes
+    assert (copydir / "fullchain.pem").read_bytes() == (config.mk_cert_dir / "fullchain.pem").read_bytes()
+    mtime = capath.stat().st_mtime_ns
+    await get_mk_certs(config)
+    assert capath.stat().st_mtime_ns == mtime
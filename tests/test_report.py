@@ -0,0 +1,96 @@
+"""Test the run report instrumentation"""
+
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+import pytest
+from libadvian.binpackers import ensure_str
+
+from miniwerk.helpers import run_cmd, write_if_changed
+from miniwerk.report import in_context, measure, reporting, to_prometheus
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_nested_stages(tmp_path: Path) -> None:
+    """Bytes count to the stage and its parents, also from executor threads, subprocesses to the innermost"""
+    loop = asyncio.get_event_loop()
+    with reporting("pytest") as report:
+        with measure("outer") as outer:
+            with measure("inner") as inner:
+                await loop.run_in_executor(None, in_context(write_if_changed, tmp_path / "test.txt", b"12345"))
+                await run_cmd(["true"])
+            write_if_changed(tmp_path / "other.txt", b"123")
+        with measure("not_in_report_twice"):
+            write_if_changed(tmp_path / "test.txt", b"12345")  # unchanged, not written
+    LOGGER.debug("report={}".format(report))
+    assert [stage.name for stage in report.stages] == ["outer", "inner", "not_in_report_twice"]
+    assert inner.parent == "outer"
+    assert inner.bytes_written == 5
+    assert outer.bytes_written == 8
+    assert report.stages[2].bytes_written == 0
+    assert [sub.program for sub in inner.subprocesses] == ["true"]
+    assert not outer.subprocesses
+    assert report.wall >= outer.wall >= inner.wall > 0
+    json.dumps(report.to_dict())
+
+
+def test_no_report() -> None:
+    """Measuring outside of a report is a no-op"""
+    with measure("orphan") as record:
+        pass
+    assert record.parent is None
+
+
+def test_prometheus() -> None:
+    """Check the exposition format"""
+    with reporting("pytest") as report:
+        with measure('quote"d'):
+            pass
+    text = to_prometheus(report)
+    assert text.endswith("\n")
+    assert 'miniwerk_stage_wall_seconds{command="pytest",stage="quote\\"d",path="quote\\"d"}' in text
+    assert "# TYPE miniwerk_stage_bytes_written gauge" in text
+
+
+def test_prometheus_unique_series() -> None:
+    """Same stage under different parents gets its own series, repeats under the same path are summed"""
+    with reporting("pytest") as report:
+        for deployment in ("dep0", "dep1"):
+            with measure(deployment):
+                for _ in range(2):
+                    with measure("manifest:fake") as record:
+                        record.bytes_written = 1
+    assert [stage.path for stage in report.stages][:3] == ["dep0", "dep0/manifest:fake", "dep0/manifest:fake"]
+    series = [line.rsplit(" ", 1) for line in to_prometheus(report).splitlines() if not line.startswith("#")]
+    names = [name for name, _ in series]
+    assert len(names) == len(set(names))
+    assert (
+        dict(series)['miniwerk_stage_bytes_written{command="pytest",stage="manifest:fake",path="dep1/manifest:fake"}']
+        == "2"
+    )
+
+
+@pytest.mark.asyncio
+async def test_report_cli(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Check that the manifests command writes the report files"""
+    reportpath = tmp_path / "report.json"
+    metricspath = tmp_path / "textfile" / "miniwerk.prom"
+    with monkeypatch.context() as mpatch:
+        mpatch.setenv("MW_REPORT_PATH", str(reportpath))
+        mpatch.setenv("MW_METRICS_TEXTFILE", str(metricspath))
+        process = await asyncio.create_subprocess_shell(
+            "miniwerk manifests",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        out = await asyncio.wait_for(process.communicate(), 30)
+        LOGGER.debug("stderr={}".format(ensure_str(out[1])))
+        assert process.returncode == 0
+    report = json.loads(reportpath.read_text(encoding="utf-8"))
+    assert report["command"] == "manifests"
+    assert "manifest:fake" in {stage["name"] for stage in report["stages"]}
+    assert 'miniwerk_run_wall_seconds{command="manifests"}' in metricspath.read_text(encoding="utf-8")
@@ -0,0 +1,111 @@
+"""Test the manifest HTTP service"""
+
+from typing import AsyncGenerator
+import logging
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from miniwerk import server as mwserver
+from miniwerk.config import MWConfig
+from miniwerk.jwt import get_verifier
+from miniwerk.server import ManifestServer
+
+Client = TestClient[web.Request, web.Application]
+
+LOGGER = logging.getLogger(__name__)
+
+# pylint: disable=W0621
+
+
+@pytest_asyncio.fixture
+async def client() -> AsyncGenerator[Client, None]:
+    """Client for the service running on localhost"""
+    server = ManifestServer()
+    await server.refresh()
+    async with TestClient(TestServer(server.make_app())) as client:
+        yield client
+
+
+@pytest.mark.asyncio
+async def test_rasenmaeher_manifest(client: Client) -> None:
+    """Static manifest and 304 for matching ETag"""
+    resp = await client.get("/rasenmaeher/kraftwerk-rasenmaeher-init.json")
+    assert resp.status == 200
+    data = await resp.json()
+    assert data["dns"] == MWConfig.singleton().domain
+    assert "fake" in data["products"]
+    etag = resp.headers["ETag"]
+    resp = await client.get("/rasenmaeher/kraftwerk-rasenmaeher-init.json", headers={"If-None-Match": etag})
+    assert resp.status == 304
+    resp = await client.get("/rasenmaeher/publickeys/kraftwerk.pub")
+    assert resp.status == 200
+    assert b"PUBLIC KEY" in await resp.read()
+    resp = await client.get("/fake/jwks.json")
+    assert resp.status == 200
+    assert (await resp.json(content_type=None))["keys"]
+
+
+@pytest.mark.asyncio
+async def test_product_manifest(client: Client) -> None:
+    """Fresh token on every 200, same weak ETag, 304 does not need a token"""
+    verifier = await get_verifier()
+    tokens = set()
+    etags = set()
+    for _ in range(2):
+        resp = await client.get("/fake/kraftwerk-init.json")
+        assert resp.status == 200
+        data = await resp.json()
+        token = data["rasenmaeher"]["init"]["csr_jwt"]
+        claims = verifier.decode(token)
+        assert claims["sub"] == data["product"]["dns"]
+        tokens.add(token)
+        etags.add(resp.headers["ETag"])
+    assert len(tokens) == 2
+    assert len(etags) == 1
+    etag = etags.pop()
+    assert etag.startswith('W/"')
+    resp = await client.get("/fake/kraftwerk-init.json", headers={"If-None-Match": '"other", ' + etag[2:]})
+    assert resp.status == 304
+    assert not await resp.read()
+
+
+@pytest.mark.asyncio
+async def test_product_etag_expires(client: Client, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A poller with an old manifest gets a new token once its token gets close to expiring"""
+    config = MWConfig.singleton()
+    window = config.csr_jwt_lifetime - config.csr_jwt_renew_before
+    now = [1000.0 * window]
+
+    class FakeTime:  # pylint: disable=R0903
+        """Clock for the server module only"""
+
+        @staticmethod
+        def time() -> float:
+            """Now"""
+            return now[0]
+
+    monkeypatch.setattr(mwserver, "time", FakeTime)
+    resp = await client.get("/fake/kraftwerk-init.json")
+    assert resp.status == 200
+    etag = resp.headers["ETag"]
+    token = (await resp.json())["rasenmaeher"]["init"]["csr_jwt"]
+    now[0] += window - 1
+    resp = await client.get("/fake/kraftwerk-init.json", headers={"If-None-Match": etag})
+    assert resp.status == 304
+    now[0] += 1
+    resp = await client.get("/fake/kraftwerk-init.json", headers={"If-None-Match": etag})
+    assert resp.status == 200
+    assert resp.headers["ETag"] != etag
+    assert (await resp.json())["rasenmaeher"]["init"]["csr_jwt"] != token
+
+
+@pytest.mark.asyncio
+async def test_unknown_product(client: Client) -> None:
+    """404 for products we do not have"""
+    resp = await client.get("/nosuch/kraftwerk-init.json")
+    assert resp.status == 404
+    resp = await client.get("/nosuch/publickeys/kraftwerk.pub")
+    assert resp.status == 404
@@ -0,0 +1,77 @@
+"""Test the stage runner"""
+
+from typing import List
+import asyncio
+import logging
+import time
+
+import pytest
+
+from miniwerk.stages import Stage, run_stages, log_stage_summary
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_dependencies_and_overlap() -> None:
+    """Dependent stages wait, independent ones overlap"""
+    order: List[str] = []
+
+    def sleeper(name: str, delay: float) -> Stage:
+        """Make a stage that sleeps"""
+
+        async def func() -> None:
+            """Sleep and record"""
+            await asyncio.sleep(delay)
+            order.append(name)
+
+        return Stage(name, func)
+
+    first = sleeper("first", 0.1)
+    second = sleeper("second", 0.1)
+    second.depends = ("first",)
+    parallel = sleeper("parallel", 0.2)
+    started = time.monotonic()
+    timings = await run_stages([first, second, parallel])
+    took = time.monotonic() - started
+    log_stage_summary(timings, took)
+    assert order.index("first") < order.index("second")
+    assert set(timings.keys()) == {"first", "second", "parallel"}
+    assert timings["parallel"] >= 0.2
+    # longest chain, not the sum of all
+    assert took < 0.35
+
+
+@pytest.mark.asyncio
+async def test_undefined_dependency() -> None:
+    """Dependencies must be defined before use"""
+
+    async def noop() -> None:
+        """Nothing"""
+
+    with pytest.raises(ValueError):
+        await run_stages([Stage("a", noop, ("b",)), Stage("b", noop)])
+    with pytest.raises(ValueError):
+        await run_stages([Stage("a", noop), Stage("a", noop)])
+
+
+@pytest.mark.asyncio
+async def test_failure_cancels() -> None:
+    """Failing stage cancels the rest"""
+    cancelled: List[bool] = []
+
+    async def fail() -> None:
+        """Raise"""
+        raise RuntimeError("fail")
+
+    async def slow() -> None:
+        """Would take long"""
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(ExceptionGroup):
+        await run_stages([Stage("slow", slow), Stage("fail", fail)])
+    assert cancelled